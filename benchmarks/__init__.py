@@ -0,0 +1,8 @@
+"""
+Benchmarks
+==========
+Standalone scripts that measure the performance of Kozmic CI components.
+Run them from the repository root, e.g.::
+
+    PYTHONPATH=. python -m benchmarks.tailer --help
+"""
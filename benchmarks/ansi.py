@@ -0,0 +1,80 @@
+# coding: utf-8
+"""
+benchmarks.ansi
+~~~~~~~~~~~~~~~
+
+Measures ANSI-to-HTML conversion throughput (lines per second) of
+:class:`kozmic.builds.ansi.AnsiToHtmlConverter` against
+:class:`ansi2html.Ansi2HTMLConverter` that Kozmic used before.
+
+Two cases are measured: line by line (how :class:`Publisher` converts live
+output) and a whole log at once (how the ``ansi2html`` Jinja filter renders
+a finished job)::
+
+    PYTHONPATH=. python -m benchmarks.ansi --lines 100000
+"""
+import time
+import random
+import argparse
+
+import ansi2html
+
+from kozmic.builds.ansi import AnsiToHtmlConverter
+
+
+SAMPLE_LINES = [
+    'Collecting Flask==0.10.1 (from -r requirements/kozmic.txt (line 1))',
+    '\x1b[1m============= test session starts =============\x1b[0m',
+    'tests/unit_tests.py \x1b[32m.\x1b[0m\x1b[32m.\x1b[0m\x1b[31mF\x1b[0m',
+    '\x1b[4mRunning "jshint:lib" (jshint) task\x1b[24m',
+    '\x1b[36m->\x1b[0m running \x1b[36m1 suite',
+    '  File "kozmic/builds/tasks.py", line 42, in <module> & <lambda>',
+    '\x1b[38;5;208mwarning:\x1b[0m unused variable `buf`',
+    '\x1b[1;31mE       assert 1 == 2\x1b[0m',
+]
+
+
+def generate_lines(count, seed=0):
+    rnd = random.Random(seed)
+    return [rnd.choice(SAMPLE_LINES) for _ in xrange(count)]
+
+
+def measure(convert, lines):
+    started_at = time.time()
+    convert(lines)
+    return len(lines) / (time.time() - started_at)
+
+
+def ansi2html_line_by_line(lines):
+    converter = ansi2html.Ansi2HTMLConverter()
+    for line in lines:
+        converter.convert(line, full=False)
+
+
+def ansi2html_whole_log(lines):
+    ansi2html.Ansi2HTMLConverter().convert('\n'.join(lines), full=False)
+
+
+def streaming_line_by_line(lines):
+    AnsiToHtmlConverter().convert_lines(lines)
+
+
+def streaming_whole_log(lines):
+    AnsiToHtmlConverter().convert('\n'.join(lines))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--lines', type=int, default=100000,
+                        help='number of lines to convert')
+    args = parser.parse_args()
+
+    lines = generate_lines(args.lines)
+    print('{:<28} {:>14}'.format('converter', 'lines/sec'))
+    for convert in (ansi2html_line_by_line, streaming_line_by_line,
+                    ansi2html_whole_log, streaming_whole_log):
+        print('{:<28} {:>14,.0f}'.format(convert.__name__, measure(convert, lines)))
+
+
+if __name__ == '__main__':
+    main()
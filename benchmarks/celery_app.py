@@ -0,0 +1,52 @@
+# coding: utf-8
+"""
+benchmarks.celery_app
+~~~~~~~~~~~~~~~~~~~~~
+
+Measures the overhead Kozmic adds to every Celery task: creating
+a :class:`Flask` application per task (what ``ContextTask`` did before)
+versus pushing an application context of the per-process application
+returned by :func:`kozmic.get_worker_app`::
+
+    KOZMIC_CONFIG=kozmic.config.TestingConfig \\
+        PYTHONPATH=. python -m benchmarks.celery_app --tasks 200
+"""
+import time
+import argparse
+
+import kozmic
+
+
+def app_per_task(tasks):
+    for _ in xrange(tasks):
+        with kozmic.create_app().app_context():
+            pass
+
+
+def app_per_process(tasks):
+    for _ in xrange(tasks):
+        with kozmic.get_worker_app().app_context():
+            pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--tasks', type=int, default=200,
+                        help='number of simulated tasks')
+    args = parser.parse_args()
+
+    started_at = time.time()
+    kozmic.get_worker_app()
+    print('worker process startup: {:.2f} ms'.format(
+        (time.time() - started_at) * 1000))
+
+    print('{:<16} {:>16}'.format('strategy', 'overhead/task, ms'))
+    for strategy in (app_per_task, app_per_process):
+        started_at = time.time()
+        strategy(args.tasks)
+        print('{:<16} {:>16.3f}'.format(
+            strategy.__name__, (time.time() - started_at) * 1000 / args.tasks))
+
+
+if __name__ == '__main__':
+    main()
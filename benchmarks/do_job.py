@@ -0,0 +1,387 @@
+# coding: utf-8
+"""
+benchmarks.do_job
+~~~~~~~~~~~~~~~~~
+
+Runs :func:`kozmic.builds.tasks.do_job` end to end and reports throughput,
+per-phase latency and peak RSS of the worker process. Docker is replaced
+by an in-process fake whose containers write ``--lines`` lines of
+``--line-size`` bytes to the job log, GitHub -- by a local HTTP stub.
+Everything else (``Builder``, the tailers, ``Publisher``, the log store,
+the scheduler) is real, so the benchmark needs the MySQL database and
+Redis configured by ``KOZMIC_CONFIG``::
+
+    KOZMIC_CONFIG=kozmic.config.TestingConfig PYTHONPATH=. \\
+        python -m benchmarks.do_job --jobs 50 --concurrency 4 --lines 5000
+
+.. warning::
+
+    The database and the Redis database are wiped clean before the run.
+"""
+import os
+import json
+import time
+import uuid
+import Queue
+import socket
+import struct
+import argparse
+import resource
+import threading
+import BaseHTTPServer
+import SocketServer
+
+import mock
+import github3
+
+import kozmic
+from kozmic.models import db, User, Job
+from kozmic.utils import get_redis_client
+from kozmic.builds import tasks
+from tests import factories
+
+
+DOCKER_IMAGE = 'kozmic/ubuntu-base:12.04'
+
+
+class FakeContainer(object):
+    def __init__(self, id, image, command):
+        self.id = id
+        self.image = image
+        self.command = command
+        self.working_dir = None
+        self.thread = None
+        self.killed = threading.Event()
+        # The container's end and the attach API end of its stdout
+        self.stdout, self.attach_socket = socket.socketpair()
+
+
+class FakeDocker(object):
+    """An in-process stand-in for :class:`docker.Client`. A started
+    container runs no script: it writes the clone timestamps and
+    `lines` lines of `line_size` bytes to its log, `rate` lines per second
+    (as fast as possible if `rate` is 0), and exits with code 0.
+    """
+    def __init__(self, lines, line_size, rate):
+        self._lines = lines
+        self._line_size = line_size
+        self._rate = rate
+        self._lock = threading.Lock()
+        self._containers = {}
+        self._images = {DOCKER_IMAGE: 'base-image-id'}
+
+    def _get(self, container):
+        if isinstance(container, dict):
+            container = container['Id']
+        with self._lock:
+            return self._containers[container]
+
+    def pull(self, image, tag=None):
+        pass
+
+    def inspect_image(self, image):
+        return {'Id': self._images[image]}
+
+    def images(self, name=None):
+        with self._lock:
+            return [{'Id': image_id, 'RepoTags': [repo_tag]}
+                    for repo_tag, image_id in self._images.items()
+                    if repo_tag.rsplit(':', 1)[0] == name]
+
+    def commit(self, container, repository=None, tag=None):
+        with self._lock:
+            self._images[':'.join((repository, tag))] = uuid.uuid4().hex
+
+    def create_container(self, image, command=None, volumes=None):
+        container = FakeContainer(uuid.uuid4().hex, image, command)
+        with self._lock:
+            self._containers[container.id] = container
+        return {'Id': container.id}
+
+    def start(self, container, binds=None):
+        container = self._get(container)
+        container.working_dir = next(path for path, mount in binds.items()
+                                     if mount == '/kozmic')
+        go = None
+        if 'pool-starter.sh' in container.command:
+            # A warm container blocks on the FIFO until Builder (or `kill`)
+            # writes to it. It is opened right away for reading and writing,
+            # as pool-starter.sh does, so that Builder can write to it as
+            # soon as the container is started
+            go = os.fdopen(os.open(
+                os.path.join(container.working_dir, 'go'), os.O_RDWR))
+        container.thread = threading.Thread(target=self._run,
+                                            args=(container, go))
+        container.thread.daemon = True
+        container.thread.start()
+
+    def _run(self, container, go=None):
+        working_dir_path = lambda f: os.path.join(container.working_dir, f)
+
+        if go is not None:
+            with go:
+                go.readline()
+            if container.killed.isSet():
+                return
+
+        with open(working_dir_path('script-starter.sh')) as f:
+            use_log_file = 'script.log' in f.read()
+        for name in ('clone-started-at', 'clone-finished-at'):
+            with open(working_dir_path(name), 'w') as f:
+                f.write(repr(time.time()))
+
+        line = '{:0<%d}\n' % (self._line_size - 1)
+        log = None
+        if use_log_file:
+            log = open(working_dir_path('script.log'), 'a')
+        try:
+            for i in xrange(self._lines):
+                if container.killed.isSet():
+                    break
+                data = line.format('line #{} '.format(i))
+                if log:
+                    log.write(data)
+                    log.flush()
+                else:
+                    container.stdout.sendall(
+                        struct.pack('>BxxxL', 1, len(data)) + data)
+                if self._rate:
+                    time.sleep(1.0 / self._rate)
+        finally:
+            if log:
+                log.close()
+            container.stdout.close()
+
+    def wait(self, container):
+        container = self._get(container)
+        container.thread.join()
+        return 137 if container.killed.isSet() else 0
+
+    def logs(self, container, stdout=True, stderr=True):
+        return ''
+
+    def attach_socket(self, container, params=None):
+        return self._get(container).attach_socket
+
+    def inspect_container(self, container):
+        container = self._get(container)
+        return {'State': {'Running': bool(container.thread and
+                                          container.thread.is_alive())}}
+
+    def _kill(self, container):
+        container.killed.set()
+        if container.working_dir and 'pool-starter.sh' in container.command:
+            # Wake up a warm container that waits for Builder
+            try:
+                fd = os.open(os.path.join(container.working_dir, 'go'),
+                             os.O_WRONLY | os.O_NONBLOCK)
+            except OSError:
+                # The container has already been started by Builder
+                return
+            try:
+                os.write(fd, 'kill\n')
+            finally:
+                os.close(fd)
+
+    def kill(self, container):
+        self._kill(self._get(container))
+
+    def remove_container(self, container):
+        container = self._get(container)
+        with self._lock:
+            del self._containers[container.id]
+
+    def kill_all(self):
+        """Kills the containers left (i.e., warm ones) and waits
+        for them to exit.
+        """
+        with self._lock:
+            containers = self._containers.values()
+        for container in containers:
+            self._kill(container)
+            if container.thread:
+                container.thread.join()
+
+
+class GitHubStub(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """A local stand-in for the part of GitHub API used by jobs:
+    repositories, commit statuses and trees.
+    """
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(
+            self, ('127.0.0.1', 0), GitHubStubHandler)
+        self.url = 'http://127.0.0.1:{}'.format(self.server_port)
+
+
+class GitHubStubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def _respond(self, status, data):
+        body = json.dumps(data)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        parts = self.path.split('?')[0].strip('/').split('/')
+        if len(parts) == 3 and parts[0] == 'repos':
+            _, owner, name = parts
+            self._respond(200, {
+                'id': 1,
+                'name': name,
+                'full_name': '{}/{}'.format(owner, name),
+                'owner': {'login': owner, 'id': 1},
+                'url': '{}/repos/{}/{}'.format(self.server.url, owner, name),
+            })
+        elif parts[3:5] == ['git', 'trees']:
+            self._respond(200, {'sha': parts[5], 'tree': [
+                {'path': 'requirements.txt', 'type': 'blob',
+                 'sha': 'a' * 40, 'mode': '100644'},
+            ]})
+        else:
+            self._respond(404, {'message': 'Not Found'})
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.getheader('Content-Length', 0)))
+        self._respond(201, {'id': 1, 'state': 'success',
+                            'creator': {'login': 'kozmic', 'id': 1}})
+
+    def log_message(self, format, *args):
+        pass
+
+
+def create_hook_calls(jobs, install_script):
+    db.drop_all()
+    db.create_all()
+    get_redis_client().flushdb()
+    factories.setup(db.session)
+
+    user = factories.UserFactory.create()
+    project = factories.ProjectFactory.create(owner=user, is_public=True)
+    hook = factories.HookFactory.create(project=project,
+                                        docker_image=DOCKER_IMAGE,
+                                        install_script=install_script)
+    if install_script:
+        factories.TrackedFileFactory.create(hook=hook,
+                                            path='requirements.txt')
+    hook_call_ids = []
+    for _ in xrange(jobs):
+        build = factories.BuildFactory.create(project=project)
+        hook_call = factories.HookCallFactory.create(hook=hook, build=build)
+        hook_call_ids.append(hook_call.id)
+    return hook_call_ids
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def run(app, hook_call_ids, concurrency):
+    queue = Queue.Queue()
+    for hook_call_id in hook_call_ids:
+        queue.put(hook_call_id)
+
+    def worker():
+        while True:
+            try:
+                hook_call_id = queue.get_nowait()
+            except Queue.Empty:
+                return
+            tasks.do_job.apply(kwargs={'hook_call_id': hook_call_id})
+
+    threads = [threading.Thread(target=worker) for _ in xrange(concurrency)]
+    started_at = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.time() - started_at
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--jobs', type=int, default=20,
+                        help='number of jobs to run')
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help='number of jobs running at the same time')
+    parser.add_argument('--lines', type=int, default=1000,
+                        help='number of lines in every job log')
+    parser.add_argument('--line-size', type=int, default=80,
+                        help='size of a log line in bytes')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='lines per second written by every job '
+                             '(default: as fast as possible)')
+    parser.add_argument('--log-source', choices=('file', 'attach'),
+                        help='overrides KOZMIC_LOG_SOURCE')
+    parser.add_argument('--pool-size', type=int,
+                        help='overrides KOZMIC_CONTAINER_POOL_SIZE')
+    parser.add_argument('--install', action='store_true',
+                        help='give the hook an install script')
+    args = parser.parse_args()
+
+    app = kozmic.get_worker_app()
+    # Bind the tasks before they are applied from several threads
+    kozmic.celery.finalize()
+    if args.log_source:
+        app.config['KOZMIC_LOG_SOURCE'] = args.log_source
+    if args.pool_size is not None:
+        app.config['KOZMIC_CONTAINER_POOL_SIZE'] = args.pool_size
+    # All the jobs belong to a single project
+    app.config['KOZMIC_PROJECT_CONCURRENCY'] = args.concurrency
+
+    fake_docker = FakeDocker(args.lines, args.line_size, args.rate)
+    github_stub = GitHubStub()
+    github_thread = threading.Thread(target=github_stub.serve_forever)
+    github_thread.daemon = True
+    github_thread.start()
+
+    def get_gh(user):
+        gh = github3.login(token=user.gh_access_token)
+        gh._session.base_url = github_stub.url
+        return gh
+
+    with app.app_context(), \
+            mock.patch('kozmic.docker_utils.get_docker_client',
+                       return_value=fake_docker), \
+            mock.patch.object(User, 'gh', property(get_gh)):
+        hook_call_ids = create_hook_calls(
+            args.jobs, 'pip install -r requirements.txt' if args.install
+            else None)
+        wall = run(app, hook_call_ids, args.concurrency)
+        fake_docker.kill_all()
+
+        db.session.remove()
+        jobs = Job.query.all()
+        failed = sum(not job.is_finished() or job.return_code != 0
+                     for job in jobs)
+        durations = {}
+        for job in jobs:
+            if not job.is_finished():
+                continue
+            for phase, seconds in job.get_timings():
+                durations.setdefault(phase, []).append(seconds)
+            durations.setdefault('total', []).append(
+                (job.finished_at - job.started_at).total_seconds())
+    github_stub.shutdown()
+
+    print('{} jobs ({} failed), concurrency {}, {} lines x {} bytes, '
+          'log source: {}, container pool size: {}'.format(
+              len(jobs), failed, args.concurrency, args.lines, args.line_size,
+              app.config['KOZMIC_LOG_SOURCE'],
+              app.config['KOZMIC_CONTAINER_POOL_SIZE']))
+    print('throughput: {:.2f} jobs/s'.format(len(jobs) / wall))
+    print('peak RSS: {:.1f} MB'.format(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
+    print('{:<24} {:>9} {:>9} {:>9}'.format(
+        'phase', 'p50, ms', 'p95, ms', 'max, ms'))
+    for phase, values in sorted(durations.items()):
+        print('{:<24} {:>9.1f} {:>9.1f} {:>9.1f}'.format(
+            phase, percentile(values, 50) * 1000,
+            percentile(values, 95) * 1000, max(values) * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+# coding: utf-8
+"""
+benchmarks.tailer
+~~~~~~~~~~~~~~~~~
+
+Compares CPU usage and line latency of :class:`kozmic.builds.tasks.Tailer`
+with the previous implementation that followed the log by reading
+a ``tail -f`` subprocess in 0.5s ``select`` iterations.
+
+Every simulated job appends ``--lines`` timestamped lines to its own log file
+at ``--rate`` lines per second, all the jobs run concurrently::
+
+    PYTHONPATH=. python -m benchmarks.tailer --jobs 20 --lines 1000 --rate 100
+
+CPU time includes the writer threads, which do the same amount of work for
+both implementations, so only the difference between the rows is meaningful.
+"""
+import os
+import time
+import fcntl
+import shutil
+import select
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+
+from kozmic.builds.tasks import Tailer
+
+
+class LegacyTailer(Tailer):
+    """The ``tail -f``-based implementation Kozmic used before."""
+    def run(self):
+        tailf = subprocess.Popen(['tail', '-f', self._log_path],
+                                 stdout=subprocess.PIPE)
+        try:
+            fl = fcntl.fcntl(tailf.stdout, fcntl.F_GETFL)
+            fcntl.fcntl(tailf.stdout, fcntl.F_SETFL, fl | os.O_NONBLOCK)
+
+            buf = ''
+            while not self.is_stopped():
+                reads, _, _ = select.select([tailf.stdout], [], [], 0.5)
+                if not reads:
+                    continue
+                buf += tailf.stdout.read()
+                lines = buf.split('\n')
+                buf = lines.pop()
+                self._publisher.publish(lines)
+        finally:
+            tailf.terminate()
+            tailf.wait()
+            self._close_wakeup_pipe()
+
+
+class LatencyRecorder(object):
+    """A :class:`kozmic.builds.tasks.Publisher` stand-in that records
+    how long it took for every line to be published.
+    """
+    def __init__(self):
+        self.latencies = []
+
+    def publish(self, lines):
+        now = time.time()
+        if isinstance(lines, basestring):
+            lines = [lines]
+        for line in lines:
+            self.latencies.append(now - float(line.split(' ', 1)[0]))
+
+    def finish(self):
+        pass
+
+
+def write_log(path, lines, rate):
+    with open(path, 'a') as log:
+        for i in xrange(lines):
+            log.write('{:.6f} line #{} of a chatty test suite\n'.format(
+                time.time(), i))
+            log.flush()
+            time.sleep(1.0 / rate)
+
+
+def cpu_time():
+    usage = [resource.getrusage(who) for who in
+             (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+    return sum(u.ru_utime + u.ru_stime for u in usage)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def run(tailer_class, jobs, lines, rate):
+    working_dir = tempfile.mkdtemp()
+    try:
+        paths = [os.path.join(working_dir, '{}.log'.format(i))
+                 for i in range(jobs)]
+        for path in paths:
+            open(path, 'w').close()
+
+        recorders = [LatencyRecorder() for _ in paths]
+        tailers = [tailer_class(log_path=path, publisher=recorder)
+                   for path, recorder in zip(paths, recorders)]
+        writers = [threading.Thread(target=write_log, args=(path, lines, rate))
+                   for path in paths]
+
+        cpu_before, started_at = cpu_time(), time.time()
+        for thread in tailers + writers:
+            thread.start()
+        for writer in writers:
+            writer.join()
+        # Give the tailers a chance to catch up before stopping them
+        time.sleep(1)
+        for tailer in tailers:
+            tailer.stop()
+            tailer.join()
+        cpu, wall = cpu_time() - cpu_before, time.time() - started_at
+    finally:
+        shutil.rmtree(working_dir)
+
+    latencies = [l for recorder in recorders for l in recorder.latencies]
+    return {
+        'implementation': tailer_class.__name__,
+        'cpu_per_job': cpu / jobs,
+        'wall': wall,
+        'delivered': len(latencies),
+        'expected': jobs * lines,
+        'p50': percentile(latencies, 50) * 1000,
+        'p95': percentile(latencies, 95) * 1000,
+        'p99': percentile(latencies, 99) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--jobs', type=int, default=20,
+                        help='number of concurrently followed logs')
+    parser.add_argument('--lines', type=int, default=1000,
+                        help='number of lines written to every log')
+    parser.add_argument('--rate', type=float, default=100,
+                        help='lines per second written to every log')
+    args = parser.parse_args()
+
+    row = ('{implementation:<14} {cpu_per_job:>12.3f} {wall:>8.1f} '
+           '{delivered:>7}/{expected:<7} {p50:>9.2f} {p95:>9.2f} {p99:>9.2f}')
+    print('{:<14} {:>12} {:>8} {:>15} {:>9} {:>9} {:>9}'.format(
+        'implementation', 'cpu/job, s', 'wall, s', 'lines',
+        'p50, ms', 'p95, ms', 'p99, ms'))
+    for tailer_class in (LegacyTailer, Tailer):
+        print(row.format(**run(tailer_class, args.jobs, args.lines, args.rate)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,241 @@
+# coding: utf-8
+"""
+benchmarks.tailer_load
+~~~~~~~~~~~~~~~~~~~~~~
+
+Load-tests :mod:`tailer`: starts it under uWSGI with ``--gevent`` async
+cores, opens ``--clients`` websockets to ``--channels`` job logs and
+publishes ``--rate`` lines per second to every log the way
+:class:`kozmic.builds.tasks.Publisher` does. Reports how many clients
+have failed to connect or have been dropped, line delivery latency and
+CPU time and peak RSS of the uWSGI process::
+
+    KOZMIC_CONFIG=kozmic.config.TestingConfig PYTHONPATH=. \\
+        python -m benchmarks.tailer_load --clients 200 --gevent 25 50 100
+
+Every ``--gevent`` value is tested by a fresh uWSGI process. The clients
+run in threads of the benchmark process, so latencies include their
+share of the GIL. Requires ``uwsgi`` in ``$PATH``, the packages from
+``requirements/tailer.txt``, ``websocket-client`` and Redis configured by
+``KOZMIC_CONFIG``.
+"""
+import os
+import json
+import time
+import uuid
+import socket
+import argparse
+import threading
+import subprocess
+
+import redis
+import websocket
+from werkzeug.utils import import_string
+
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def get_free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def start_tailer(uwsgi, port, gevent):
+    process = subprocess.Popen(
+        [uwsgi, '--http-socket', '127.0.0.1:{}'.format(port),
+         '--gevent', str(gevent), '--gevent-monkey-patch',
+         '--module', 'tailer:app', '--chdir', ROOT_DIR,
+         '--listen', '1024', '--disable-logging'],
+        stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+    for _ in xrange(100):
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+        except socket.error:
+            if process.poll() is not None:
+                raise RuntimeError('uWSGI has exited with code {}.'.format(
+                    process.returncode))
+            time.sleep(0.1)
+        else:
+            return process
+    process.kill()
+    raise RuntimeError('uWSGI has not started listening in 10 seconds.')
+
+
+def get_process_usage(pid):
+    """Returns CPU time (in seconds) and peak RSS (in MB) of `pid`."""
+    with open('/proc/{}/stat'.format(pid)) as f:
+        # The process name may contain spaces and is wrapped in parentheses
+        fields = f.read().rsplit(')', 1)[1].split()
+    cpu = (int(fields[11]) + int(fields[12])) / float(
+        os.sysconf('SC_CLK_TCK'))
+    with open('/proc/{}/status'.format(pid)) as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                peak_rss = int(line.split()[1]) / 1024.0
+    return cpu, peak_rss
+
+
+class Client(threading.Thread):
+    """A websocket client of :mod:`tailer` that records the latencies of
+    received lines. A client is dropped if its connection breaks before
+    the tailer has reported that the job is finished.
+    """
+    def __init__(self, url, connect_timeout, recv_timeout):
+        super(Client, self).__init__()
+        self.daemon = True
+        self._url = url
+        self._connect_timeout = connect_timeout
+        self._recv_timeout = recv_timeout
+        self.latencies = []
+        self.connected = threading.Event()
+        self.is_connected = False
+        self.is_dropped = False
+
+    def run(self):
+        try:
+            ws = websocket.create_connection(
+                self._url, timeout=self._connect_timeout)
+        except Exception:
+            self.connected.set()
+            return
+        self.is_connected = True
+        self.connected.set()
+        try:
+            ws.settimeout(self._recv_timeout)
+            while True:
+                message = json.loads(ws.recv())
+                if message['type'] == 'status':
+                    break
+                self._record(message['content'])
+        except Exception:
+            self.is_dropped = True
+        finally:
+            ws.close()
+
+    def _record(self, content):
+        now = time.time()
+        for line in content.splitlines():
+            try:
+                self.latencies.append(now - float(line.split(' ', 1)[0]))
+            except ValueError:
+                # Not a timestamped line
+                pass
+
+
+def publish(redis_client, channel, lines, rate):
+    for i in xrange(lines):
+        line = '{:.6f} line #{} of a chatty test suite\n'.format(
+            time.time(), i)
+        pipeline = redis_client.pipeline(transaction=False)
+        pipeline.rpush(channel, line)
+        pipeline.publish(channel, line)
+        pipeline.execute()
+        time.sleep(1.0 / rate)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def run(redis_client, args, gevent):
+    port = get_free_port()
+    channels = [uuid.uuid4().hex for _ in xrange(args.channels)]
+    for channel in channels:
+        # The tailer streams a channel while its key exists
+        redis_client.rpush(channel, 'Load test\n')
+
+    process = start_tailer(args.uwsgi, port, gevent)
+    try:
+        cpu_before, _ = get_process_usage(process.pid)
+        clients = [Client('ws://127.0.0.1:{}/{}/'.format(
+                              port, channels[i % len(channels)]),
+                          connect_timeout=args.connect_timeout,
+                          recv_timeout=args.recv_timeout)
+                   for i in xrange(args.clients)]
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.connected.wait()
+
+        publishers = [threading.Thread(
+                          target=publish,
+                          args=(redis_client, channel, args.lines, args.rate))
+                      for channel in channels]
+        for publisher in publishers:
+            publisher.start()
+        for publisher in publishers:
+            publisher.join()
+        # Give the tailer a chance to catch up before finishing the jobs
+        time.sleep(1)
+        redis_client.delete(*channels)
+        for client in clients:
+            client.join()
+        cpu_after, peak_rss = get_process_usage(process.pid)
+    finally:
+        process.kill()
+        process.wait()
+        redis_client.delete(*channels)
+
+    connected = [client for client in clients if client.is_connected]
+    latencies = [l for client in connected for l in client.latencies]
+    return {
+        'gevent': gevent,
+        'connected': len(connected),
+        'dropped': sum(client.is_dropped for client in connected),
+        'delivered': len(latencies),
+        'expected': len(connected) * args.lines,
+        'p50': percentile(latencies, 50) * 1000,
+        'p95': percentile(latencies, 95) * 1000,
+        'p99': percentile(latencies, 99) * 1000,
+        'cpu': cpu_after - cpu_before,
+        'peak_rss': peak_rss,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--clients', type=int, default=200,
+                        help='number of websocket clients')
+    parser.add_argument('--channels', type=int, default=1,
+                        help='number of job logs the clients are spread over')
+    parser.add_argument('--lines', type=int, default=500,
+                        help='number of lines published to every job log')
+    parser.add_argument('--rate', type=float, default=50,
+                        help='lines per second published to every job log')
+    parser.add_argument('--gevent', type=int, nargs='+', default=[25],
+                        help='numbers of uWSGI async cores to test')
+    parser.add_argument('--connect-timeout', type=float, default=10,
+                        help='seconds after which a client gives up '
+                             'connecting')
+    parser.add_argument('--recv-timeout', type=float, default=30,
+                        help='seconds of silence after which a client '
+                             'is considered dropped')
+    parser.add_argument('--uwsgi', default='uwsgi',
+                        help='path to the uwsgi executable')
+    args = parser.parse_args()
+
+    config = import_string(os.environ['KOZMIC_CONFIG'])
+    redis_client = redis.StrictRedis(host=config.KOZMIC_REDIS_HOST,
+                                     port=config.KOZMIC_REDIS_PORT,
+                                     db=config.KOZMIC_REDIS_DATABASE)
+
+    row = ('{gevent:>6} {connected:>5}/{clients:<5} {dropped:>7} '
+           '{delivered:>8}/{expected:<8} {p50:>9.2f} {p95:>9.2f} {p99:>9.2f} '
+           '{cpu:>7.2f} {peak_rss:>8.1f}')
+    print('{:>6} {:>11} {:>7} {:>17} {:>9} {:>9} {:>9} {:>7} {:>8}'.format(
+        'gevent', 'connected', 'dropped', 'lines', 'p50, ms', 'p95, ms',
+        'p99, ms', 'cpu, s', 'rss, MB'))
+    for gevent in args.gevent:
+        print(row.format(clients=args.clients,
+                         **run(redis_client, args, gevent)))
+
+
+if __name__ == '__main__':
+    main()
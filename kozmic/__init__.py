@@ -4,14 +4,15 @@ kozmic
 ~~~~~~
 
 .. autofunction:: create_app
+.. autofunction:: get_worker_app
 """
 import os
 import logging
 
-import docker as _docker
 import flask
 import raven.contrib
 from celery import Celery, Task
+from celery.signals import worker_init, worker_process_init
 from werkzeug.local import LocalProxy
 from flask.ext.sqlalchemy import SQLAlchemy
 from flask.ext.migrate import Migrate
@@ -38,9 +39,14 @@ celery = Celery()
 csrf = CsrfProtect()
 mail = Mail()
 moment = Moment()
-docker = LocalProxy(lambda: _docker.Client(
-    base_url=flask.current_app.config['DOCKER_URL'],
-    version=flask.current_app.config['DOCKER_API_VERSION']))
+
+
+def _get_docker_client():
+    from kozmic.docker_utils import get_docker_client
+    return get_docker_client(flask.current_app.config)
+
+
+docker = LocalProxy(_get_docker_client)
 
 
 def create_app(config=None):
@@ -124,13 +130,12 @@ def register_jinja2_globals_and_filters(app):
     app.jinja_env.globals['get_version'] = get_version
     app.jinja_env.globals['bootstrap_is_hidden_field'] = \
         lambda field: isinstance(field, wtforms.HiddenField)
-    ansi_converter = get_ansi_to_html_converter()
     app.jinja_env.filters['ansi2html'] = \
-        lambda ansi: ansi_converter.convert(ansi, full=False)
+        lambda ansi: get_ansi_to_html_converter().convert(ansi)
     app.jinja_env.filters['precise_moment'] = \
         lambda dt: moment.create(dt).format('H:mm:ss, MMM DD')
     app.jinja_env.globals['render_ansi2html_style_tag'] = \
-        ansi_converter.produce_headers
+        get_ansi_to_html_converter().produce_headers
 
 
 def init_celery_app(app, celery):
@@ -140,7 +145,7 @@ def init_celery_app(app, celery):
         abstract = True
 
         def __call__(self, *args, **kwargs):
-            with create_app().app_context():
+            with get_worker_app().app_context():
                 return super(ContextTask, self).__call__(*args, **kwargs)
 
     celery.Task = ContextTask
@@ -149,3 +154,41 @@ def init_celery_app(app, celery):
     if sentry_dsn:
         client = raven.Client(sentry_dsn)
         raven.contrib.celery.register_signal(client)
+
+
+_worker_app = None
+_worker_app_pid = None
+
+
+def get_worker_app():
+    """Returns a :class:`Flask` application to run Celery tasks in.
+    The application is created once per process, so that blueprints,
+    extensions and SQLAlchemy engine are reused between tasks.
+    """
+    global _worker_app, _worker_app_pid
+    if _worker_app is None or _worker_app_pid != os.getpid():
+        _worker_app = create_app()
+        _worker_app_pid = os.getpid()
+    return _worker_app
+
+
+@worker_process_init.connect
+def init_worker_process(**kwargs):
+    """Creates the application as soon as a worker process is started,
+    before it receives the first task.
+    """
+    get_worker_app()
+
+
+@worker_init.connect
+def init_worker(sender, **kwargs):
+    """Makes the worker consume ``KOZMIC_WORKER_QUEUE`` (if set)
+    and starts the heartbeat of :mod:`kozmic.builds.affinity`.
+    """
+    app = get_worker_app()
+    queue = app.config['KOZMIC_WORKER_QUEUE']
+    if not queue:
+        return
+    from .builds.affinity import Heartbeat
+    sender.app.amqp.queues.select_add(queue)
+    Heartbeat(app, queue, sender.concurrency).start()
@@ -6,14 +6,15 @@ kozmic.builds
 .. attribute:: bp
 
     :class:`flask.Blueprint` that implements webhooks to be triggered by
-    GitHub and serves status badges.
+    GitHub and serves status badges and metrics.
 
     .. note::
         Does not require authentication.
 """
-import ansi2html
 from flask import Blueprint
 
+from .ansi import AnsiToHtmlConverter
+
 
 bp = Blueprint('builds', __name__)
 
@@ -28,4 +29,7 @@ def register_views():
 
 
 def get_ansi_to_html_converter():
-    return ansi2html.Ansi2HTMLConverter()
+    """Returns a new :class:`kozmic.builds.ansi.AnsiToHtmlConverter`.
+    Converters are stateful, use a separate one for each log.
+    """
+    return AnsiToHtmlConverter()
@@ -0,0 +1,281 @@
+# coding: utf-8
+"""
+kozmic.builds.affinity
+~~~~~~~~~~~~~~~~~~~~~~
+
+Cache-affinity routing of jobs. Cached images built by install scripts
+(and pulled base images) only exist on the worker host that has built
+(or pulled) them, so a job that lands on another host runs the install
+script again.
+
+A worker with ``KOZMIC_WORKER_QUEUE`` set consumes that Celery queue in
+addition to the default one and keeps a registry in Redis of the images
+it holds: the images are listed every :data:`HEARTBEAT_INTERVAL` seconds
+by a thread of the main worker process and recorded by jobs as soon as
+they are pulled or built. :func:`kozmic.builds.scheduler.dispatch` sends
+a job to the queue of a live worker that holds the latest cached image
+of the job's hook (or, failing that, its base image) and has not been
+sent as many jobs as it has worker processes. Jobs of different build
+matrix entries of a hook have their own images and are routed
+separately. Otherwise the job goes to the default queue and is taken by
+any worker.
+
+A job sent to a worker queue expires if it has not been started in
+:data:`ROUTE_TIMEOUT` seconds (for instance, because the worker has died)
+and is sent to the default queue by the next :func:`dispatch
+<kozmic.builds.scheduler.dispatch>`. Heartbeats of the live workers call
+it periodically.
+
+.. autofunction:: route
+.. autofunction:: start
+.. autofunction:: pop_expired
+.. autofunction:: release
+.. autofunction:: add_image
+.. autofunction:: set_hook_image
+"""
+import time
+import logging
+import threading
+
+from flask import current_app
+
+from kozmic import docker
+from kozmic.utils import get_redis_client
+
+
+logger = logging.getLogger(__name__)
+
+
+#: Number of seconds between heartbeats of a worker
+HEARTBEAT_INTERVAL = 30
+#: Number of seconds since the last heartbeat after which
+#: a worker is considered dead
+HEARTBEAT_TIMEOUT = 3 * HEARTBEAT_INTERVAL
+#: Number of seconds after which a job sent to a worker queue
+#: expires unless it has been started
+ROUTE_TIMEOUT = 5 * 60
+
+#: Sorted set of worker queues scored by the time of their last heartbeat
+WORKERS_KEY = 'kozmic:affinity:workers'
+#: Redis hash mapping worker queues to the numbers of their processes
+CONCURRENCY_KEY = 'kozmic:affinity:concurrency'
+#: Redis hash mapping jobs (see :func:`_get_job_id`) to the worker
+#: queues they have been sent to
+ROUTES_KEY = 'kozmic:affinity:routes'
+#: Sorted set of jobs sent to worker queues that have not been started,
+#: scored by the time they have been sent
+PENDING_KEY = 'kozmic:affinity:pending'
+
+
+def _get_image_key(repo_tag):
+    """Set of worker queues that hold the image."""
+    return 'kozmic:affinity:image:{}'.format(repo_tag)
+
+
+def _get_worker_images_key(queue):
+    """Set of images held by the worker."""
+    return 'kozmic:affinity:worker-images:{}'.format(queue)
+
+
+def _get_routed_key(queue):
+    """Sorted set of jobs sent to the worker queue, scored by the time
+    they have been sent.
+    """
+    return 'kozmic:affinity:routed:{}'.format(queue)
+
+
+def _get_job_id(hook_call_id, matrix_index):
+    """Identifies the job of the hook call that runs the build matrix
+    entry. Jobs of the first entry are identified by hook call ids.
+    """
+    if matrix_index:
+        return '{}:{}'.format(hook_call_id, matrix_index)
+    return str(hook_call_id)
+
+
+def _parse_job_id(job_id):
+    """Returns a pair ``(hook call id, matrix index)``."""
+    hook_call_id, _, matrix_index = job_id.partition(':')
+    return int(hook_call_id), int(matrix_index or 0)
+
+
+def _get_hook_image_key(hook_id, matrix_index):
+    return 'kozmic:affinity:hook-image:{}'.format(
+        _get_job_id(hook_id, matrix_index))
+
+
+def _normalize(repo_tag):
+    if ':' not in repo_tag.rsplit('/', 1)[-1]:
+        repo_tag += ':latest'
+    return repo_tag
+
+
+def add_image(repo_tag):
+    """Records that the worker holds `repo_tag` image. Does nothing
+    unless ``KOZMIC_WORKER_QUEUE`` is set.
+    """
+    queue = current_app.config['KOZMIC_WORKER_QUEUE']
+    if not queue:
+        return
+    repo_tag = _normalize(repo_tag)
+    pipeline = get_redis_client().pipeline()
+    pipeline.sadd(_get_image_key(repo_tag), queue)
+    pipeline.sadd(_get_worker_images_key(queue), repo_tag)
+    pipeline.execute()
+
+
+def set_hook_image(hook, repo_tag, matrix_index=0):
+    """Records `repo_tag` as the latest cached image used by
+    the `matrix_index` build matrix entry of `hook`.
+    """
+    get_redis_client().set(_get_hook_image_key(hook.id, matrix_index),
+                           repo_tag)
+
+
+def sync_images(queue, concurrency):
+    """Replaces the images registered for the worker `queue` with
+    the images Docker has and reports that the worker is alive.
+    """
+    repo_tags = set(repo_tag for image_data in docker.images()
+                    for repo_tag in image_data['RepoTags']
+                    if repo_tag != '<none>:<none>')
+
+    redis_client = get_redis_client()
+    worker_images_key = _get_worker_images_key(queue)
+    registered = redis_client.smembers(worker_images_key)
+    pipeline = redis_client.pipeline()
+    for repo_tag in registered - repo_tags:
+        pipeline.srem(_get_image_key(repo_tag), queue)
+        pipeline.srem(worker_images_key, repo_tag)
+    for repo_tag in repo_tags - registered:
+        pipeline.sadd(_get_image_key(repo_tag), queue)
+        pipeline.sadd(worker_images_key, repo_tag)
+    pipeline.hset(CONCURRENCY_KEY, queue, concurrency)
+    pipeline.zadd(WORKERS_KEY, time.time(), queue)
+    pipeline.execute()
+
+
+def route(hook_call_id, hook_id, docker_image, job_timeout, matrix_index=0):
+    """Picks a worker queue to send the job of a hook call to and
+    records it. Returns ``None`` if no live worker with a free slot
+    holds the images of the job.
+
+    :param hook_call_id: int, :class:`HookCall` identifier
+    :param hook_id: int, identifier of the hook call's :class:`Hook`
+    :param docker_image: base Docker image of the job's build matrix entry
+    :param job_timeout: number of seconds after which a job sent to
+                        a worker stops taking its slot
+    :param matrix_index: index of the build matrix entry run by the job
+    """
+    redis_client = get_redis_client()
+    now = time.time()
+    alive = set(redis_client.zrangebyscore(
+        WORKERS_KEY, now - HEARTBEAT_TIMEOUT, '+inf'))
+    if not alive:
+        return None
+
+    repo_tags = [_normalize(docker_image)]
+    hook_image = redis_client.get(_get_hook_image_key(hook_id, matrix_index))
+    if hook_image:
+        repo_tags.insert(0, hook_image)
+
+    for repo_tag in repo_tags:
+        candidates = redis_client.smembers(_get_image_key(repo_tag)) & alive
+        if not candidates:
+            continue
+        candidates = sorted(candidates)
+        concurrency = redis_client.hmget(CONCURRENCY_KEY, candidates)
+        pipeline = redis_client.pipeline()
+        for queue in candidates:
+            routed_key = _get_routed_key(queue)
+            pipeline.zremrangebyscore(routed_key, 0, now - job_timeout)
+            pipeline.zcard(routed_key)
+        loads = pipeline.execute()[1::2]
+
+        free = [(load, queue) for queue, load, slots in
+                zip(candidates, loads, concurrency)
+                if load < int(slots or 0)]
+        if not free:
+            continue
+        _, queue = min(free)
+        job_id = _get_job_id(hook_call_id, matrix_index)
+        pipeline = redis_client.pipeline()
+        pipeline.zadd(_get_routed_key(queue), now, job_id)
+        pipeline.hset(ROUTES_KEY, job_id, queue)
+        pipeline.zadd(PENDING_KEY, now, job_id)
+        pipeline.execute()
+        logger.info('Routing job #%s of HookCall#%s to %s that holds %s.',
+                    matrix_index, hook_call_id, queue, repo_tag)
+        return queue
+    return None
+
+
+def start(hook_call_id, matrix_index=0):
+    """Records that the job of a hook call has been started, so that
+    it does not expire. Must be called by the job as soon as it starts.
+    """
+    get_redis_client().zrem(PENDING_KEY,
+                            _get_job_id(hook_call_id, matrix_index))
+
+
+def pop_expired():
+    """Frees the slots of the jobs that have been sent to worker queues
+    and have not been started in :data:`ROUTE_TIMEOUT` seconds. Returns
+    a list of pairs ``(hook call id, matrix index)`` of these jobs, which
+    have to be sent to the default queue.
+    """
+    redis_client = get_redis_client()
+    expired = []
+    for job_id in redis_client.zrangebyscore(
+            PENDING_KEY, 0, time.time() - ROUTE_TIMEOUT):
+        if not redis_client.zrem(PENDING_KEY, job_id):
+            # The job has just been started
+            continue
+        hook_call_id, matrix_index = _parse_job_id(job_id)
+        logger.warning('Job #%s of HookCall#%s has not been started by %s '
+                       'in %s seconds.', matrix_index, hook_call_id,
+                       redis_client.hget(ROUTES_KEY, job_id), ROUTE_TIMEOUT)
+        release(hook_call_id, matrix_index)
+        expired.append((hook_call_id, matrix_index))
+    return expired
+
+
+def release(hook_call_id, matrix_index=0):
+    """Frees the slot taken by the job of a hook call on the worker
+    it has been routed to, if any.
+    """
+    redis_client = get_redis_client()
+    job_id = _get_job_id(hook_call_id, matrix_index)
+    queue = redis_client.hget(ROUTES_KEY, job_id)
+    if queue is None:
+        return
+    pipeline = redis_client.pipeline()
+    pipeline.zrem(_get_routed_key(queue), job_id)
+    pipeline.hdel(ROUTES_KEY, job_id)
+    pipeline.zrem(PENDING_KEY, job_id)
+    pipeline.execute()
+
+
+class Heartbeat(threading.Thread):
+    """A thread of the main worker process that periodically calls
+    :func:`sync_images` and :func:`kozmic.builds.scheduler.dispatch`
+    (to send expired jobs to the default queue).
+    """
+    def __init__(self, app, queue, concurrency):
+        super(Heartbeat, self).__init__(name='kozmic-heartbeat')
+        self.daemon = True
+        self._app = app
+        self._queue = queue
+        self._concurrency = concurrency
+
+    def run(self):
+        from . import scheduler
+
+        while True:
+            try:
+                with self._app.app_context():
+                    sync_images(self._queue, self._concurrency)
+                    scheduler.dispatch()
+            except Exception:
+                logger.exception('Heartbeat of %s has failed.', self._queue)
+            time.sleep(HEARTBEAT_INTERVAL)
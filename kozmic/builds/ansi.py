@@ -0,0 +1,173 @@
+# coding: utf-8
+"""
+kozmic.builds.ansi
+~~~~~~~~~~~~~~~~~~
+
+.. autoclass:: AnsiToHtmlConverter
+   :members:
+"""
+import re
+
+from ansi2html.style import get_styles
+
+
+_ANSI_CODES_RE = re.compile('\033\\[([\\d;]*)([a-zA-Z])')
+
+RESET = 0
+FOREGROUND_256 = 38
+BACKGROUND_256 = 48
+NEGATIVE_ON = 7
+
+# Groups of mutually exclusive SGR codes: (first code, last code, default)
+_INTENSITY = (1, 2, 22)
+_STYLE = (3, 3, 23)
+_BLINK = (5, 6, 25)
+_UNDERLINE = (4, 4, 24)
+_CROSSED_OUT = (9, 9, 29)
+_VISIBILITY = (8, 8, 28)
+_NEGATIVE = (7, 7, 27)
+_FOREGROUND = (30, 38, 39)
+_BACKGROUND = (40, 48, 49)
+
+_ATTRIBUTES = (_INTENSITY, _STYLE, _BLINK, _UNDERLINE, _CROSSED_OUT,
+               _VISIBILITY, _NEGATIVE, _FOREGROUND, _BACKGROUND)
+_DEFAULT_STATE = tuple((default, None) for _, _, default in _ATTRIBUTES)
+
+_CODE_TO_ATTRIBUTE = dict(
+    (code, i)
+    for i, (first, last, default) in enumerate(_ATTRIBUTES)
+    for code in range(first, last + 1) + [default])
+
+
+def _escape(text):
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+def _get_css_classes(state):
+    """Returns a value of the ``class`` attribute for `state`. Produces the
+    same class names as :class:`ansi2html.Ansi2HTMLConverter` does, so that
+    :meth:`AnsiToHtmlConverter.produce_headers` styles apply.
+    """
+    (intensity, _), (style, _), (blink, _), (underline, _), \
+        (crossed_out, _), (visibility, _), (negative, _), \
+        foreground, background = state
+
+    css_classes = []
+    for value, default in ((intensity, 22), (style, 23), (blink, 25),
+                           (underline, 24), (crossed_out, 29),
+                           (visibility, 28)):
+        if value != default:
+            css_classes.append('ansi%d' % value)
+
+    is_negative = negative == NEGATIVE_ON
+    for (value, parameter), default, neg_css_class in (
+            (foreground, 39, 'inv_background'),
+            (background, 49, 'inv_foreground')):
+        if value != default:
+            css_classes.append(
+                ('inv' if is_negative else 'ansi') +
+                (str(value) if parameter is None else
+                 '%d-%d' % (value, parameter)))
+        elif is_negative:
+            css_classes.append(neg_css_class)
+    return ' '.join(css_classes)
+
+
+class AnsiToHtmlConverter(object):
+    """A streaming converter of ANSI SGR sequences to HTML.
+
+    Unlike :class:`ansi2html.Ansi2HTMLConverter`, it remembers colors and
+    attributes between :meth:`convert` calls, so a color that has been set
+    on one line and reset a few lines later is applied to all of them.
+    Every returned chunk is a well-formed HTML: spans opened in the chunk are
+    closed at its end and re-opened at the beginning of the next one.
+
+    Non-SGR sequences (such as cursor movements) are dropped.
+    """
+    def __init__(self):
+        self._state = _DEFAULT_STATE
+        self._css_classes_cache = {_DEFAULT_STATE: ''}
+
+    def reset(self):
+        """Forgets the current colors and attributes."""
+        self._state = _DEFAULT_STATE
+
+    def _apply(self, state, params):
+        try:
+            codes = [int(code) for code in params.split(';')]
+        except ValueError:
+            codes = [RESET]
+        state = list(state)
+        i = 0
+        while i < len(codes):
+            code = codes[i]
+            parameter = None
+            if code == RESET:
+                state = list(_DEFAULT_STATE)
+            elif code in (FOREGROUND_256, BACKGROUND_256):
+                # 38;5;<n> or 48;5;<n>
+                if i + 2 >= len(codes):
+                    break
+                parameter = codes[i + 2]
+                i += 2
+            attribute = _CODE_TO_ATTRIBUTE.get(code)
+            if attribute is not None:
+                state[attribute] = (code, parameter)
+            i += 1
+        return tuple(state)
+
+    def _get_css_classes(self, state):
+        try:
+            return self._css_classes_cache[state]
+        except KeyError:
+            css_classes = _get_css_classes(state)
+            self._css_classes_cache[state] = css_classes
+            return css_classes
+
+    def convert(self, ansi):
+        """Converts a chunk of text (usually a line) to HTML."""
+        parts = []
+        state = self._state
+        css_classes = self._get_css_classes(state)
+        is_span_open = False
+        last_end = 0
+        for match in _ANSI_CODES_RE.finditer(ansi):
+            start, end = match.span()
+            if start > last_end:
+                if css_classes and not is_span_open:
+                    parts.append('<span class="%s">' % css_classes)
+                    is_span_open = True
+                parts.append(_escape(ansi[last_end:start]))
+            last_end = end
+
+            params, command = match.groups()
+            if command != 'm':
+                continue
+            state = self._apply(state, params)
+            new_css_classes = self._get_css_classes(state)
+            if new_css_classes != css_classes:
+                if is_span_open:
+                    parts.append('</span>')
+                    is_span_open = False
+                css_classes = new_css_classes
+
+        if last_end < len(ansi):
+            if css_classes and not is_span_open:
+                parts.append('<span class="%s">' % css_classes)
+                is_span_open = True
+            parts.append(_escape(ansi[last_end:]))
+        if is_span_open:
+            parts.append('</span>')
+
+        self._state = state
+        return ''.join(parts)
+
+    def convert_lines(self, lines):
+        """Converts a batch of lines. Returns a list of HTML strings."""
+        return [self.convert(line) for line in lines]
+
+    def produce_headers(self):
+        """Returns a ``<style>`` tag with CSS classes used in the output."""
+        return '<style type="text/css">\n%(style)s\n</style>\n' % {
+            'style': '\n'.join(map(str, get_styles())),
+        }
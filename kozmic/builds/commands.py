@@ -1,22 +1,24 @@
 import logging
 import collections
-import datetime as dt
 
 import flask
+from docker import APIError as DockerAPIError
 
 from kozmic import docker
+from kozmic.docker_utils import get_cached_images_last_used, forget_cached_image
 
 
 logger = logging.getLogger(__name__)
 
 
-def clean_dependencies_cache(verbose=True):
-    images_by_projects = collections.defaultdict(list)
-    limit = flask.current_app.config['KOZMIC_CACHED_IMAGES_LIMIT']
+CachedImage = collections.namedtuple(
+    'CachedImage', ['last_used_at', 'id', 'repo_tag', 'project_id', 'size'])
 
-    for image_data in docker.images():
-        created_at = image_data['Created']
 
+def _get_cached_images():
+    last_used = get_cached_images_last_used()
+    images = []
+    for image_data in docker.images():
         for repo_tag in image_data['RepoTags']:
             if not repo_tag.startswith('kozmic-cache/'):
                 continue
@@ -31,12 +33,67 @@ def clean_dependencies_cache(verbose=True):
             except ValueError:
                 continue
 
-            images_by_projects[project_id].append((created_at, image_data['Id']))
+            # Images that have not been used since the last-used timestamps
+            # are recorded are considered used when they were created
+            images.append(CachedImage(
+                last_used_at=last_used.get(repo_tag, image_data['Created']),
+                id=image_data['Id'],
+                repo_tag=repo_tag,
+                project_id=project_id,
+                size=image_data.get('Size', 0)))
             break
+    return images
+
+
+def clean_dependencies_cache(verbose=True, dry_run=False):
+    """Removes least recently used cached images. Keeps at most
+    ``KOZMIC_CACHED_IMAGES_LIMIT`` images per project and, if
+    ``KOZMIC_CACHED_IMAGES_DISK_BUDGET`` is set, no more than that many
+    bytes of them in total.
+
+    If `dry_run` is true, only reports images to be removed and the number
+    of bytes that would be reclaimed.
+    """
+    config = flask.current_app.config
+    limit = config['KOZMIC_CACHED_IMAGES_LIMIT']
+    budget = config['KOZMIC_CACHED_IMAGES_DISK_BUDGET']
+
+    images_by_projects = collections.defaultdict(list)
+    for image in _get_cached_images():
+        images_by_projects[image.project_id].append(image)
+
+    images_to_keep = []
+    images_to_remove = []
+    for project_id, images in images_by_projects.iteritems():
+        images.sort()
+        images_to_remove.extend(images[:-limit])
+        images_to_keep.extend(images[-limit:])
+
+    if budget is not None:
+        images_to_keep.sort()
+        total_size = sum(image.size for image in images_to_keep)
+        while images_to_keep and total_size > int(budget):
+            image = images_to_keep.pop(0)
+            images_to_remove.append(image)
+            total_size -= image.size
+
+    reclaimed = 0
+    for image in sorted(images_to_remove):
+        if dry_run:
+            logger.info('Would remove %s (%s)', image.id, image.repo_tag)
+            reclaimed += image.size
+            continue
+        try:
+            docker.remove_image(image.id)
+        except DockerAPIError as e:
+            # The image may be a parent of a warm-installed image
+            logger.info('Failed to remove %s: %s', image.id, e)
+        else:
+            forget_cached_image(image.repo_tag)
+            logger.info('Removed %s (%s)', image.id, image.repo_tag)
+            reclaimed += image.size
 
-    for project_id, timestamped_images in images_by_projects.iteritems():
-        images_to_remove = [image for _, image in
-                            sorted(timestamped_images)[:-limit]]
-        for image in images_to_remove:
-            docker.remove_image(image)
-            logger.info('Removed %s', image)
+    if verbose:
+        print('{} {} bytes in {} images.'.format(
+            'Reclaimable:' if dry_run else 'Reclaimed:',
+            reclaimed, len(images_to_remove)))
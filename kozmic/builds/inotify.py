@@ -0,0 +1,88 @@
+# coding: utf-8
+"""
+kozmic.builds.inotify
+~~~~~~~~~~~~~~~~~~~~~
+
+A tiny ctypes binding to Linux inotify(7), just enough to be woken up
+when a file changes.
+
+.. autoclass:: Watch
+"""
+import os
+import errno
+import ctypes
+import ctypes.util
+
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+#: Events that mean "the file may have new content"
+DEFAULT_MASK = (IN_MODIFY | IN_CLOSE_WRITE | IN_ATTRIB |
+                IN_DELETE_SELF | IN_MOVE_SELF)
+
+
+_libc = None
+
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        libc_name = ctypes.util.find_library('c')
+        if not libc_name:
+            raise OSError(errno.ENOSYS, 'libc is not found')
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify is not supported')
+        _libc = libc
+    return _libc
+
+
+class Watch(object):
+    """An inotify instance watching a single file.
+
+    The instance has :meth:`fileno`, so it can be passed directly
+    to :func:`select.select`. Once it becomes readable, call :meth:`drain`
+    to consume pending events.
+
+    Raises :class:`OSError` if inotify is not available.
+
+    :param path: path to the file to watch
+    :type path: str
+    """
+    def __init__(self, path, mask=DEFAULT_MASK):
+        libc = _get_libc()
+        self._fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        wd = libc.inotify_add_watch(self._fd, path, mask)
+        if wd < 0:
+            e = ctypes.get_errno()
+            os.close(self._fd)
+            raise OSError(e, os.strerror(e), path)
+
+    def fileno(self):
+        return self._fd
+
+    def drain(self):
+        """Reads and discards all pending events."""
+        while True:
+            try:
+                if not os.read(self._fd, 4096):
+                    return
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
@@ -0,0 +1,143 @@
+# coding: utf-8
+"""
+kozmic.builds.mirrors
+~~~~~~~~~~~~~~~~~~~~~
+
+Host-side bare mirrors of project repositories. A mirror is mounted
+read-only into build containers, so that the source code is cloned
+from it locally instead of being downloaded from GitHub by every job.
+
+.. autofunction:: update_git_mirror
+"""
+import os
+import fcntl
+import pipes
+import shutil
+import logging
+import tempfile
+import contextlib
+import subprocess
+
+from Crypto.PublicKey import RSA
+
+
+logger = logging.getLogger(__name__)
+
+
+GIT_SSH_SH = '''
+#!/bin/sh
+exec ssh -i {id_rsa} -o IdentitiesOnly=yes -o BatchMode=yes \
+  -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null "$@"
+'''.strip()
+
+
+@contextlib.contextmanager
+def _locked(lock_path):
+    with open(lock_path, 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+@contextlib.contextmanager
+def _git_env(deploy_key):
+    """Yields environment for git commands. If `deploy_key` is given,
+    the environment makes git use it for SSH connections.
+    """
+    env = dict(os.environ, GIT_TERMINAL_PROMPT='0')
+    if not deploy_key:
+        yield env
+        return
+
+    rsa_private_key, passphrase = deploy_key
+    temp_dir = tempfile.mkdtemp()
+    try:
+        id_rsa_path = os.path.join(temp_dir, 'id_rsa')
+        fd = os.open(id_rsa_path, os.O_WRONLY | os.O_CREAT, 0o600)
+        with os.fdopen(fd, 'w') as id_rsa:
+            id_rsa.write(RSA.importKey(
+                rsa_private_key, passphrase=passphrase).exportKey('PEM'))
+
+        git_ssh_path = os.path.join(temp_dir, 'git-ssh.sh')
+        with open(git_ssh_path, 'w') as git_ssh:
+            git_ssh.write(GIT_SSH_SH.format(id_rsa=pipes.quote(id_rsa_path)))
+        os.chmod(git_ssh_path, 0o700)
+
+        env['GIT_SSH'] = git_ssh_path
+        yield env
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+def _git(args, env, git_dir=None):
+    command = ['git'] + (['--git-dir', git_dir] if git_dir else []) + args
+    process = subprocess.Popen(command, env=env, stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT)
+    output, _ = process.communicate()
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(
+            process.returncode, ' '.join(command), output)
+    return output
+
+
+def _has_commit(mirror_path, commit_sha, env):
+    try:
+        _git(['cat-file', '-e', commit_sha + '^{commit}'], env,
+             git_dir=mirror_path)
+    except subprocess.CalledProcessError:
+        return False
+    else:
+        return True
+
+
+def update_git_mirror(mirrors_dir, name, clone_url, commit_sha,
+                      deploy_key=None):
+    """Makes sure that a bare mirror of `clone_url` repository
+    in `mirrors_dir` contains `commit_sha`. Creates the mirror if it
+    does not exist yet and fetches it otherwise. Concurrent updates of
+    the same mirror (by other threads or worker processes) are
+    serialized by a file lock.
+
+    Returns the mirror path or ``None`` if the mirror could not be
+    updated -- in that case the repository should be cloned from GitHub.
+
+    :param name: mirror name unique for the repository (i.e., project id)
+    :param deploy_key: a pair of strings (private key, passphrase) to be
+                       used for fetching a private repository
+    """
+    mirror_path = os.path.join(mirrors_dir, '{}.git'.format(name))
+    try:
+        if not os.path.isdir(mirrors_dir):
+            os.makedirs(mirrors_dir)
+        with _locked(mirror_path + '.lock'), _git_env(deploy_key) as env:
+            if not os.path.isdir(mirror_path):
+                logger.info('Creating git mirror %s of %s.',
+                            mirror_path, clone_url)
+                temp_path = tempfile.mkdtemp(dir=mirrors_dir)
+                try:
+                    # Build scripts run by an unprivileged user
+                    # read objects from the mirror
+                    os.chmod(temp_path, 0o755)
+                    _git(['clone', '-q', '--mirror', clone_url, temp_path], env)
+                    os.rename(temp_path, mirror_path)
+                except:
+                    shutil.rmtree(temp_path)
+                    raise
+            elif not _has_commit(mirror_path, commit_sha, env):
+                logger.info('Fetching git mirror %s.', mirror_path)
+                _git(['remote', 'set-url', 'origin', clone_url], env,
+                     git_dir=mirror_path)
+                _git(['fetch', '-q', '--prune', 'origin'], env,
+                     git_dir=mirror_path)
+
+            if not _has_commit(mirror_path, commit_sha, env):
+                logger.warning('Git mirror %s does not contain %s.',
+                               mirror_path, commit_sha)
+                return None
+    except (OSError, IOError, subprocess.CalledProcessError, ValueError) as e:
+        logger.warning('Failed to update git mirror %s: %r %s', mirror_path,
+                       e, getattr(e, 'output', ''))
+        return None
+    return mirror_path
@@ -0,0 +1,324 @@
+# coding: utf-8
+"""
+kozmic.builds.pool
+~~~~~~~~~~~~~~~~~~
+
+A per-process pool of warm containers. Creating and starting a container
+takes a while, which adds up for short jobs. The pool keeps containers
+of the most used images created and started in advance: a pooled
+container blocks on a FIFO in its working directory until the directory
+is populated and then runs the starter script, just like a container
+started by :class:`kozmic.builds.tasks.Builder`.
+
+Containers are pooled by image id rather than by image name, so that
+a tag moved by ``docker pull`` is never served by a container of
+the image it used to point to. Idle containers of that image are removed.
+
+The pool holds at most ``KOZMIC_CONTAINER_POOL_SIZE`` idle containers.
+Every claim of an image is followed by the creation of a fresh container
+of that image in background; once the pool is full, idle containers of
+less used images make room for more used ones. Containers that have been
+idle for ``KOZMIC_CONTAINER_POOL_IDLE_TIMEOUT`` seconds are removed.
+
+.. autofunction:: get_container_pool
+.. autoclass:: ContainerPool
+   :members: claim, get_stats
+.. autoclass:: PooledContainer
+"""
+import os
+import time
+import Queue
+import shutil
+import logging
+import tempfile
+import threading
+import collections
+
+from flask import current_app
+
+from kozmic import docker
+
+
+logger = logging.getLogger(__name__)
+
+
+POOL_STARTER_SH = '''
+# Wait until Builder populates the working directory and writes a line
+# to the FIFO. It is opened for both reading and writing, so that
+# opening it does not block until there is a writer
+exec 4<> /kozmic/go
+if read -t {timeout} <&4; then
+  exec 4<&-
+  exec bash /kozmic/script-starter.sh
+fi
+# Nobody has claimed the container
+exit 1
+'''.strip()
+
+
+def get_mounts(working_dir, mirror_path=None):
+    """Returns a pair of `volumes` and `binds` to pass to
+    :meth:`docker.Client.create_container` and :meth:`docker.Client.start`
+    respectively: `working_dir` is mounted in container's `/kozmic` path
+    and `mirror_path` (if given) is mounted read-only
+    in `/kozmic-mirror` path.
+    """
+    volumes = {'/kozmic': {}}
+    binds = {working_dir: '/kozmic'}
+    if mirror_path:
+        volumes['/kozmic-mirror'] = {}
+        binds[mirror_path] = '/kozmic-mirror:ro'
+    return volumes, binds
+
+
+class PooledContainer(object):
+    """A started container waiting for its working directory to be
+    populated. Used as a context manager, returns the working directory
+    and removes it on exit.
+
+    .. attribute:: key
+
+        Pair of the id of the container's image and the mirror path.
+
+    .. attribute:: container
+
+        Dictionary returned by :meth:`docker.Client.create_container`.
+
+    .. attribute:: working_dir
+
+        Path of the directory mounted in container's `/kozmic` path.
+    """
+    def __init__(self, key, container, working_dir):
+        self.key = key
+        self.container = container
+        self.working_dir = working_dir
+        self.created_at = time.time()
+
+    def __enter__(self):
+        return self.working_dir
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        shutil.rmtree(self.working_dir)
+
+
+class ContainerPool(object):
+    """A pool of warm containers.
+
+    :param docker: Docker client
+    :type docker: :class:`docker.Client`
+
+    :param size: maximum number of idle containers
+    :type size: int
+
+    :param idle_timeout: number of seconds after which
+                         an idle container is removed
+    :type idle_timeout: int
+    """
+    def __init__(self, docker, size, idle_timeout):
+        self._docker = docker
+        self._size = size
+        self._idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        # Idle containers by (image id, mirror path), the oldest first
+        self._idle = collections.defaultdict(collections.deque)
+        # Number of claims by (image id, mirror path)
+        self._demand = collections.Counter()
+        # Ids of the claimed images by their names
+        self._image_ids = {}
+        self._hits = 0
+        self._misses = 0
+        self._refills = Queue.Queue()
+        self._filler = threading.Thread(target=self._fill,
+                                        name='kozmic-container-pool')
+        self._filler.daemon = True
+        self._filler.start()
+
+    def claim(self, docker_image, mirror_path=None):
+        """Returns a :class:`PooledContainer` of the image `docker_image`
+        currently refers to with `mirror_path` mounted or ``None`` if
+        the pool has none.
+        """
+        try:
+            image_id = self._docker.inspect_image(docker_image)['Id']
+        except Exception:
+            logger.exception('Failed to inspect %s.', docker_image)
+            return None
+        key = (image_id, mirror_path)
+        self._evict_moved(docker_image, image_id)
+        self._evict_expired()
+        with self._lock:
+            self._demand[key] += 1
+            idle = self._idle[key]
+            # The most recently created container is the least likely
+            # to have given up waiting
+            pooled = idle.pop() if idle else None
+        self._refills.put(key)
+
+        if pooled is not None and not self._is_running(pooled):
+            self._remove(pooled)
+            pooled = None
+        with self._lock:
+            if pooled is None:
+                self._misses += 1
+            else:
+                self._hits += 1
+        if pooled is not None:
+            logger.info('%s of %s has been claimed from the pool.',
+                        pooled.container, docker_image)
+        return pooled
+
+    def get_stats(self):
+        """Returns a dictionary with the number of ``idle`` containers
+        and the numbers of claims that were pool ``hits`` and ``misses``.
+        """
+        with self._lock:
+            return {
+                'idle': sum(len(idle) for idle in self._idle.values()),
+                'hits': self._hits,
+                'misses': self._misses,
+            }
+
+    def _is_running(self, pooled):
+        try:
+            state = self._docker.inspect_container(pooled.container)['State']
+        except Exception:
+            logger.exception('Failed to inspect %s.', pooled.container)
+            return False
+        return state['Running']
+
+    def _create(self, key):
+        docker_image, mirror_path = key
+        working_dir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(working_dir, 'pool-starter.sh'), 'w') as f:
+                # Give up waiting a minute after the container
+                # would have been evicted
+                f.write(POOL_STARTER_SH.format(
+                    timeout=int(self._idle_timeout) + 60))
+            go_path = os.path.join(working_dir, 'go')
+            os.mkfifo(go_path)
+            # The script may run as any user of the image
+            os.chmod(go_path, 0o666)
+            volumes, binds = get_mounts(working_dir, mirror_path)
+            container = self._docker.create_container(
+                docker_image,
+                command='bash /kozmic/pool-starter.sh',
+                volumes=volumes)
+            self._docker.start(container, binds=binds)
+        except:
+            shutil.rmtree(working_dir)
+            raise
+        logger.info('%s of %s has been added to the pool.',
+                    container, docker_image)
+        return PooledContainer(key, container, working_dir)
+
+    def _remove(self, pooled):
+        logger.info('Removing %s from the pool.', pooled.container)
+        try:
+            self._docker.kill(pooled.container)
+        except Exception:
+            # The container may have already exited
+            logger.info('Failed to kill %s.', pooled.container)
+        try:
+            self._docker.remove_container(pooled.container)
+        except Exception:
+            logger.exception('Failed to remove %s.', pooled.container)
+        shutil.rmtree(pooled.working_dir, ignore_errors=True)
+
+    def _evict_moved(self, docker_image, image_id):
+        """Removes idle containers of the image `docker_image` referred
+        to before it has been moved to `image_id`.
+        """
+        with self._lock:
+            old_image_id = self._image_ids.get(docker_image)
+            self._image_ids[docker_image] = image_id
+            if old_image_id in (None, image_id):
+                return
+            moved = []
+            for key in self._idle.keys():
+                if key[0] == old_image_id:
+                    moved.extend(self._idle.pop(key))
+                    del self._demand[key]
+        for pooled in moved:
+            self._remove(pooled)
+
+    def _evict_expired(self):
+        expired = []
+        created_before = time.time() - self._idle_timeout
+        with self._lock:
+            for idle in self._idle.values():
+                while idle and idle[0].created_at < created_before:
+                    expired.append(idle.popleft())
+        for pooled in expired:
+            self._remove(pooled)
+
+    def _make_room(self, key):
+        """Evicts an idle container of the least used image if the pool
+        is full. Returns whether there is room for a container of `key`.
+        """
+        with self._lock:
+            if sum(len(idle) for idle in self._idle.values()) < self._size:
+                return True
+            candidates = [other_key for other_key, idle in self._idle.items()
+                          if idle and other_key != key]
+            if not candidates:
+                return False
+            coldest_key = min(candidates, key=self._demand.get)
+            if self._demand[coldest_key] >= self._demand[key]:
+                return False
+            evicted = self._idle[coldest_key].popleft()
+        self._remove(evicted)
+        return True
+
+    def _fill(self):
+        while True:
+            try:
+                key = self._refills.get(timeout=self._idle_timeout / 2.)
+            except Queue.Empty:
+                self._evict_expired()
+                continue
+            self._evict_expired()
+            with self._lock:
+                if key[0] not in self._image_ids.values():
+                    # The image has been moved since the claim
+                    continue
+            if not self._make_room(key):
+                continue
+            try:
+                pooled = self._create(key)
+            except Exception:
+                logger.exception('Failed to create a container of %s '
+                                 'for the pool.', key[0])
+                continue
+            with self._lock:
+                self._idle[key].append(pooled)
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def get_container_pool():
+    """Returns the :class:`ContainerPool` of the current process or
+    ``None`` if ``KOZMIC_CONTAINER_POOL_SIZE`` is not set. Must be called
+    within the application context.
+    """
+    global _pool, _pool_pid
+    config = current_app.config
+    if not config['KOZMIC_CONTAINER_POOL_SIZE']:
+        return None
+    pid = os.getpid()
+    if _pool_pid != pid:
+        with _pool_lock:
+            if _pool_pid != pid:
+                # Threads do not survive fork, so a pool inherited
+                # from the parent process is not being filled
+                _pool = ContainerPool(
+                    # `docker` is a local proxy, unusable outside
+                    # of the app context
+                    docker=docker._get_current_object(),
+                    size=config['KOZMIC_CONTAINER_POOL_SIZE'],
+                    idle_timeout=config['KOZMIC_CONTAINER_POOL_IDLE_TIMEOUT'])
+                _pool_pid = pid
+    return _pool
@@ -0,0 +1,314 @@
+# coding: utf-8
+"""
+kozmic.builds.scheduler
+~~~~~~~~~~~~~~~~~~~~~~~
+
+Fair-share scheduling of jobs. Hook calls are not sent to Celery as soon
+as they are created: their jobs (one per build matrix entry, see
+:meth:`kozmic.models.Hook.get_matrix`) are put into per-project queues
+in Redis and dispatched by :func:`dispatch`, which
+
+* runs at most ``KOZMIC_PROJECT_CONCURRENCY`` jobs of a project at once;
+* if ``KOZMIC_SCHEDULER_CAPACITY`` is set, runs at most that many jobs
+  in total;
+* serves projects in round-robin order, so that a project that pushed
+  many commits does not starve the others;
+* within a project, prefers builds of the default branch and restarts
+  (:data:`HIGH_PRIORITY`) to other builds, and older builds to newer ones;
+* sends jobs to the workers that hold their images when possible
+  (see :mod:`kozmic.builds.affinity`).
+
+:func:`dispatch` is called whenever a hook call is enqueued and whenever
+a job finishes.
+
+.. autofunction:: enqueue
+.. autofunction:: dispatch
+.. autofunction:: cancel
+.. autofunction:: job_finished
+.. autofunction:: get_queue_position
+.. autofunction:: get_stats
+"""
+import time
+import logging
+
+from flask import current_app
+
+from kozmic.utils import get_redis_client
+from . import affinity
+
+
+logger = logging.getLogger(__name__)
+
+
+#: Priority of default branch builds and restarted jobs
+HIGH_PRIORITY = 0
+#: Priority of all the other builds
+NORMAL_PRIORITY = 1
+
+# Queue scores are ``priority * _PRIORITY_WEIGHT + sequence number``
+_PRIORITY_WEIGHT = 2 ** 40
+
+#: Counter used for ordering queued hook calls and served projects
+SEQUENCE_KEY = 'kozmic:scheduler:sequence'
+#: Sorted set of projects that have queued hook calls, scored by
+#: the sequence number of the last time they have been served
+PROJECTS_KEY = 'kozmic:scheduler:projects'
+#: Sorted set of running jobs (``<project id>:<job member>``, see
+#: :func:`_get_member`), scored by the time they have been dispatched
+RUNNING_KEY = 'kozmic:scheduler:running'
+LOCK_KEY = 'kozmic:scheduler:lock'
+
+
+def _get_queue_key(project_id):
+    """Sorted set of queued jobs of the project."""
+    return 'kozmic:scheduler:queue:{}'.format(project_id)
+
+
+def _get_project_running_key(project_id):
+    """Sorted set of the project's running jobs."""
+    return 'kozmic:scheduler:running:{}'.format(project_id)
+
+
+def _get_member(hook_call_id, matrix_index=0):
+    """Returns the member of the queues representing the job of
+    the hook call that runs the build matrix entry: a hook call id
+    for the first entry and ``<hook call id>:<matrix index>`` for
+    the other ones.
+    """
+    if matrix_index:
+        return '{}:{}'.format(hook_call_id, matrix_index)
+    return str(hook_call_id)
+
+
+def _parse_member(member):
+    """Returns a pair ``(hook call id, matrix index)``."""
+    hook_call_id, _, matrix_index = member.partition(':')
+    return int(hook_call_id), int(matrix_index or 0)
+
+
+def _get_members(hook_call, matrix_indexes=None):
+    if matrix_indexes is None:
+        matrix_indexes = (range(len(hook_call.hook.get_matrix()))
+                          if hook_call.hook else [0])
+    return [_get_member(hook_call.id, matrix_index)
+            for matrix_index in matrix_indexes]
+
+
+def enqueue(hook_call, priority=NORMAL_PRIORITY, matrix_indexes=None):
+    """Puts the jobs of `hook_call` into the queue of its project and
+    dispatches jobs that can be started.
+
+    :param hook_call: :class:`HookCall`
+    :param priority: :data:`HIGH_PRIORITY` or :data:`NORMAL_PRIORITY`
+    :param matrix_indexes: indexes of the build matrix entries to be run,
+                           all the entries of the hook by default
+    """
+    members = _get_members(hook_call, matrix_indexes)
+    redis_client = get_redis_client()
+    project_id = hook_call.build.project_id
+    with redis_client.lock(LOCK_KEY, timeout=60):
+        sequence = redis_client.incrby(SEQUENCE_KEY, len(members))
+        pipeline = redis_client.pipeline()
+        for i, member in enumerate(members):
+            pipeline.zadd(
+                _get_queue_key(project_id),
+                priority * _PRIORITY_WEIGHT + sequence - len(members) + i + 1,
+                member)
+        if redis_client.zscore(PROJECTS_KEY, project_id) is None:
+            # The project joins the end of the round
+            pipeline.zadd(PROJECTS_KEY, sequence, project_id)
+        pipeline.execute()
+    dispatch()
+
+
+def _expire_running_jobs(redis_client, timeout):
+    # Workers that died while running a job never report it finished
+    expired = redis_client.zrangebyscore(RUNNING_KEY, 0, time.time() - timeout)
+    for running_member in expired:
+        project_id, member = running_member.split(':', 1)
+        hook_call_id, matrix_index = _parse_member(member)
+        logger.warning('Job #%s of HookCall#%s has not finished '
+                       'in %s seconds.', matrix_index, hook_call_id, timeout)
+        pipeline = redis_client.pipeline()
+        pipeline.zrem(RUNNING_KEY, running_member)
+        pipeline.zrem(_get_project_running_key(project_id), member)
+        pipeline.execute()
+        affinity.release(hook_call_id, matrix_index)
+
+
+def _pick(redis_client, concurrency):
+    """Moves the next job to be run from its project queue to
+    the running jobs. Returns a pair ``(hook call id, matrix index)``
+    or ``None`` if all the projects with queued jobs have run out of
+    their concurrency.
+    """
+    for project_id in redis_client.zrange(PROJECTS_KEY, 0, -1):
+        queue_key = _get_queue_key(project_id)
+        running_key = _get_project_running_key(project_id)
+        if redis_client.zcard(running_key) >= concurrency:
+            continue
+
+        members = redis_client.zrange(queue_key, 0, 0)
+        if not members:
+            redis_client.zrem(PROJECTS_KEY, project_id)
+            continue
+        member = members[0]
+
+        now = time.time()
+        sequence = redis_client.incr(SEQUENCE_KEY)
+        pipeline = redis_client.pipeline()
+        pipeline.zrem(queue_key, member)
+        pipeline.zadd(running_key, now, member)
+        pipeline.zadd(RUNNING_KEY, now, '{}:{}'.format(project_id, member))
+        # The project goes to the end of the round
+        pipeline.zadd(PROJECTS_KEY, sequence, project_id)
+        pipeline.zcard(queue_key)
+        if not pipeline.execute()[-1]:
+            redis_client.zrem(PROJECTS_KEY, project_id)
+        return _parse_member(member)
+    return None
+
+
+def _route(jobs, job_timeout):
+    """Returns a dictionary mapping jobs (pairs ``(hook call id, matrix
+    index)``) to the worker queues they have to be sent to. Jobs that
+    go to the default queue are omitted (see :func:`affinity.route`).
+    """
+    from kozmic.models import HookCall
+
+    if not jobs:
+        return {}
+    # Only ids and image names are handled under the lock, the hook
+    # calls are loaded from the database while it is not held
+    images = {}
+    hook_calls = HookCall.query.filter(
+        HookCall.id.in_(set(hook_call_id for hook_call_id, _ in jobs)))
+    for hook_call in hook_calls:
+        matrix = hook_call.hook.get_matrix() if hook_call.hook else []
+        for matrix_index, entry in enumerate(matrix):
+            images[hook_call.id, matrix_index] = (hook_call.hook_id,
+                                                  entry['docker_image'])
+
+    queues = {}
+    with get_redis_client().lock(LOCK_KEY, timeout=60):
+        for hook_call_id, matrix_index in jobs:
+            if (hook_call_id, matrix_index) not in images:
+                # The hook has been deleted or its matrix has been
+                # changed, the job will be skipped
+                continue
+            hook_id, docker_image = images[hook_call_id, matrix_index]
+            queue = affinity.route(hook_call_id, hook_id, docker_image,
+                                   job_timeout=job_timeout,
+                                   matrix_index=matrix_index)
+            if queue is not None:
+                queues[hook_call_id, matrix_index] = queue
+    return queues
+
+
+def dispatch():
+    """Sends to Celery as many queued jobs as the concurrency limits
+    allow. Returns a list of the hook call ids of dispatched jobs.
+    """
+    from . import tasks
+
+    config = current_app.config
+    concurrency = config['KOZMIC_PROJECT_CONCURRENCY']
+    capacity = config['KOZMIC_SCHEDULER_CAPACITY']
+    redis_client = get_redis_client()
+
+    jobs = []
+    with redis_client.lock(LOCK_KEY, timeout=60):
+        _expire_running_jobs(redis_client,
+                             config['KOZMIC_SCHEDULER_JOB_TIMEOUT'])
+        # Jobs that have expired in worker queues keep their running
+        # slots and are sent again to the default queue
+        expired = affinity.pop_expired()
+        running = redis_client.zcard(RUNNING_KEY)
+        while capacity is None or running < capacity:
+            job = _pick(redis_client, concurrency)
+            if job is None:
+                break
+            jobs.append(job)
+            running += 1
+
+    queues = _route(jobs, config['KOZMIC_SCHEDULER_JOB_TIMEOUT'])
+
+    # Tasks are sent after the lock is released: with CELERY_ALWAYS_EAGER
+    # they run right away and dispatch jobs themselves when they finish
+    for hook_call_id, matrix_index in jobs + expired:
+        kwargs = {'hook_call_id': hook_call_id}
+        if matrix_index:
+            kwargs['matrix_index'] = matrix_index
+        queue = queues.get((hook_call_id, matrix_index))
+        if queue is None:
+            logger.info('Dispatching job #%s of HookCall#%s.',
+                        matrix_index, hook_call_id)
+            tasks.do_job.delay(**kwargs)
+        else:
+            logger.info('Dispatching job #%s of HookCall#%s to %s.',
+                        matrix_index, hook_call_id, queue)
+            # The job is sent again to the default queue once it expires
+            # (see `affinity.pop_expired`), it must not run on the worker
+            # after that
+            tasks.do_job.apply_async(kwargs=kwargs, queue=queue,
+                                     expires=affinity.ROUTE_TIMEOUT)
+    return [hook_call_id for hook_call_id, _ in jobs + expired]
+
+
+def cancel(hook_call):
+    """Removes the jobs of `hook_call` from the queue of its project.
+    Returns whether any of them has been queued.
+
+    :param hook_call: :class:`HookCall`
+    """
+    return bool(get_redis_client().zrem(
+        _get_queue_key(hook_call.build.project_id),
+        *_get_members(hook_call)))
+
+
+def job_finished(hook_call, matrix_index=0):
+    """Frees the slot taken by the job of `hook_call` and dispatches
+    jobs that can be started.
+
+    :param hook_call: :class:`HookCall`
+    :param matrix_index: index of the build matrix entry run by the job
+    """
+    redis_client = get_redis_client()
+    project_id = hook_call.build.project_id
+    member = _get_member(hook_call.id, matrix_index)
+    pipeline = redis_client.pipeline()
+    pipeline.zrem(RUNNING_KEY, '{}:{}'.format(project_id, member))
+    pipeline.zrem(_get_project_running_key(project_id), member)
+    pipeline.execute()
+    affinity.release(hook_call.id, matrix_index)
+    dispatch()
+
+
+def get_queue_position(build):
+    """Returns the position (starting from 1) of the first queued job
+    of `build` in its project queue or ``None`` if none of the build's
+    jobs is queued.
+    """
+    queue_key = _get_queue_key(build.project_id)
+    pipeline = get_redis_client().pipeline()
+    for hook_call in build.hook_calls:
+        for member in _get_members(hook_call):
+            pipeline.zrank(queue_key, member)
+    ranks = [rank for rank in pipeline.execute() if rank is not None]
+    return min(ranks) + 1 if ranks else None
+
+
+def get_stats():
+    """Returns a dictionary with the numbers of ``enqueued``
+    and ``running`` jobs.
+    """
+    redis_client = get_redis_client()
+    pipeline = redis_client.pipeline()
+    for project_id in redis_client.zrange(PROJECTS_KEY, 0, -1):
+        pipeline.zcard(_get_queue_key(project_id))
+    pipeline.zcard(RUNNING_KEY)
+    counts = pipeline.execute()
+    return {
+        'enqueued': sum(counts[:-1]),
+        'running': counts[-1],
+    }
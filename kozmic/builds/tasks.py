@@ -8,26 +8,33 @@ kozmic.builds.tasks
 """
 import os
 import sys
+import time
 import tempfile
 import shutil
 import contextlib
 import threading
 import pipes
-import subprocess
-import fcntl
 import select
 import Queue
 import socket
+import struct
+import zlib
+import json
+import hashlib
 
-import redis
 from flask import current_app
 from celery.utils.log import get_task_logger
 from docker import APIError as DockerAPIError
 
-from kozmic import db, celery, docker
-from kozmic.models import Job, HookCall
-from kozmic.docker_utils import does_docker_image_exist
-from . import get_ansi_to_html_converter
+from kozmic import db, celery, docker, metrics
+from kozmic.models import Job, JobLogChunk, HookCall, TrackedFile
+from kozmic.docker_utils import does_docker_image_exist, touch_cached_image
+from kozmic.utils import get_redis_client
+from . import get_ansi_to_html_converter, inotify
+from .mirrors import update_git_mirror
+from .watchdog import get_watchdog
+from .pool import get_container_pool, get_mounts
+from . import scheduler, affinity
 
 
 logger = get_task_logger(__name__)
@@ -40,6 +47,78 @@ def create_temp_dir():
     shutil.rmtree(build_dir)
 
 
+class PhaseTimer(object):
+    """Records wall-clock durations of job phases.
+
+    .. attribute:: timings
+
+        List of ``(phase, seconds)`` pairs in the order
+        the phases were run.
+    """
+    def __init__(self):
+        self.timings = []
+
+    def add(self, phase, seconds):
+        self.timings.append((phase, seconds))
+
+    @contextlib.contextmanager
+    def phase(self, phase):
+        """A context manager that records the duration of its block."""
+        started_at = time.time()
+        try:
+            yield
+        finally:
+            self.add(phase, time.time() - started_at)
+
+
+class JobLogWriter(object):
+    """Appends a job log to the database as :class:`JobLogChunk` s.
+    Written data is buffered until it makes up a chunk of `chunk_size`
+    bytes, which is then compressed and inserted. :meth:`flush`
+    inserts the rest of the buffer as a (possibly smaller) chunk.
+
+    The writer uses `engine` directly and does not need an application
+    context, so it can be used from any thread.
+
+    :param engine: SQLAlchemy engine
+    :param job_id: :class:`Job` identifier
+    :param chunk_size: chunk size in bytes
+    """
+    def __init__(self, engine, job_id, chunk_size=64 * 1024):
+        self._engine = engine
+        self._job_id = job_id
+        self._chunk_size = chunk_size
+        self._lock = threading.Lock()
+        self._buffer = ''
+        self._number = 0
+        self._offset = 0
+
+    def write(self, data):
+        with self._lock:
+            self._buffer += data
+            while len(self._buffer) >= self._chunk_size:
+                chunk = self._buffer[:self._chunk_size]
+                self._buffer = self._buffer[self._chunk_size:]
+                self._insert(chunk)
+
+    def flush(self):
+        with self._lock:
+            if self._buffer:
+                chunk = self._buffer
+                self._buffer = ''
+                self._insert(chunk)
+
+    def _insert(self, chunk):
+        self._engine.execute(JobLogChunk.__table__.insert().values(
+            job_id=self._job_id,
+            number=self._number,
+            offset=self._offset,
+            size=len(chunk),
+            data=zlib.compress(chunk)))
+        self._number += 1
+        self._offset += len(chunk)
+
+
 class Publisher(object):
     """
     :param redis_client: Redis client
@@ -47,24 +126,100 @@ class Publisher(object):
 
     :param channel: pub/sub channel name
     :type channel: str
+
+    :param flush_interval: number of seconds to buffer lines for before
+                           sending them to Redis. If ``0``, every line is
+                           sent as soon as it is published
+    :type flush_interval: float
+
+    :param batch_size: number of bytes after which buffered lines are
+                       sent without waiting for ``flush_interval`` to expire.
+                       ``0`` means no limit
+    :type batch_size: int
+
+    :param log_writer: if given, published lines are also
+                       written to it as they are (before ANSI conversion)
+    :type log_writer: :class:`JobLogWriter`
+
+    Buffered lines are sent in a single pipeline: one ``RPUSH`` with all
+    the lines and one ``PUBLISH`` with their concatenation. Without
+    buffering, the lines of every :meth:`publish` call are sent in
+    a single pipeline too.
     """
-    def __init__(self, redis_client, channel):
+    def __init__(self, redis_client, channel, flush_interval=0, batch_size=0,
+                 log_writer=None):
         self._redis_client = redis_client
+        self._log_writer = log_writer
         self._channel = channel
+        self._flush_interval = flush_interval
+        self._batch_size = batch_size
         self._ansi_converter = get_ansi_to_html_converter()
+        self._lock = threading.Lock()
+        self._buffer = []
+        self._buffer_size = 0
+        self._flush_timer = None
 
     def publish(self, lines):
         if isinstance(lines, basestring):
             lines = [lines]
-        for line in lines:
-            try:
-                line = self._ansi_converter.convert(line, full=False) + '\n'
-            except:
-                pass
-            self._redis_client.publish(self._channel, line)
-            self._redis_client.rpush(self._channel, line)
+        if self._log_writer:
+            self._log_writer.write(''.join(line + '\n' for line in lines))
+        try:
+            converted_lines = [
+                line + '\n' for line in self._ansi_converter.convert_lines(lines)]
+        except:
+            converted_lines = [line + '\n' for line in lines]
+
+        if not self._flush_interval:
+            pipeline = self._redis_client.pipeline(transaction=False)
+            for line in converted_lines:
+                pipeline.publish(self._channel, line)
+                pipeline.rpush(self._channel, line)
+            self._count_published(pipeline, converted_lines,
+                                  messages=len(converted_lines))
+            pipeline.execute()
+            return
+
+        with self._lock:
+            self._buffer.extend(converted_lines)
+            self._buffer_size += sum(len(line) for line in converted_lines)
+            flush_now = (self._batch_size and
+                         self._buffer_size >= self._batch_size)
+            if not flush_now and self._flush_timer is None:
+                self._flush_timer = threading.Timer(self._flush_interval,
+                                                    self.flush)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+        if flush_now:
+            self.flush()
+
+    def flush(self):
+        """Sends buffered lines to Redis."""
+        # The lock is held during the round trip to make sure that
+        # concurrent flushes do not reorder lines
+        with self._lock:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+            lines = self._buffer
+            self._buffer = []
+            self._buffer_size = 0
+            if not lines:
+                return
+            pipeline = self._redis_client.pipeline(transaction=False)
+            pipeline.rpush(self._channel, *lines)
+            pipeline.publish(self._channel, ''.join(lines))
+            self._count_published(pipeline, lines, messages=1)
+            pipeline.execute()
+
+    def _count_published(self, pipeline, lines, messages):
+        metrics.incr('log_published_messages', messages, pipeline)
+        metrics.incr('log_published_lines', len(lines), pipeline)
+        metrics.incr('log_published_bytes', sum(len(line) for line in lines),
+                     pipeline)
 
     def finish(self):
+        self.flush()
         # Remove `channel` key to let `tailer` module
         # stop listening pubsub channel
         self._redis_client.delete(self._channel)
@@ -79,13 +234,14 @@ class Tailer(threading.Thread):
     2. Sends the line to a Redis pub/sub channel;
     3. Pushes it to Redis list of the same name.
 
-    If the log file does not change for ``kill_timeout`` seconds,
-    specified Docker container will be killed and corresponding message
-    will be appended to the log file.
+    The log file is read in-process from the last known offset. The thread
+    sleeps until inotify reports a change of the file; if inotify is not
+    available, the file is polled every ``poll_interval`` seconds.
 
-    Once the thread has finished, :attr:`has_killed_container` tells
-    whether the :param:`container` has stopped by itself or been killed
-    by a timeout.
+    If ``watch`` is given, its :meth:`~kozmic.builds.watchdog.ContainerWatch.touch`
+    is called whenever something is appended to the log file, so that
+    the watchdog does not kill the container of a job that is making
+    progress.
 
     :param log_path: path to the log file to watch
     :type log_path: str
@@ -93,80 +249,211 @@ class Tailer(threading.Thread):
     :param publisher: publisher
     :type publisher: :class:`Publisher`
 
-    :param container: container to kill
-    :type container: dictionary returned by :meth:`docker.Client.create_container`
+    :param watch: the container watch
+    :type watch: :class:`kozmic.builds.watchdog.ContainerWatch`
 
-    :param kill_timeout: number of seconds since the last log append after
-                         which kill the container
-    :type kill_timeout: int
+    :param poll_interval: number of seconds between file checks
+                          if inotify is not available
+    :type poll_interval: float
     """
     daemon = True
 
-    def __init__(self, log_path, publisher, container, kill_timeout=600):
+    def __init__(self, log_path, publisher, watch=None, poll_interval=0.5):
         threading.Thread.__init__(self)
         self._stop = threading.Event()
         self._log_path = log_path
         self._publisher = publisher
-        self._container = container
-        self._kill_timeout = kill_timeout
-        self._read_timeout = 0.5
-        self.has_killed_container = False
+        self._watch = watch
+        self._poll_interval = poll_interval
+        self._read_size = 64 * 1024
+        # A self-pipe that lets `stop` interrupt `select`
+        self._wakeup_lock = threading.Lock()
+        self._wakeup_r, self._wakeup_w = os.pipe()
 
     def stop(self):
         self._stop.set()
+        with self._wakeup_lock:
+            if self._wakeup_w is not None:
+                os.write(self._wakeup_w, '.')
 
     def is_stopped(self):
         return self._stop.isSet()
 
-    def _kill_container(self):
-        logger.info('Tailer is killing %s', self._container)
-        docker.kill(self._container)
-        self.has_killed_container = True
-        logger.info('%s has been killed.', self._container)
+    def _close_wakeup_pipe(self):
+        with self._wakeup_lock:
+            os.close(self._wakeup_r)
+            os.close(self._wakeup_w)
+            self._wakeup_r = self._wakeup_w = None
+
+    def _read(self, log_fd, buf):
+        """Reads everything appended to the log since the last call,
+        publishes complete lines and returns a pair: the incomplete tail of
+        the last line and a flag whether anything has been read.
+        """
+        has_read = False
+        while True:
+            data = os.read(log_fd, self._read_size)
+            if not data:
+                return buf, has_read
+            has_read = True
+            lines = (buf + data).split('\n')
+            buf = lines.pop()
+            if lines:
+                self._publisher.publish(lines)
 
     def run(self):
         logger.info('Tailer has started. Log path: %s', self._log_path)
 
-        tailf = subprocess.Popen(['/usr/bin/tail', '-f', self._log_path],
-                                 stdout=subprocess.PIPE)
         try:
-            fl = fcntl.fcntl(tailf.stdout, fcntl.F_GETFL)
-            fcntl.fcntl(tailf.stdout, fcntl.F_SETFL, fl | os.O_NONBLOCK)
+            inotify_watch = inotify.Watch(self._log_path)
+        except OSError as e:
+            logger.info('inotify is not available (%s), polling %s.',
+                        e, self._log_path)
+            inotify_watch = None
 
+        log_fd = os.open(self._log_path, os.O_RDONLY)
+        try:
             buf = ''
-            iterations_without_read = 0
             while True:
                 if self.is_stopped():
                     break
-                reads, _, _ = select.select([tailf.stdout], [], [], self._read_timeout)
-                if not reads:
-                    iterations_without_read += 1
-                    if iterations_without_read * self._read_timeout < self._kill_timeout:
-                        continue
-                    else:
-                        self._kill_container()
-                        return
+
+                if inotify_watch is None:
+                    fds, timeout = [self._wakeup_r], self._poll_interval
                 else:
-                    iterations_without_read = 0
+                    # Stalls are detected by the watchdog, there is
+                    # no need to wake up until the log changes
+                    fds, timeout = [self._wakeup_r, inotify_watch], None
+                reads, _, _ = select.select(fds, [], [], timeout)
+                if inotify_watch in reads:
+                    inotify_watch.drain()
+
+                buf, has_read = self._read(log_fd, buf)
+                if has_read and self._watch is not None:
+                    self._watch.touch()
+
+            # The script has finished: publish whatever is left in the log
+            buf, _ = self._read(log_fd, buf)
+            if buf:
+                self._publisher.publish([buf])
+        finally:
+            os.close(log_fd)
+            if inotify_watch is not None:
+                inotify_watch.close()
+            self._close_wakeup_pipe()
 
-                buf += tailf.stdout.read()
-                lines = buf.split('\n')
 
-                if lines[-1] == '':
-                    buf = ''
-                else:
-                    buf = lines[-1]
-                lines = lines[:-1]
 
-                self._publisher.publish(lines)
-        finally:
-            tailf.terminate()
-            tailf.wait()
+#: Size of the header that precedes every frame of
+#: a multiplexed Docker attach stream
+STREAM_HEADER_SIZE = 8
+
+
+class StreamTailer(threading.Thread):
+    """A daemon thread that reads the container's stdout through
+    the Docker attach API and publishes it line by line, just like
+    :class:`Tailer` does with the log file.
+
+    The stream starts with everything the container has written so far,
+    so the thread can be started before the container. Once :meth:`stop`
+    is called, the stream is read until it ends or nothing arrives for
+    ``poll_interval`` seconds.
+
+    If ``watch`` is given, its :meth:`~kozmic.builds.watchdog.ContainerWatch.touch`
+    is called whenever the container writes something.
 
+    :param docker: Docker client
+    :type docker: :class:`docker.Client`
+
+    :param container: container to read the output of
+    :type container: dictionary returned by :meth:`docker.Client.create_container`
+
+    :param publisher: publisher
+    :type publisher: :class:`Publisher`
+
+    :param watch: the container watch
+    :type watch: :class:`kozmic.builds.watchdog.ContainerWatch`
+
+    :param poll_interval: number of seconds to wait for the rest
+                          of the output once the thread is stopped
+    :type poll_interval: float
+    """
+    daemon = True
+
+    def __init__(self, docker, container, publisher, watch=None,
+                 poll_interval=0.5):
+        threading.Thread.__init__(self)
+        self._stop = threading.Event()
+        self._docker = docker
+        self._container = container
+        self._publisher = publisher
+        self._watch = watch
+        self._poll_interval = poll_interval
+
+    def stop(self):
+        self._stop.set()
+
+    def is_stopped(self):
+        return self._stop.isSet()
+
+    def _recv(self, sock, size):
+        """Reads exactly `size` bytes from `sock`. Returns ``None`` if
+        the stream has ended or the thread has been stopped and nothing
+        has arrived for ``poll_interval`` seconds.
+        """
+        data = ''
+        while len(data) < size:
+            try:
+                block = sock.recv(size - len(data))
+            except socket.timeout:
+                if self.is_stopped():
+                    return None
+                continue
+            if not block:
+                return None
+            data += block
+        return data
+
+    def run(self):
+        logger.info('StreamTailer has started. Container: %s', self._container)
+
+        sock = self._docker.attach_socket(self._container, params={
+            'stdout': 1,
+            'stderr': 0,
+            'stream': 1,
+            'logs': 1,
+        })
+        sock.settimeout(self._poll_interval)
+        try:
+            buf = ''
+            while True:
+                header = self._recv(sock, STREAM_HEADER_SIZE)
+                if header is None:
+                    break
+                _, length = struct.unpack('>BxxxL', header)
+                data = self._recv(sock, length)
+                if data is None:
+                    break
+                if self._watch is not None:
+                    self._watch.touch()
+
+                lines = (buf + data).split('\n')
+                buf = lines.pop()
+                if lines:
+                    self._publisher.publish(lines)
+
+            if buf:
+                self._publisher.publish([buf])
+        finally:
+            sock.close()
 
 SCRIPT_STARTER_SH = '''
 set -x
 set -e
+# Keep the container's stdout for the script output only: the output
+# of the starter itself goes to stderr
+exec 3>&1 1>&2
+
 function cleanup {{  # escape
   # Files created during the build in /kozmic/ folder are owned by root
   # from the host point of view, because the Docker daemon runs from root.
@@ -196,12 +483,25 @@ if [ -f /kozmic/id_rsa ] && [ -f /kozmic/askpass.sh ]; then
   rm /kozmic/askpass.sh /kozmic/id_rsa
 fi
 
-git clone {clone_url} /kozmic/src
+date +%s.%N > /kozmic/clone-started-at
+if [ -d /kozmic-mirror ] && \
+   git --git-dir=/kozmic-mirror cat-file -e {commit_sha}^{{commit}}; then
+  # The host mirror of the repository contains the commit:
+  # clone it locally, borrowing objects instead of downloading them
+  git clone -q --shared /kozmic-mirror /kozmic/src
+  git --git-dir=/kozmic/src/.git remote set-url origin {clone_url}
+else
+  git clone {clone_url} /kozmic/src
+fi
 cd /kozmic/src && git checkout -q {commit_sha}
+date +%s.%N > /kozmic/clone-finished-at
 
 chown -R kozmic /kozmic
+# Environment variables of the build matrix entry
+{exports}
 # Redirect stdout to the file being translated to the redis pubsub channel
-TERM=xterm su kozmic -c "/kozmic/script.sh" &>> /kozmic/script.log
+# (or to the container's stdout if it is streamed through the Docker API)
+TERM=xterm su kozmic -c "/kozmic/script.sh" {script_output}
 '''.strip()
 
 ASKPASS_SH = '''
@@ -215,6 +515,35 @@ fi
 echo {passphrase}
 '''.strip()
 
+SHARD_TESTS_SH = '''
+#!/bin/bash
+# Reads test names (one per line) from stdin and prints the ones to be run
+# by this shard. The tests are spread over the shards so that the shards
+# take about the same time according to the timings reported by previous
+# jobs. Tests without reported timings are assumed to take the average time.
+timings=${KOZMIC_SHARD_TIMINGS:-/kozmic/shard-timings.tsv}
+tab=$(printf '\\t')
+sort -u | awk -F "$tab" -v OFS="$tab" '
+  FILENAME == ARGV[1] { seconds[$1] = $2; next }
+  $0 != "" {
+    tests[$0] = 1
+    if ($0 in seconds) { sum += seconds[$0]; count++ }
+  }
+  END {
+    average = count ? sum / count : 1
+    for (test in tests) print (test in seconds ? seconds[test] : average), test
+  }' "$timings" - |
+sort -t "$tab" -k1,1gr -k2 |
+awk -F "$tab" -v shard="$KOZMIC_SHARD_INDEX" -v total="$KOZMIC_SHARD_TOTAL" '
+  {
+    # Give the test to the least loaded shard, the longest tests first
+    least = 0
+    for (i = 1; i < total; i++) if (load[i] < load[least]) least = i
+    load[least] += $1
+    if (least == shard) print $2
+  }'
+'''.strip()
+
 
 class Builder(threading.Thread):
     """A thread that starts a script in a container and waits
@@ -232,6 +561,13 @@ class Builder(threading.Thread):
         ``exc_info`` triple ``(type, value, traceback)``
         if something went wrong.
 
+    Once the thread has finished, :attr:`timings` is a list of
+    ``(phase, seconds)`` pairs for the phases that have been reached:
+    ``'container start'``, ``'git clone'`` and ``'script'``, and
+    :attr:`test_timings` is a dictionary of the timings (in seconds)
+    of the tests the script has written to ``$KOZMIC_TEST_TIMINGS``
+    (a line of a test name and seconds separated by a tab per test).
+
     :param docker: Docker client
     :type docker: :class:`docker.Client`
 
@@ -259,9 +595,41 @@ class Builder(threading.Thread):
 
     :param commit_sha: SHA of the commit to be checked out
     :type commit_sha: str
+
+    :param env: environment variables to be set for the script
+    :type env: dictionary
+
+    :param shard_timings: timings (in seconds) of the tests reported by
+                          previous jobs. If given, they are used by
+                          `/kozmic/shard-tests` helper that picks the tests
+                          of the shard given by ``KOZMIC_SHARD_INDEX`` and
+                          ``KOZMIC_SHARD_TOTAL`` variables
+    :type shard_timings: dictionary
+
+    :param mirror_path: path of a bare mirror of the repository
+                        (see :func:`kozmic.builds.mirrors.update_git_mirror`)
+                        to be mounted read-only in container's
+                        `/kozmic-mirror` path and cloned from
+    :type mirror_path: str
+
+    :param stream_output: whether to write the script output to
+                          the container's stdout (to be read by
+                          :class:`StreamTailer`) instead of `script.log`
+                          file in the working directory
+    :type stream_output: bool
+
+    :param container: a warm container to run the script in instead of
+                      creating a new one. It has to be started from
+                      the image :attr:`docker_image` refers to, with
+                      :attr:`working_dir` (containing `go` FIFO) and
+                      :attr:`mirror_path` mounted
+                      (see :class:`kozmic.builds.pool.ContainerPool`).
+    :type container: dictionary returned by :meth:`docker.Client.create_container`
     """
     def __init__(self, docker, message_queue, docker_image, script,
-                 working_dir, clone_url, commit_sha, deploy_key=None):
+                 working_dir, clone_url, commit_sha, deploy_key=None,
+                 mirror_path=None, stream_output=False, container=None,
+                 env=None, shard_timings=None):
         threading.Thread.__init__(self)
 
         self._docker = docker
@@ -271,6 +639,11 @@ class Builder(threading.Thread):
         self._working_dir = working_dir
         self._clone_url = clone_url
         self._commit_sha = commit_sha
+        self._mirror_path = mirror_path
+        self._stream_output = stream_output
+        self._warm_container = container
+        self._env = env or {}
+        self._shard_timings = shard_timings
 
         self._rsa_private_key = None
         self._passphrase = None
@@ -280,6 +653,8 @@ class Builder(threading.Thread):
         self.return_code = None
         self.exc_info = None
         self.container = None
+        self.timings = []
+        self.test_timings = {}
 
     def run(self):
         try:
@@ -295,7 +670,12 @@ class Builder(threading.Thread):
         script_starter_sh_path = working_dir_path('script-starter.sh')
         script_starter_sh_content = SCRIPT_STARTER_SH.format(
             clone_url=pipes.quote(self._clone_url),
-            commit_sha=pipes.quote(self._commit_sha))
+            commit_sha=pipes.quote(self._commit_sha),
+            exports='\n'.join(
+                'export {}={}'.format(name, pipes.quote(value))
+                for name, value in sorted(self._env.items())),
+            script_output=('>&3 2>&3' if self._stream_output else
+                           '&>> /kozmic/script.log'))
         with open(script_starter_sh_path, 'w') as script_starter_sh:
             script_starter_sh.write(script_starter_sh_content)
 
@@ -304,10 +684,20 @@ class Builder(threading.Thread):
             script.write(self._build_script)
         os.chmod(script_path, 0o755)
 
-        log_path = working_dir_path('script.log')
-        with open(log_path, 'w') as log:
-            log.write('')
-        os.chmod(log_path, 0o664)
+        if self._shard_timings is not None:
+            with open(working_dir_path('shard-timings.tsv'), 'w') as f:
+                for test, seconds in sorted(self._shard_timings.items()):
+                    f.write(u'{}\t{}\n'.format(test, seconds).encode('utf-8'))
+            shard_tests_path = working_dir_path('shard-tests')
+            with open(shard_tests_path, 'w') as shard_tests:
+                shard_tests.write(SHARD_TESTS_SH)
+            os.chmod(shard_tests_path, 0o755)
+
+        if not self._stream_output:
+            log_path = working_dir_path('script.log')
+            with open(log_path, 'w') as log:
+                log.write('')
+            os.chmod(log_path, 0o664)
 
         if self._rsa_private_key and self._passphrase:
             askpass_sh_path = working_dir_path('askpass.sh')
@@ -322,19 +712,39 @@ class Builder(threading.Thread):
                 id_rsa.write(self._rsa_private_key)
             os.chmod(id_rsa_path, 0o400)
 
+        volumes, binds = get_mounts(self._working_dir, self._mirror_path)
+
         logger.info('Starting Docker process...')
-        self.container = self._docker.create_container(
-            self._docker_image,
-            command='bash /kozmic/script-starter.sh',
-            volumes={'/kozmic': {}})
+        started_at = time.time()
+        if self._warm_container:
+            self.container = self._warm_container
+        else:
+            self.container = self._docker.create_container(
+                self._docker_image,
+                command='bash /kozmic/script-starter.sh',
+                volumes=volumes)
 
         self._message_queue.put(self.container, block=True, timeout=60)
         self._message_queue.join()
 
-        self._docker.start(self.container, binds={self._working_dir: '/kozmic'})
+        if self._warm_container:
+            # The container is waiting for a line in this FIFO to run
+            # the starter. Opening it does not block: the container
+            # has it open (or has given up and the open fails)
+            go_fd = os.open(working_dir_path('go'),
+                            os.O_WRONLY | os.O_NONBLOCK)
+            try:
+                os.write(go_fd, 'go\n')
+            finally:
+                os.close(go_fd)
+        else:
+            self._docker.start(self.container, binds=binds)
         logger.info('Docker process %s has started.', self.container)
+        self.timings.append(('container start', time.time() - started_at))
 
         return_code = self._docker.wait(self.container)
+        self.timings.extend(self._get_script_timings(time.time()))
+        self.test_timings = self._get_test_timings()
         try:
             logs = self._docker.logs(self.container)
         except socket.timeout:
@@ -347,55 +757,123 @@ class Builder(threading.Thread):
 
         return return_code
 
+    def _get_test_timings(self):
+        """Returns the test timings reported by the script.
+        Malformed lines are skipped.
+        """
+        test_timings = {}
+        try:
+            f = open(os.path.join(self._working_dir, 'test-timings.tsv'))
+        except IOError:
+            return test_timings
+        with f:
+            for line in f:
+                test, _, seconds = line.rstrip('\n').rpartition('\t')
+                if not test:
+                    continue
+                try:
+                    test_timings[test.decode('utf-8')] = float(seconds)
+                except ValueError:
+                    continue
+        return test_timings
+
+    def _get_script_timings(self, finished_at):
+        """Returns timings of the git clone and the script based on
+        the timestamps written by the starter script.
+        """
+        timestamps = []
+        for name in ('clone-started-at', 'clone-finished-at'):
+            try:
+                with open(os.path.join(self._working_dir, name)) as f:
+                    timestamps.append(float(f.read()))
+            except (IOError, ValueError):
+                break
+        timings = []
+        if len(timestamps) == 2:
+            clone_started_at, clone_finished_at = timestamps
+            timings.append(('git clone', clone_finished_at - clone_started_at))
+            timings.append(('script', finished_at - clone_finished_at))
+        return timings
+
 
 @contextlib.contextmanager
 def _run(publisher, stall_timeout, clone_url, commit_sha,
-         docker_image, script, deploy_key=None, remove_container=True):
+         docker_image, script, deploy_key=None, mirror_path=None,
+         remove_container=True, is_cancelled=None, log_source='file',
+         timer=None, phase='build', env=None, shard_timings=None,
+         test_timings=None):
     yielded = False
-    stdout = ''
     try:
-        with create_temp_dir() as working_dir:
+        container_pool = get_container_pool()
+        warm_container = None
+        if container_pool is not None:
+            warm_container = container_pool.claim(docker_image, mirror_path)
+
+        with (warm_container or create_temp_dir()) as working_dir:
             message_queue = Queue.Queue()
+            # `docker` is a local proxy, unusable outside of the app context
+            docker_client = docker._get_current_object()
             builder = Builder(
-                docker=docker._get_current_object(),  # `docker` is a local proxy
+                docker=docker_client,
                 deploy_key=deploy_key,
                 clone_url=clone_url,
                 commit_sha=commit_sha,
+                mirror_path=mirror_path,
                 docker_image=docker_image,
                 script=script,
+                env=env,
+                shard_timings=shard_timings,
                 working_dir=working_dir,
-                message_queue=message_queue)
+                message_queue=message_queue,
+                stream_output=(log_source == 'attach'),
+                container=warm_container and warm_container.container)
 
-            log_path = os.path.join(working_dir, 'script.log')
-            stop_reason = ''
             try:
                 # Start Builder and wait until it will create the container
                 builder.start()
                 container = message_queue.get(block=True, timeout=60)
 
-                # Now the container id is known and we can pass it to Tailer
-                tailer = Tailer(
-                    log_path=log_path,
-                    publisher=publisher,
-                    container=container,
-                    kill_timeout=stall_timeout)
+                # Now the container id is known and we can pass it
+                # to the watchdog and the tailer
+                watch = get_watchdog().watch(
+                    container,
+                    timeout=stall_timeout,
+                    kill=docker_client.kill,
+                    is_cancelled=is_cancelled)
+                if log_source == 'attach':
+                    tailer = StreamTailer(
+                        docker=docker_client,
+                        container=container,
+                        publisher=publisher,
+                        watch=watch)
+                else:
+                    tailer = Tailer(
+                        log_path=os.path.join(working_dir, 'script.log'),
+                        publisher=publisher,
+                        watch=watch)
                 tailer.start()
                 try:
                     # Tell Builder to continue and wait for it to finish
                     message_queue.task_done()
                     builder.join()
                 finally:
+                    watch.stop()
                     tailer.stop()
-                    if tailer.has_killed_container:
-                        stop_reason = '\nSorry, your script has stalled and been killed.\n'
+                    tailer.join()
+                    if watch.has_stalled:
+                        publisher.publish(
+                            'Sorry, your script has stalled and been killed.')
+                    elif watch.has_been_cancelled:
+                        publisher.publish('The job has been cancelled.')
             finally:
+                if timer is not None:
+                    for name, seconds in builder.timings:
+                        timer.add('{} {}'.format(phase, name), seconds)
+                if test_timings is not None:
+                    test_timings.update(builder.test_timings)
                 if builder.container and remove_container:
                     docker.remove_container(builder.container)
 
-                if os.path.exists(log_path):
-                    with open(log_path, 'r') as log:
-                        stdout = log.read()
-
                 assert ((builder.return_code is not None) ^
                         (builder.exc_info is not None))
                 if builder.exc_info:
@@ -404,9 +882,7 @@ def _run(publisher, stall_timeout, clone_url, commit_sha,
                     raise builder.exc_info[1], None, builder.exc_info[2]
                 else:
                     try:
-                        yield (builder.return_code,
-                               stdout + stop_reason,
-                               builder.container)
+                        yield builder.return_code, builder.container
                     except:
                         raise
                     finally:
@@ -414,20 +890,243 @@ def _run(publisher, stall_timeout, clone_url, commit_sha,
                                         # stop after throw()" error if nested
                                         # code raised exception
     except:
-        stdout += ('\nSorry, something went wrong. We are notified of '
-                   'the issue and will fix it soon.')
         if not yielded:
-            yield 1, stdout, None
+            publisher.publish('Sorry, something went wrong. We are notified '
+                              'of the issue and will fix it soon.')
+            yield 1, None
         raise
 
 
+def _install(cached_image, cached_image_tag, timer, **kwargs):
+    """Runs the install script. If it succeeds, promotes the resulting
+    container to `cached_image`:`cached_image_tag` image that will be
+    used for running the build script in this and consequent jobs.
+    Returns the script's return code.
+    """
+    with _run(remove_container=False, timer=timer, phase='install',
+              **kwargs) as (return_code, container):
+        if container:
+            if return_code == 0:
+                with timer.phase('docker commit'):
+                    docker.commit(container['Id'], repository=cached_image,
+                                  tag=cached_image_tag)
+            docker.remove_container(container)
+    return return_code
+
+
+#: The maximum number of warm installs in a row. Every warm install adds
+#: a layer on top of the previous cached image, so once in a while the
+#: install script is run from scratch to keep the number of layers bounded
+WARM_INSTALL_MAX_DEPTH = 20
+
+
+def _get_warm_install_key(hook, matrix_index=0):
+    if matrix_index:
+        return 'kozmic:warm-install:{}:{}'.format(hook.id, matrix_index)
+    return 'kozmic:warm-install:{}'.format(hook.id)
+
+
+def _get_warm_install_image(hook, base_image_id, matrix_index=0):
+    """Returns a pair: the most recent cached image of the `hook`'s
+    `matrix_index` build matrix entry and the number of warm installs
+    it is a result of. Returns ``(None, -1)`` if there is no such image,
+    it is built from another base image or the number of warm installs
+    reached :data:`WARM_INSTALL_MAX_DEPTH`.
+    """
+    data = get_redis_client().hgetall(
+        _get_warm_install_key(hook, matrix_index))
+    if not data or data.get('base_image_id') != base_image_id:
+        return None, -1
+    depth = int(data['depth'])
+    if depth >= WARM_INSTALL_MAX_DEPTH:
+        return None, -1
+    image, tag = data['image'].rsplit(':', 1)
+    if not does_docker_image_exist(image, tag):
+        return None, -1
+    return data['image'], depth
+
+
+def _set_warm_install_image(hook, base_image_id, image, depth,
+                            matrix_index=0):
+    get_redis_client().hmset(_get_warm_install_key(hook, matrix_index), {
+        'base_image_id': base_image_id,
+        'image': image,
+        'depth': depth,
+    })
+
+
+#: Number of seconds the test timings of a hook are kept since
+#: they have been reported last time
+TEST_TIMINGS_TTL = 30 * 24 * 60 * 60
+
+
+def _get_test_timings_key(hook):
+    return 'kozmic:test-timings:{}'.format(hook.id)
+
+
+def _get_test_timings(hook):
+    """Returns a dictionary of the test timings (in seconds)
+    reported by the previous jobs of the `hook`.
+    """
+    return dict((test.decode('utf-8'), float(seconds)) for test, seconds in
+                get_redis_client().hgetall(_get_test_timings_key(hook)).items())
+
+
+def _save_test_timings(hook, test_timings):
+    """Merges `test_timings` reported by the jobs of a hook call into
+    the test timings of the `hook`. Jobs of the build matrix entries and
+    shards of the hook report timings of different tests and share them.
+    """
+    if not test_timings:
+        return
+    key = _get_test_timings_key(hook)
+    pipeline = get_redis_client().pipeline()
+    pipeline.hmset(key, dict((test.encode('utf-8'), round(seconds, 3))
+                             for test, seconds in test_timings.items()))
+    pipeline.expire(key, TEST_TIMINGS_TTL)
+    pipeline.execute()
+
+
+#: Number of seconds the test timings the shards of a hook call are split
+#: by and the timings reported by them are kept for restarting the shards
+SHARD_TIMINGS_TTL = 7 * 24 * 60 * 60
+
+
+def _get_shard_timings_key(hook_call):
+    return 'kozmic:shard-timings:{}'.format(hook_call.id)
+
+
+def _get_reported_test_timings_key(hook_call):
+    return 'kozmic:reported-test-timings:{}'.format(hook_call.id)
+
+
+def _get_shard_timings(hook_call):
+    """Returns the test timings of the hook the tests are split by between
+    the shards of `hook_call`. The first job of the hook call takes them,
+    so that all the shards (and their restarts) split the tests the same
+    way, whatever timings the other hook calls report meanwhile.
+    """
+    key = _get_shard_timings_key(hook_call)
+    redis_client = get_redis_client()
+    shard_timings = redis_client.get(key)
+    if shard_timings is None:
+        pipeline = redis_client.pipeline()
+        pipeline.setnx(key, json.dumps(_get_test_timings(hook_call.hook)))
+        pipeline.expire(key, SHARD_TIMINGS_TTL)
+        pipeline.get(key)
+        shard_timings = pipeline.execute()[-1]
+    return json.loads(shard_timings)
+
+
+def _report_test_timings(hook_call, test_timings):
+    """Keeps `test_timings` reported by a job of `hook_call` until
+    all the jobs of the hook call have finished.
+    """
+    if not test_timings:
+        return
+    key = _get_reported_test_timings_key(hook_call)
+    pipeline = get_redis_client().pipeline()
+    pipeline.hmset(key, dict((test.encode('utf-8'), round(seconds, 3))
+                             for test, seconds in test_timings.items()))
+    pipeline.expire(key, SHARD_TIMINGS_TTL)
+    pipeline.execute()
+
+
+def _merge_test_timings(hook_call):
+    """Merges the test timings reported by the jobs of `hook_call` into
+    the test timings of its hook if all the jobs (including restarted
+    ones) have finished.
+    """
+    matrix_indexes = set(range(len(hook_call.hook.get_matrix())))
+    finished = set()
+    for matrix_index, finished_at in Job.query.filter_by(
+            hook_call_id=hook_call.id).with_entities(
+            Job.matrix_index, Job.finished_at):
+        if finished_at is None:
+            return
+        finished.add(matrix_index)
+    if not matrix_indexes <= finished:
+        return
+    reported = get_redis_client().hgetall(
+        _get_reported_test_timings_key(hook_call))
+    _save_test_timings(hook_call.hook, dict(
+        (test.decode('utf-8'), float(seconds))
+        for test, seconds in reported.items()))
+
+
+#: Number of seconds the ids computed by a job are kept for its restart
+RESTART_HINT_TTL = 24 * 60 * 60
+
+
+def _get_restart_hint_key(hook_call, matrix_index=0):
+    if matrix_index:
+        return 'kozmic:restart-hint:{}:{}'.format(hook_call.id, matrix_index)
+    return 'kozmic:restart-hint:{}'.format(hook_call.id)
+
+
+def _get_hook_fingerprint(hook, matrix_entry):
+    """Returns a string that changes whenever the Docker image,
+    the environment variables of the build matrix entry, the install
+    script or the tracked files of the `hook` are changed.
+    """
+    parts = [matrix_entry['docker_image'], hook.install_script or u'']
+    parts.extend(u'{}={}'.format(name, value)
+                 for name, value in sorted(matrix_entry['env'].items()))
+    parts.extend(tracked_file.path for tracked_file in
+                 hook.tracked_files.order_by(TrackedFile.path))
+    return hashlib.sha256(u'\0'.join(parts).encode('utf-8')).hexdigest()
+
+
+def _save_restart_hint(job):
+    """Remembers the Docker image id and the cache id of the `job`,
+    so that the job restarting it can skip pulling the image and
+    computing the cache id.
+    """
+    matrix_entry = job.get_matrix_entry()
+    if not job.docker_image_id or matrix_entry is None:
+        return
+    key = _get_restart_hint_key(job.hook_call, job.matrix_index)
+    pipeline = get_redis_client().pipeline()
+    pipeline.hmset(key, {
+        'hook_fingerprint': _get_hook_fingerprint(job.hook_call.hook,
+                                                  matrix_entry),
+        'docker_image_id': job.docker_image_id,
+        'cache_id': job.cache_id or '',
+    })
+    pipeline.expire(key, RESTART_HINT_TTL)
+    pipeline.execute()
+
+
+def _pop_restart_hint(hook_call, matrix_index=0):
+    """Returns a dictionary saved by :func:`_save_restart_hint` for
+    the job of the `hook_call` running the `matrix_index` build matrix
+    entry. Returns an empty dictionary if there is none or the hook has
+    been changed since.
+    """
+    key = _get_restart_hint_key(hook_call, matrix_index)
+    pipeline = get_redis_client().pipeline()
+    pipeline.hgetall(key)
+    pipeline.delete(key)
+    data, _ = pipeline.execute()
+    if not data:
+        return {}
+    matrix_entry = hook_call.hook.get_matrix()[matrix_index]
+    if data['hook_fingerprint'] != _get_hook_fingerprint(hook_call.hook,
+                                                         matrix_entry):
+        return {}
+    return data
+
+
 class RestartError(Exception):
     pass
 
 
 @celery.task
 def restart_job(id):
-    """A Celery task that restarts a job.
+    """A Celery task that restarts a job: replaces it with a new job
+    of the same hook call, enqueued with a high priority. The new job
+    reuses the pulled Docker image and the cache id of the old one unless
+    the hook has been changed.
 
     :param id: int, :class:`Job` identifier
     """
@@ -435,69 +1134,154 @@ def restart_job(id):
     assert 'Job#{} does not exist.'.format(id)
     if not job.is_finished():
         raise RestartError('Tried to restart %r which is not finished.', job)
+    if not job.can_be_restarted():
+        raise RestartError('Tried to restart %r of a cancelled build.', job)
 
+    hook_call = job.hook_call
+    matrix_index = job.matrix_index
+    _save_restart_hint(job)
     db.session.delete(job)
-    # Run do_job task synchronously:
-    do_job.apply(args=(job.hook_call_id,))
+    db.session.commit()
+    scheduler.enqueue(hook_call, priority=scheduler.HIGH_PRIORITY,
+                      matrix_indexes=[matrix_index])
 
 
 @celery.task
-def do_job(hook_call_id):
+def do_job(hook_call_id, matrix_index=0):
     """A Celery task that does a job specified by a hook call.
 
     Creates a :class:`Job` instance and executes a build script prescribed
     by a triggered :class:`Hook`. Also sends job output to :attr:`Job.task_uuid`
-    Redis pub-sub channel and updates build status.
+    Redis pub-sub channel, stores it in :class:`JobLogChunk` s
+    and updates build status.
 
     :param hook_call_id: int, :class:`HookCall` identifier
+    :param matrix_index: int, index of the build matrix entry
+                         (see :meth:`Hook.get_matrix`) to be run
     """
+    # A job sent to a worker queue expires unless it is started
+    affinity.start(hook_call_id, matrix_index)
     hook_call = HookCall.query.get(hook_call_id)
     assert hook_call, 'HookCall#{} does not exist.'.format(hook_call_id)
 
+    try:
+        _do_job(hook_call, matrix_index, task_uuid=do_job.request.id)
+    except:
+        db.session.rollback()
+        raise
+    finally:
+        # The slot is freed even if the job has failed to be created
+        scheduler.job_finished(hook_call, matrix_index)
+
+
+def _do_job(hook_call, matrix_index, task_uuid):
+    if hook_call.build.status == 'cancelled':
+        logger.info('%r has been cancelled, skipping HookCall#%s.',
+                    hook_call.build, hook_call.id)
+        return
+
+    hook = hook_call.hook
+    matrix = hook.get_matrix()
+    if matrix_index >= len(matrix):
+        logger.info('%r matrix has no entry #%s anymore, skipping '
+                    'HookCall#%s.', hook, matrix_index, hook_call.id)
+        return
+    matrix_entry = matrix[matrix_index]
+    docker_image = matrix_entry['docker_image']
+
     job = Job(
         build=hook_call.build,
         hook_call=hook_call,
-        task_uuid=do_job.request.id)
+        matrix_index=matrix_index,
+        task_uuid=task_uuid)
     db.session.add(job)
     job.started()
     db.session.commit()
 
-    hook = hook_call.hook
     project = hook.project
     config = current_app.config
 
-    redis_client = redis.StrictRedis(host=config['KOZMIC_REDIS_HOST'],
-                                     port=config['KOZMIC_REDIS_PORT'],
-                                     db=config['KOZMIC_REDIS_DATABASE'])
-    publisher = Publisher(redis_client=redis_client, channel=job.task_uuid)
+    redis_client = get_redis_client()
+    log_writer = JobLogWriter(
+        engine=db.engine,
+        job_id=job.id,
+        chunk_size=config['KOZMIC_LOG_CHUNK_SIZE'])
+    publisher = Publisher(
+        redis_client=redis_client,
+        channel=job.task_uuid,
+        flush_interval=config['KOZMIC_REDIS_PUBLISH_INTERVAL'],
+        batch_size=config['KOZMIC_REDIS_PUBLISH_BATCH_SIZE'],
+        log_writer=log_writer)
+
+    cancellation_key = job.get_cancellation_key()
+    is_cancelled = lambda: bool(redis_client.exists(cancellation_key))
+    timer = PhaseTimer()
+
+    def finish(return_code):
+        # Make sure that the whole log is stored by the time
+        # the job is marked as finished
+        log_writer.flush()
+        job.is_cancelled = is_cancelled()
+        job.set_timings(timer.timings)
+        job.finished(return_code)
+        db.session.commit()
+        job.cache_log_html()
+        # The timings change only once all the shards have
+        # been split by the same ones
+        _merge_test_timings(hook_call)
+        for phase, seconds in timer.timings:
+            metrics.observe('job_phase_duration_seconds', seconds, phase)
+        metrics.observe('job_duration_seconds',
+                        (job.finished_at - job.started_at).total_seconds())
 
-    stdout = ''
     try:
         kwargs = dict(
             publisher=publisher,
+            is_cancelled=is_cancelled,
             stall_timeout=config['KOZMIC_STALL_TIMEOUT'],
+            log_source=config['KOZMIC_LOG_SOURCE'],
+            timer=timer,
+            env=matrix_entry['env'],
             clone_url=(project.gh_https_clone_url if project.is_public else
                        project.gh_ssh_clone_url),
             commit_sha=hook_call.build.gh_commit_sha)
 
-        message = 'Pulling "{}" Docker image...'.format(hook.docker_image)
-        logger.info(message)
-        publisher.publish(message)
-        stdout = message + '\n'
+        restart_hint = _pop_restart_hint(hook_call, matrix_index)
+        docker_image_id = None
+        if restart_hint:
+            # The job is a restart: skip pulling if the image
+            # is still the one the restarted job has pulled
+            try:
+                docker_image_id = docker.inspect_image(docker_image)['Id']
+            except DockerAPIError:
+                pass
+            if docker_image_id != restart_hint['docker_image_id']:
+                docker_image_id = None
 
-        try:
-            docker.pull(hook.docker_image)
-            # Make sure that image has been successfully pulled by calling
-            # `inspect_image` on it:
-            docker.inspect_image(hook.docker_image)
-        except DockerAPIError as e:
-            logger.info('Failed to pull %s: %s.', hook.docker_image, e)
-            job.finished(1)
-            job.stdout = str(e)
-            db.session.commit()
-            return
+        if docker_image_id:
+            publisher.publish('Reusing "{}" Docker image pulled by '
+                              'the restarted job...'.format(docker_image))
         else:
-            logger.info('%s image has been pulled.', hook.docker_image)
+            message = 'Pulling "{}" Docker image...'.format(docker_image)
+            logger.info(message)
+            publisher.publish(message)
+
+            try:
+                with timer.phase('docker pull'):
+                    docker.pull(docker_image)
+                    # Make sure that image has been successfully pulled
+                    # by calling `inspect_image` on it:
+                    docker_image_id = docker.inspect_image(
+                        docker_image)['Id']
+            except DockerAPIError as e:
+                logger.info('Failed to pull %s: %s.', docker_image, e)
+                publisher.publish(str(e))
+                finish(1)
+                return
+            else:
+                logger.info('%s image has been pulled.', docker_image)
+                affinity.add_image(docker_image)
+        job.docker_image_id = docker_image_id
 
         if not project.is_public:
             project.deploy_key.ensure()
@@ -507,45 +1291,98 @@ def do_job(hook_call_id):
                 project.deploy_key.rsa_private_key,
                 project.passphrase)
 
-        if job.hook_call.hook.install_script:
-            cached_image = 'kozmic-cache/{}'.format(job.get_cache_id())
+        if config['KOZMIC_GIT_MIRRORS_DIR']:
+            with timer.phase('git mirror'):
+                kwargs['mirror_path'] = update_git_mirror(
+                    mirrors_dir=config['KOZMIC_GIT_MIRRORS_DIR'],
+                    name=project.id,
+                    clone_url=kwargs['clone_url'],
+                    commit_sha=kwargs['commit_sha'],
+                    deploy_key=kwargs.get('deploy_key'))
+
+        if hook.install_script:
+            with timer.phase('cache id'):
+                if (restart_hint.get('cache_id') and
+                        docker_image_id == restart_hint['docker_image_id']):
+                    cache_id = restart_hint['cache_id']
+                else:
+                    cache_id = job.get_cache_id()
+            job.cache_id = cache_id
+            cached_image = 'kozmic-cache/{}'.format(cache_id)
             cached_image_tag = str(project.id)
             if does_docker_image_exist(cached_image, cached_image_tag):
-                install_stdout = ('Skipping install script as tracked files '
-                                  'did not change...')
-                publisher.publish(install_stdout)
-                stdout += install_stdout + '\n'
+                metrics.incr('cache_hits')
+                touch_cached_image(cached_image, cached_image_tag)
+                publisher.publish('Skipping install script as tracked files '
+                                  'did not change (cache hit)...')
             else:
-                with _run(docker_image=hook.docker_image,
-                          script=hook.install_script,
-                          remove_container=False,
-                          **kwargs) as (return_code, install_stdout, container):
-                    stdout += install_stdout
-                    if return_code == 0:
-                        # Install script has finished successfully. So we
-                        # promote the resulting container to an image that
-                        # we will use for running the build script in
-                        # this and consequent jobs
-                        docker.commit(container['Id'], repository=cached_image,
-                                      tag=cached_image_tag)
-                        docker.remove_container(container)
-                    else:
-                        job.finished(return_code)
-                        job.stdout = stdout
-                        db.session.commit()
+                metrics.incr('cache_misses')
+                warm_image, depth = None, -1
+                if hook.use_warm_install:
+                    warm_image, depth = _get_warm_install_image(
+                        hook, docker_image_id, matrix_index)
+
+                return_code = None
+                if warm_image:
+                    publisher.publish('Running install script on top of {} '
+                                      '(warm install)...'.format(warm_image))
+                    try:
+                        return_code = _install(
+                            docker_image=warm_image,
+                            script=hook.install_script,
+                            cached_image=cached_image,
+                            cached_image_tag=cached_image_tag,
+                            **kwargs)
+                    except Exception:
+                        logger.exception('Warm install of %r on top of %s '
+                                         'has failed.', job, warm_image)
+                        return_code = None
+                    if return_code != 0:
+                        publisher.publish('Warm install has failed.')
+                        depth = -1
+
+                if return_code != 0:
+                    publisher.publish('Running install script (cold install)...')
+                    return_code = _install(
+                        docker_image=docker_image,
+                        script=hook.install_script,
+                        cached_image=cached_image,
+                        cached_image_tag=cached_image_tag,
+                        **kwargs)
+                    if return_code != 0:
+                        finish(return_code)
                         return
                 assert docker.images(cached_image)
+                touch_cached_image(cached_image, cached_image_tag)
+                _set_warm_install_image(
+                    hook, docker_image_id,
+                    cached_image + ':' + cached_image_tag, depth + 1,
+                    matrix_index)
             docker_image = cached_image + ':' + cached_image_tag
+            affinity.add_image(docker_image)
+            affinity.set_hook_image(hook, docker_image, matrix_index)
+
+        # The install script is shared by the shards and does not get
+        # the shard variables
+        kwargs['env'] = dict(
+            matrix_entry['env'],
+            KOZMIC_SHARD_INDEX=str(matrix_entry['shard_index']),
+            KOZMIC_SHARD_TOTAL=str(matrix_entry['shard_total']),
+            KOZMIC_TEST_TIMINGS='/kozmic/test-timings.tsv')
+        if matrix_entry['shard_total'] > 1:
+            shard_timings = _get_shard_timings(hook_call)
         else:
-            docker_image = job.hook_call.hook.docker_image
-
+            # A single shard runs all the tests whatever the timings are
+            shard_timings = {}
+        test_timings = {}
         with _run(docker_image=docker_image,
                   script=hook.build_script,
                   remove_container=True,
-                  **kwargs) as (return_code, build_stdout, container):
-            job.finished(return_code)
-            job.stdout = stdout + build_stdout
-            db.session.commit()
+                  shard_timings=shard_timings,
+                  test_timings=test_timings,
+                  **kwargs) as (return_code, container):
+            _report_test_timings(hook_call, test_timings)
+            finish(return_code)
             return
     finally:
         publisher.finish()
@@ -5,11 +5,11 @@ import re
 
 import github3
 import sqlalchemy
-from flask import request, redirect, url_for
+from flask import Response, request, redirect, url_for
 
-from kozmic import db, csrf
+from kozmic import db, csrf, metrics
 from kozmic.models import Project, Build, Hook, HookCall
-from . import bp, tasks
+from . import bp, scheduler
 
 
 def get_ref_and_sha(payload):
@@ -38,6 +38,11 @@ def get_ref_and_sha(payload):
         return None
 
 
+def get_default_branch(payload):
+    repository = payload.get('repository', {})
+    return repository.get('default_branch') or repository.get('master_branch')
+
+
 @csrf.exempt
 @bp.route('/_hooks/hook/<int:id>/', methods=('POST',))
 def hook(id):
@@ -80,7 +85,8 @@ def hook(id):
         Build.gh_commit_ref == ref,
         Build.gh_commit_sha == gh_commit.sha).first()
 
-    if not build:
+    is_build_new = not build
+    if is_build_new:
         build = Build(
             project=hook.project,
             status='enqueued',
@@ -109,7 +115,19 @@ def hook(id):
         db.session.rollback()
         return 'OK'
 
-    tasks.do_job.delay(hook_call_id=hook_call.id)
+    if is_build_new and hook.project.auto_cancel_builds:
+        for superseded_build in build.get_superseded_builds():
+            superseded_build.cancel(
+                description='Kozmic build #{0} has been superseded '
+                            'by #{1}'.format(superseded_build.number,
+                                             build.number))
+        db.session.commit()
+
+    if ref == get_default_branch(payload):
+        priority = scheduler.HIGH_PRIORITY
+    else:
+        priority = scheduler.NORMAL_PRIORITY
+    scheduler.enqueue(hook_call, priority=priority)
     return 'OK'
 
 
@@ -127,3 +145,9 @@ def badge(gh_login, gh_name, ref):
         _scheme='https'))
     response.status_code = 307
     return response
+
+
+@bp.route('/metrics')
+def metrics_view():
+    return Response(metrics.render(),
+                    content_type='text/plain; version=0.0.4')
@@ -0,0 +1,206 @@
+# coding: utf-8
+"""
+kozmic.builds.watchdog
+~~~~~~~~~~~~~~~~~~~~~~
+
+A single thread per worker process that kills containers of stalled and
+cancelled jobs. Deadlines of all the running containers are kept in
+a heap, so the thread only wakes up when the nearest deadline is due
+(or to check for cancellations), no matter how many jobs are running.
+
+.. autofunction:: get_watchdog
+.. autoclass:: Watchdog
+   :members: watch
+.. autoclass:: ContainerWatch
+   :members:
+"""
+import os
+import time
+import heapq
+import select
+import logging
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+#: Number of seconds between checks whether the watched jobs are cancelled
+CANCEL_CHECK_INTERVAL = 2
+
+
+class ContainerWatch(object):
+    """A container watched by :class:`Watchdog`. Returned by
+    :meth:`Watchdog.watch`.
+
+    .. attribute:: has_stalled
+
+        Whether the container has been killed because there was no
+        activity for ``timeout`` seconds.
+
+    .. attribute:: has_been_cancelled
+
+        Whether the container has been killed because the job
+        has been cancelled.
+    """
+    def __init__(self, watchdog, container, timeout, kill, is_cancelled):
+        self._watchdog = watchdog
+        self.container = container
+        self.timeout = timeout
+        self.kill = kill
+        self.is_cancelled = is_cancelled
+        self.deadline = time.time() + timeout
+        self.is_active = True
+        self.has_stalled = False
+        self.has_been_cancelled = False
+
+    def touch(self):
+        """Reports the container activity, pushing its deadline forward."""
+        # The heap entry is not updated: the watchdog notices that
+        # the deadline has moved when the entry comes up
+        self.deadline = time.time() + self.timeout
+
+    def stop(self):
+        """Stops watching the container."""
+        self._watchdog.unwatch(self)
+
+
+class Watchdog(threading.Thread):
+    """A daemon thread that kills watched containers once their deadlines
+    expire or their jobs are cancelled. Use :func:`get_watchdog` to get
+    the watchdog of the current process.
+    """
+    daemon = True
+
+    def __init__(self, cancel_check_interval=CANCEL_CHECK_INTERVAL):
+        threading.Thread.__init__(self, name='kozmic-watchdog')
+        self._cancel_check_interval = cancel_check_interval
+        self._lock = threading.Lock()
+        # (deadline, sequence number, watch) tuples
+        self._heap = []
+        self._sequence = 0
+        self._watches = set()
+        self._next_cancel_check_at = 0
+        # A self-pipe that lets `watch` interrupt `select`
+        self._wakeup_r, self._wakeup_w = os.pipe()
+
+    def _push(self, watch):
+        self._sequence += 1
+        heapq.heappush(self._heap, (watch.deadline, self._sequence, watch))
+
+    def _wakeup(self):
+        os.write(self._wakeup_w, '.')
+
+    def watch(self, container, timeout, kill, is_cancelled=None):
+        """Starts watching `container`. Returns a :class:`ContainerWatch`
+        whose :meth:`~ContainerWatch.touch` must be called on every
+        container activity.
+
+        :param timeout: number of seconds of inactivity after which
+                        the container is killed
+        :param kill: a function that kills the container, i.e.
+                     :meth:`docker.Client.kill`
+        :param is_cancelled: a function that tells whether the job
+                             has been cancelled
+        """
+        watch = ContainerWatch(self, container, timeout, kill, is_cancelled)
+        with self._lock:
+            self._watches.add(watch)
+            self._push(watch)
+        self._wakeup()
+        return watch
+
+    def unwatch(self, watch):
+        with self._lock:
+            watch.is_active = False
+            self._watches.discard(watch)
+        # The heap entry is dropped once it comes up
+
+    def _pop_stalled(self, now):
+        stalled = []
+        while self._heap and self._heap[0][0] <= now:
+            _, _, watch = heapq.heappop(self._heap)
+            if not watch.is_active:
+                continue
+            if watch.deadline > now:
+                # The container has been active since the entry was pushed
+                self._push(watch)
+                continue
+            watch.is_active = False
+            self._watches.discard(watch)
+            stalled.append(watch)
+        return stalled
+
+    def _get_timeout(self, now):
+        timeouts = []
+        if self._heap:
+            timeouts.append(self._heap[0][0] - now)
+        if any(watch.is_cancelled for watch in self._watches):
+            timeouts.append(self._next_cancel_check_at - now)
+        return max(min(timeouts), 0) if timeouts else None
+
+    def _kill(self, watch):
+        logger.info('Watchdog is killing %s.', watch.container)
+        try:
+            watch.kill(watch.container)
+        except Exception:
+            logger.exception('Failed to kill %s.', watch.container)
+        else:
+            logger.info('%s has been killed.', watch.container)
+
+    def run(self):
+        while True:
+            with self._lock:
+                now = time.time()
+                stalled = self._pop_stalled(now)
+                to_check = []
+                if now >= self._next_cancel_check_at:
+                    to_check = [watch for watch in self._watches
+                                if watch.is_cancelled]
+                    self._next_cancel_check_at = (
+                        now + self._cancel_check_interval)
+                timeout = self._get_timeout(now)
+
+            for watch in stalled:
+                watch.has_stalled = True
+                self._kill(watch)
+            for watch in to_check:
+                try:
+                    is_cancelled = watch.is_cancelled()
+                except Exception:
+                    logger.exception('Failed to check whether the job of %s '
+                                     'is cancelled.', watch.container)
+                    continue
+                if is_cancelled and watch.is_active:
+                    self.unwatch(watch)
+                    watch.has_been_cancelled = True
+                    self._kill(watch)
+
+            if stalled or to_check:
+                # Killing might have taken a while
+                continue
+            reads, _, _ = select.select([self._wakeup_r], [], [], timeout)
+            if reads:
+                os.read(self._wakeup_r, 4096)
+
+
+_watchdog = None
+_watchdog_pid = None
+_watchdog_lock = threading.Lock()
+
+
+def get_watchdog():
+    """Returns the :class:`Watchdog` of the current process,
+    starting it if necessary.
+    """
+    global _watchdog, _watchdog_pid
+    pid = os.getpid()
+    if _watchdog_pid != pid:
+        with _watchdog_lock:
+            if _watchdog_pid != pid:
+                # Threads do not survive fork, so a watchdog inherited
+                # from the parent process is not running
+                _watchdog = Watchdog()
+                _watchdog.start()
+                _watchdog_pid = pid
+    return _watchdog
@@ -16,16 +16,31 @@ class DefaultConfig(object):
     KOZMIC_REDIS_HOST = 'localhost'
     KOZMIC_REDIS_PORT = 6379
     KOZMIC_REDIS_DATABASE = 0
+    KOZMIC_REDIS_PUBLISH_INTERVAL = 0.25
+    KOZMIC_REDIS_PUBLISH_BATCH_SIZE = 64 * 1024
     KOZMIC_STALL_TIMEOUT = 900
+    KOZMIC_LOG_SOURCE = 'file'
+    KOZMIC_LOG_CHUNK_SIZE = 64 * 1024
+    KOZMIC_LOG_HTML_CACHE_TTL = 7 * 24 * 60 * 60
     KOZMIC_ENABLE_EMAIL_NOTIFICATIONS = False  # They are not very useful
                                                # at the moment
     KOZMIC_CACHED_IMAGES_LIMIT = 3
+    KOZMIC_CACHED_IMAGES_DISK_BUDGET = None
+    KOZMIC_GIT_MIRRORS_DIR = None
+    KOZMIC_CONTAINER_POOL_SIZE = 0
+    KOZMIC_CONTAINER_POOL_IDLE_TIMEOUT = 10 * 60
+    KOZMIC_WORKER_QUEUE = None
+    KOZMIC_PROJECT_CONCURRENCY = 4
+    KOZMIC_SCHEDULER_CAPACITY = None
+    KOZMIC_SCHEDULER_JOB_TIMEOUT = 6 * 60 * 60
     KOZMIC_USE_HTTPS_FOR_BADGES = False
 
     SQLALCHEMY_DATABASE_URI = 'mysql+pymysql://kozmic:@127.0.0.1/kozmic'
 
     DOCKER_URL = 'unix://var/run/docker.sock'
     DOCKER_API_VERSION = '1.10'
+    DOCKER_TIMEOUT = 60
+    DOCKER_POOL_SIZE = 10
 
     BROKER_URL = 'redis://{host}:{port}/{db}'.format(
         host=KOZMIC_REDIS_HOST,
@@ -1,4 +1,144 @@
+import os
+import time
+import threading
+
+import docker as _docker
+from docker.unixconn import unixconn
+
 from . import docker
+from .utils import get_redis_client
+
+
+class UnixHTTPConnection(unixconn.UnixHTTPConnection):
+    """A connection that sends the request path it is given.
+
+    :class:`docker.unixconn.unixconn.UnixHTTPConnection` takes the path
+    from the URL its pool has been created for, which ties every pool
+    to a single URL and makes pooling pointless.
+    """
+    def _extract_path(self, url):
+        # requests takes the first component of the socket path of
+        # an ``http+unix://`` URL for the host and the rest of it
+        # for the beginning of the request path
+        socket_path = self.base_url.replace('http+unix://', '', 1)
+        prefix = '/' + socket_path.partition('/')[2]
+        if url.startswith(prefix):
+            url = url[len(prefix):]
+        return url if url.startswith('/') else '/' + url
+
+    def request(self, method, url, **kwargs):
+        super(unixconn.UnixHTTPConnection, self).request(
+            method, self._extract_path(url), **kwargs)
+
+
+class UnixHTTPConnectionPool(unixconn.UnixHTTPConnectionPool):
+    def __init__(self, base_url, timeout=60, maxsize=1):
+        unixconn.connectionpool.HTTPConnectionPool.__init__(
+            self, 'localhost', timeout=timeout, maxsize=maxsize)
+        self.base_url = base_url
+        self.socket_path = base_url
+        self.timeout = timeout
+
+    def _new_conn(self):
+        self.num_connections += 1
+        return UnixHTTPConnection(self.base_url, self.socket_path,
+                                  self.timeout)
+
+
+class PooledUnixAdapter(unixconn.UnixAdapter):
+    """An adapter that keeps a single pool of up to `pool_size` idle
+    keep-alive connections to the Docker socket.
+
+    :class:`docker.unixconn.unixconn.UnixAdapter` creates a new pool
+    (and therefore a new connection) for every request.
+    """
+    def __init__(self, base_url, timeout=60, pool_size=10):
+        super(PooledUnixAdapter, self).__init__(base_url, timeout)
+        self.pool = UnixHTTPConnectionPool(base_url, timeout=timeout,
+                                           maxsize=pool_size)
+
+    def get_connection(self, socket_path, proxies=None):
+        return self.pool
+
+    def close(self):
+        self.pool.close()
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_docker_client(config):
+    """Returns a :class:`docker.Client` configured by `config`.
+
+    The client is created once per process and per configuration and
+    is shared by all the threads of the process. Requests to a Unix socket
+    go through a pool of ``DOCKER_POOL_SIZE`` keep-alive connections.
+    """
+    key = (os.getpid(), config['DOCKER_URL'], config['DOCKER_API_VERSION'],
+           config['DOCKER_TIMEOUT'], config['DOCKER_POOL_SIZE'])
+    client = _clients.get(key)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(key)
+            if client is None:
+                client = _docker.Client(base_url=config['DOCKER_URL'],
+                                        version=config['DOCKER_API_VERSION'],
+                                        timeout=config['DOCKER_TIMEOUT'])
+                if client.base_url.startswith('http+unix://'):
+                    client.mount('http+unix://', PooledUnixAdapter(
+                        client.base_url, timeout=config['DOCKER_TIMEOUT'],
+                        pool_size=config['DOCKER_POOL_SIZE']))
+                # Clients inherited from the parent process
+                # must not be used after fork
+                for client_key in _clients.keys():
+                    if client_key[0] != key[0]:
+                        del _clients[client_key]
+                _clients[key] = client
+    return client
+
+
+def get_docker_pool_stats():
+    """Returns connection reuse counters of Docker clients of
+    the current process: the number of ``requests`` made and
+    the number of ``connections`` opened to serve them.
+    """
+    stats = {'requests': 0, 'connections': 0}
+    pid = os.getpid()
+    for key, client in _clients.items():
+        if key[0] != pid:
+            continue
+        adapter = client.get_adapter(client.base_url)
+        if isinstance(adapter, PooledUnixAdapter):
+            stats['requests'] += adapter.pool.num_requests
+            stats['connections'] += adapter.pool.num_connections
+    return stats
+
+
+#: Redis hash mapping cached images (``repository:tag``) to Unix
+#: timestamps of their last use
+CACHED_IMAGES_LAST_USED_KEY = 'kozmic:cached-images:last-used'
+
+
+def touch_cached_image(image, tag):
+    """Records that `image`:`tag` has just been used, so that
+    :func:`kozmic.builds.commands.clean_dependencies_cache` evicts
+    it after images that have been used less recently.
+    """
+    get_redis_client().hset(CACHED_IMAGES_LAST_USED_KEY,
+                            ':'.join((image, tag)), int(time.time()))
+
+
+def get_cached_images_last_used():
+    """Returns a dictionary mapping cached images (``repository:tag``)
+    to Unix timestamps of their last use.
+    """
+    return dict((repo_tag, int(timestamp)) for repo_tag, timestamp in
+                get_redis_client().hgetall(CACHED_IMAGES_LAST_USED_KEY).items())
+
+
+def forget_cached_image(repo_tag):
+    get_redis_client().hdel(CACHED_IMAGES_LAST_USED_KEY, repo_tag)
 
 
 def does_docker_image_exist(image, tag='latest'):
@@ -0,0 +1,144 @@
+# coding: utf-8
+"""
+kozmic.metrics
+~~~~~~~~~~~~~~
+
+Metrics in the Prometheus text format. Counters and histograms are
+updated by Celery workers and kept in Redis, so that the metrics of all
+the workers are served by any web process.
+
+.. autofunction:: incr
+.. autofunction:: observe
+.. autofunction:: render
+"""
+from .utils import get_redis_client
+
+
+#: Redis hash of counters
+COUNTERS_KEY = 'kozmic:metrics:counters'
+
+#: Upper bounds (in seconds) of histogram buckets
+HISTOGRAM_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600)
+
+COUNTERS = (
+    ('cache_hits', 'Jobs that have reused a kozmic-cache image.'),
+    ('cache_misses', 'Jobs that have run the install script.'),
+    ('log_published_messages',
+     'Messages published to Redis pub/sub channels of job logs.'),
+    ('log_published_lines', 'Job log lines published to Redis.'),
+    ('log_published_bytes', 'Job log bytes published to Redis.'),
+)
+
+HISTOGRAMS = (
+    ('job_duration_seconds', None, 'Durations of finished jobs.'),
+    ('job_phase_duration_seconds', 'phase', 'Durations of job phases.'),
+)
+
+
+def _get_histogram_key(name):
+    """Redis hash of cumulative bucket counts (``<label>|<bound>``)
+    and sums of observed values (``<label>|sum``).
+    """
+    return 'kozmic:metrics:histogram:{}'.format(name)
+
+
+def incr(name, amount=1, redis_client=None):
+    """Increments the counter `name` by `amount`.
+
+    :param redis_client: Redis client or pipeline to use instead of
+                         :func:`kozmic.utils.get_redis_client`
+    """
+    redis_client = redis_client or get_redis_client()
+    redis_client.hincrby(COUNTERS_KEY, name, amount)
+
+
+def observe(name, value, label=''):
+    """Records `value` in the histogram `name`.
+
+    :param label: value of the histogram's label
+    """
+    key = _get_histogram_key(name)
+    pipeline = get_redis_client().pipeline(transaction=False)
+    for bound in HISTOGRAM_BUCKETS:
+        if value <= bound:
+            pipeline.hincrby(key, '{}|{}'.format(label, bound), 1)
+    pipeline.hincrby(key, '{}|+Inf'.format(label), 1)
+    pipeline.hincrbyfloat(key, '{}|sum'.format(label), value)
+    pipeline.execute()
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{{{}}}'.format(','.join(
+        '{}="{}"'.format(name, value.replace('\\', '\\\\').replace('"', '\\"'))
+        for name, value in labels))
+
+
+def _format_sample(name, value, labels=()):
+    return 'kozmic_{}{} {}'.format(name, _format_labels(labels), value)
+
+
+def _format_metric(name, type_, help_, samples):
+    lines = ['# HELP kozmic_{} {}'.format(name, help_),
+             '# TYPE kozmic_{} {}'.format(name, type_)]
+    lines.extend(samples)
+    return lines
+
+
+def _render_histogram(name, label_name, help_, data):
+    by_label = {}
+    for field, value in data.items():
+        label, _, suffix = field.rpartition('|')
+        by_label.setdefault(label, {})[suffix] = value
+
+    samples = []
+    for label in sorted(by_label):
+        values = by_label[label]
+        labels = [(label_name, label)] if label_name else []
+        for bound in HISTOGRAM_BUCKETS + ('+Inf',):
+            samples.append(_format_sample(
+                name + '_bucket', int(values.get(str(bound), 0)),
+                labels + [('le', str(bound))]))
+        samples.append(_format_sample(
+            name + '_sum', float(values.get('sum', 0)), labels))
+        samples.append(_format_sample(
+            name + '_count', int(values.get('+Inf', 0)), labels))
+    return _format_metric(name, 'histogram', help_, samples)
+
+
+def render():
+    """Returns all the metrics in the Prometheus text format."""
+    from .models import get_log_html_cache_stats
+    from .builds import scheduler
+
+    redis_client = get_redis_client()
+    pipeline = redis_client.pipeline(transaction=False)
+    pipeline.hgetall(COUNTERS_KEY)
+    for name, _, _ in HISTOGRAMS:
+        pipeline.hgetall(_get_histogram_key(name))
+    results = pipeline.execute()
+    counters, histograms = results[0], results[1:]
+
+    scheduler_stats = scheduler.get_stats()
+    log_html_cache_stats = get_log_html_cache_stats()
+
+    lines = []
+    lines.extend(_format_metric(
+        'jobs_enqueued', 'gauge', 'Jobs waiting in the scheduler queues.',
+        [_format_sample('jobs_enqueued', scheduler_stats['enqueued'])]))
+    lines.extend(_format_metric(
+        'jobs_running', 'gauge', 'Jobs dispatched to the workers.',
+        [_format_sample('jobs_running', scheduler_stats['running'])]))
+    for name, help_ in COUNTERS:
+        total_name = name + '_total'
+        lines.extend(_format_metric(total_name, 'counter', help_, [
+            _format_sample(total_name, int(counters.get(name, 0)))]))
+    for (name, label_name, help_), data in zip(HISTOGRAMS, histograms):
+        lines.extend(_render_histogram(name, label_name, help_, data))
+    for outcome in ('hits', 'misses'):
+        name = 'log_html_cache_{}_total'.format(outcome)
+        lines.extend(_format_metric(
+            name, 'counter', 'Rendered job log cache {}.'.format(outcome),
+            [_format_sample(name, log_html_cache_stats[outcome])]))
+    return '\n'.join(lines) + '\n'
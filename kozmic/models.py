@@ -3,12 +3,15 @@
 kozmic.models
 ~~~~~~~~~~~~~
 """
+import json
+import pipes
 import itertools
 import datetime
 import collections
 import hashlib
 import os.path
 import logging
+import zlib
 
 import github3
 import sqlalchemy.dialects.mysql
@@ -21,7 +24,8 @@ from werkzeug.utils import cached_property
 from sqlalchemy.ext.declarative import declared_attr
 
 from . import db, mail, perms, docker_utils
-from .utils import JSONEncodedDict
+from .utils import JSONEncodedDict, get_redis_client
+from .builds import get_ansi_to_html_converter, scheduler
 
 
 logger = logging.getLogger(__name__)
@@ -48,6 +52,19 @@ github3.repos.repo.Repository.create_status = create_status
 # /TODO
 
 
+# NOTE: github3.py can only get a recursive tree in two requests
+# (:meth:`github3.repos.repo.Repository.tree` and then
+# :meth:`github3.git.Tree.recurse`)
+def recursive_tree(self, sha):
+    json = None
+    if sha:
+        url = self._build_url('git', 'trees', sha, base_url=self._api)
+        json = self._json(self._get(url, params={'recursive': '1'}), 200)
+    return github3.git.Tree(json, self) if json else None
+
+github3.repos.repo.Repository.recursive_tree = recursive_tree
+
+
 class RepositoryBase(object):
     """A base repository class to be used by :class:`HasRepositories` mixin."""
     id = db.Column(db.Integer, primary_key=True)
@@ -382,6 +399,9 @@ class Project(db.Model):
     gh_https_clone_url = db.Column(db.String(200), nullable=False)
     #: Is the project's repository public?
     is_public = db.Column(db.Boolean, nullable=False)
+    #: Whether a new build cancels unfinished builds of the same ref
+    auto_cancel_builds = db.Column(db.Boolean, nullable=False, default=False,
+                                   server_default='0')
 
     #: Deploy key
     deploy_key = db.relationship(
@@ -511,6 +531,18 @@ class Hook(db.Model):
     #: (for example, "ubuntu" or "aromanovich/ubuntu-kozmic").
     #: Specified docker image is pulled from index.docker.io before build
     docker_image = db.Column(db.String(200), nullable=False)
+    #: Whether to run the install script on top of the most recent
+    #: cached image instead of :attr:`docker_image` when the cache
+    #: is invalidated
+    use_warm_install = db.Column(db.Boolean, nullable=False, default=False,
+                                 server_default='0')
+    #: Build matrix: a list of ``{'docker_image': ..., 'env': {...}}``
+    #: entries. Use :meth:`get_matrix` instead
+    matrix = db.Column(JSONEncodedDict)
+    #: Number of parallel shards the build script of every build matrix
+    #: entry is split into
+    shard_count = db.Column(db.Integer, nullable=False, default=1,
+                            server_default='1')
     #: Project
     project = db.relationship(
         Project, backref=db.backref('hooks', lazy='dynamic', cascade='all'))
@@ -547,6 +579,22 @@ class Hook(db.Model):
             self.gh_id = gh_hook.id
             return True
 
+    def get_matrix(self):
+        """Returns a list of the build matrix entries, dictionaries with
+        ``docker_image``, ``env`` (a dictionary of environment variables
+        to be set for the install and build scripts), ``shard_index``
+        and ``shard_total`` keys. Every hook call runs a job for each
+        entry. A hook without a matrix has :attr:`shard_count` entries
+        with :attr:`docker_image` and no variables.
+        """
+        shard_total = self.shard_count or 1
+        return [{'docker_image': entry.get('docker_image') or self.docker_image,
+                 'env': entry.get('env') or {},
+                 'shard_index': shard_index,
+                 'shard_total': shard_total}
+                for entry in self.matrix or [{}]
+                for shard_index in range(shard_total)]
+
     def delete(self):
         """Deletes the project hook. Returns True if it's corresponding GitHub
         hook is missing or has been successfully deleted; False otherwise.
@@ -570,6 +618,16 @@ class Hook(db.Model):
             return True
 
 
+def format_matrix_entry(entry):
+    """Returns a build matrix entry as a line of its Docker image
+    (if any) and ``NAME=value`` pairs.
+    """
+    parts = [entry['docker_image']] if entry.get('docker_image') else []
+    parts.extend(u'{}={}'.format(name, pipes.quote(value))
+                 for name, value in sorted(entry.get('env', {}).items()))
+    return u' '.join(parts)
+
+
 class TrackedFile(db.Model):
     """Reflecs a :term:`tracked file`."""
     __table_args__ = (
@@ -613,7 +671,7 @@ class Build(db.Model):
     created_at = db.Column(db.DateTime, nullable=False, index=True,
                            default=datetime.datetime.utcnow)
     #: Build status, one of the following strings:
-    #: 'enqueued', 'success', 'pending', 'failure', 'error'
+    #: 'enqueued', 'success', 'pending', 'failure', 'error', 'cancelled'
     status = db.Column(db.String(40), nullable=False)
     #: Project
     project = db.relationship(
@@ -643,7 +701,8 @@ class Build(db.Model):
 
     def set_status(self, status, target_url='', description=''):
         """Sets :attr:`status` and posts it on GitHub."""
-        assert status in ('enqueued', 'success', 'pending', 'failure', 'error')
+        assert status in ('enqueued', 'success', 'pending', 'failure', 'error',
+                          'cancelled')
 
         if self.status == status:
             return
@@ -652,7 +711,8 @@ class Build(db.Model):
         if self.status != 'enqueued':
             self.project.gh.create_status(
                 self.gh_commit_sha,
-                status,
+                # GitHub does not have a state for cancelled builds
+                'error' if status == 'cancelled' else status,
                 target_url=target_url or self.url,
                 description=description,
                 context='Kozmic-CI')
@@ -681,6 +741,26 @@ class Build(db.Model):
                     recipients=recipients)
                 mail.send(message)
 
+    def get_superseded_builds(self):
+        """Returns unfinished builds of the same ref that have been
+        created before this one.
+        """
+        return self.project.builds.filter(
+            Build.gh_commit_ref == self.gh_commit_ref,
+            Build.id < self.id,
+            Build.status.in_(('enqueued', 'pending'))).all()
+
+    def cancel(self, description=''):
+        """Cancels the build: removes its hook calls from the scheduler
+        queue and asks workers to kill containers of its running jobs.
+        """
+        for hook_call in self.hook_calls:
+            scheduler.cancel(hook_call)
+        for job in self.jobs:
+            if not job.is_finished():
+                job.request_cancellation()
+        self.set_status('cancelled', description=description)
+
     @property
     def url(self):
         return flask.url_for(
@@ -716,6 +796,68 @@ class HookCall(db.Model):
         Build, backref=db.backref('hook_calls', lazy='dynamic', cascade='all'))
 
 
+#: How long (in seconds) to keep cache ids memoized by :meth:`Job.get_cache_id`
+CACHE_ID_MEMO_TTL = 30 * 24 * 60 * 60
+
+
+def _get_tracked_hash_parts_from_tree(tree, paths):
+    entries = dict((entry.path, entry) for entry in tree.tree)
+    hash_parts = []
+    for path in paths:
+        entry = entries.get(path)
+        if path == '' or (entry and entry.type == 'tree'):
+            # `path` is a directory. Add all its entries to the hash
+            prefix = path + '/' if path else ''
+            for entry_path in sorted(entries):
+                if (entry_path.startswith(prefix) and
+                        '/' not in entry_path[len(prefix):]):
+                    hash_parts.append(entry_path[len(prefix):] +
+                                      entries[entry_path].sha)
+        elif entry:
+            # `path` is a regular file
+            hash_parts.append(path + entry.sha)
+        else:
+            # `path` does not exist. But it's still necessary to include
+            # it in the hash to be able to detect file removals
+            hash_parts.append(path)
+    return hash_parts
+
+
+def _get_tracked_hash_parts_from_contents(gh, paths, commit_sha):
+    hash_parts = []
+    for path in paths:
+        contents = gh.contents(path, ref=commit_sha)
+        if isinstance(contents, dict):
+            # `contents` represents a directory. Add all its entries
+            # to the hash
+            for file_name in sorted(contents):
+                hash_parts.append(file_name + contents[file_name].sha)
+        elif contents:
+            # `contents` represents a regular file
+            hash_parts.append(path + contents.sha)
+        else:
+            hash_parts.append(path)
+    return hash_parts
+
+
+#: How many :class:`JobLogChunk` s :meth:`Job.iter_log` fetches per query
+LOG_CHUNKS_PER_QUERY = 16
+
+#: Redis hash counting ``hits`` and ``misses`` of :meth:`Job.get_log_html`
+LOG_HTML_CACHE_STATS_KEY = 'kozmic:log-html:stats'
+
+
+def get_log_html_cache_stats():
+    """Returns a dictionary with the numbers of ``hits`` and ``misses``
+    of the rendered job logs cache.
+    """
+    stats = get_redis_client().hgetall(LOG_HTML_CACHE_STATS_KEY)
+    return {
+        'hits': int(stats.get('hits', 0)),
+        'misses': int(stats.get('misses', 0)),
+    }
+
+
 class Job(db.Model):
     """A job that caused by a hook call."""
     id = db.Column(db.Integer, primary_key=True)
@@ -730,63 +872,305 @@ class Job(db.Model):
     finished_at = db.Column(db.DateTime)
     #: Return code
     return_code = db.Column(db.Integer)
-    #: Job log
+    #: Job log of jobs that had finished before logs were stored
+    #: in :class:`JobLogChunk` s. Use :meth:`iter_log` instead
     stdout = db.deferred(db.Column(sqlalchemy.dialects.mysql.MEDIUMBLOB))
     #: uuid of a Celery task that is running a job
     task_uuid = db.Column(db.String(36))
+    #: Whether the job has been cancelled
+    is_cancelled = db.Column(db.Boolean, nullable=False, default=False,
+                             server_default='0')
+    #: List of ``[phase, seconds]`` pairs. Use :meth:`get_timings` instead
+    timings = db.Column(JSONEncodedDict)
+    #: Id of the pulled Docker image of the hook
+    docker_image_id = db.Column(db.String(64))
+    #: Cache id (see :meth:`get_cache_id`) if the hook has an install script
+    cache_id = db.Column(db.String(64))
+    #: Index of the build matrix entry (see :meth:`Hook.get_matrix`)
+    #: the job runs
+    matrix_index = db.Column(db.Integer, nullable=False, default=0,
+                             server_default='0')
     #: :class:`Build`
     build = db.relationship(
         Build, backref=db.backref('jobs', lazy='dynamic', cascade='all'))
     #: :class:`HookCall`
     hook_call = db.relationship('HookCall')
+    #: Job log chunks
+    log_chunks = db.relationship(
+        'JobLogChunk', lazy='dynamic', cascade='all, delete-orphan',
+        passive_deletes=True, order_by='JobLogChunk.number')
 
     def __repr__(self):
         return u'<Job #{0.id}>'.format(self).encode('utf-8')
 
+    def iter_log(self, start=0, end=None):
+        """Yields the job log from byte `start` up to (but not including)
+        byte `end` piece by piece. Only the chunks that overlap the range
+        are fetched, a few at a time, so that the whole log is never
+        loaded into memory.
+        """
+        if end is not None and end <= start:
+            return
+
+        query = self.log_chunks
+        if start:
+            query = query.filter(
+                JobLogChunk.offset + JobLogChunk.size > start)
+        if end is not None:
+            query = query.filter(JobLogChunk.offset < end)
+
+        has_chunks = False
+        last_number = -1
+        while True:
+            chunks = query.filter(JobLogChunk.number > last_number).limit(
+                LOG_CHUNKS_PER_QUERY).all()
+            if not chunks:
+                break
+            has_chunks = True
+            for chunk in chunks:
+                data = chunk.get_data()
+                from_ = max(start - chunk.offset, 0)
+                to = None if end is None else end - chunk.offset
+                yield data[from_:to]
+                last_number = chunk.number
+            if len(chunks) < LOG_CHUNKS_PER_QUERY:
+                break
+
+        if not has_chunks and self.stdout:
+            yield self.stdout[start:end]
+
+    def _iter_log_reversed(self):
+        """Yields (offset, data) pairs of the job log pieces
+        from the last one to the first one.
+        """
+        query = self.log_chunks.order_by(None).order_by(
+            JobLogChunk.number.desc())
+        has_chunks = False
+        last_number = None
+        while True:
+            batch_query = query
+            if last_number is not None:
+                batch_query = query.filter(JobLogChunk.number < last_number)
+            chunks = batch_query.limit(LOG_CHUNKS_PER_QUERY).all()
+            for chunk in chunks:
+                has_chunks = True
+                yield chunk.offset, chunk.get_data()
+                last_number = chunk.number
+            if len(chunks) < LOG_CHUNKS_PER_QUERY:
+                break
+
+        if not has_chunks and self.stdout:
+            yield 0, self.stdout
+
+    def get_log_tail_offset(self, lines):
+        """Returns the offset of the last `lines` lines of the job log.
+        Only the chunks containing them are fetched.
+        """
+        if lines <= 0:
+            return self.get_log_size()
+
+        remaining = lines
+        is_last_piece = True
+        for offset, data in self._iter_log_reversed():
+            if is_last_piece and data.endswith('\n'):
+                # The trailing newline ends the last line
+                # rather than starts a new one
+                data = data[:-1]
+            is_last_piece = False
+            position = len(data)
+            while remaining:
+                position = data.rfind('\n', 0, position)
+                if position == -1:
+                    break
+                remaining -= 1
+            if not remaining:
+                return offset + position + 1
+        return 0
+
+    def get_matrix_entry(self):
+        """Returns the build matrix entry of the job or ``None`` if
+        the hook's matrix does not have it anymore.
+        """
+        matrix = self.hook_call.hook.get_matrix()
+        index = self.matrix_index or 0
+        return matrix[index] if index < len(matrix) else None
+
+    @property
+    def title(self):
+        """The hook title followed by the build matrix entry
+        if the hook has a matrix or shards.
+        """
+        hook = self.hook_call.hook
+        entry = self.get_matrix_entry()
+        if entry is None:
+            return u'{} #{}'.format(hook.title, self.matrix_index + 1)
+        parts = []
+        if hook.matrix:
+            parts.append(format_matrix_entry(entry))
+        if entry['shard_total'] > 1:
+            parts.append(u'shard {}/{}'.format(entry['shard_index'] + 1,
+                                               entry['shard_total']))
+        if not parts:
+            return hook.title
+        return u'{} ({})'.format(hook.title, u', '.join(parts))
+
+    def get_log(self, start=0, end=None):
+        """Returns the job log (or its part) as a string."""
+        return ''.join(self.iter_log(start=start, end=end))
+
+    def get_timings(self):
+        """Returns a list of ``(phase, seconds)`` pairs: wall-clock
+        durations of the job phases in the order they were run.
+        """
+        return [(phase, seconds) for phase, seconds in self.timings or []]
+
+    def set_timings(self, timings):
+        """Stores `timings`, a list of ``(phase, seconds)`` pairs."""
+        self.timings = [[phase, round(seconds, 3)]
+                        for phase, seconds in timings]
+
+    def _iter_log_html(self):
+        """Yields the job log rendered as HTML piece by piece. The log
+        is converted by one converter a few whole lines at a time, so that
+        neither ANSI sequences nor UTF-8 characters are split.
+        """
+        converter = get_ansi_to_html_converter()
+        pending = ''
+        for data in self.iter_log():
+            pending += data
+            position = pending.rfind('\n') + 1
+            if position:
+                yield converter.convert(pending[:position].decode('utf-8'))
+                pending = pending[position:]
+        if pending:
+            yield converter.convert(pending.decode('utf-8'))
+
+    def _get_log_html_key(self):
+        return 'kozmic:log-html:{}'.format(self.id)
+
+    def cache_log_html(self):
+        """Renders the log of the finished job as HTML and stores it
+        in Redis zlib-compressed. Returns the compressed HTML.
+        """
+        assert self.is_finished()
+        compressor = zlib.compressobj()
+        compressed_parts = [compressor.compress(html.encode('utf-8'))
+                            for html in self._iter_log_html()]
+        compressed_parts.append(compressor.flush())
+        compressed_html = ''.join(compressed_parts)
+        get_redis_client().setex(
+            self._get_log_html_key(),
+            flask.current_app.config['KOZMIC_LOG_HTML_CACHE_TTL'],
+            compressed_html)
+        return compressed_html
+
+    def get_log_html(self):
+        """Returns the job log with ANSI sequences translated to HTML.
+
+        Logs of finished jobs never change: they are rendered once
+        by :meth:`cache_log_html` and evicted from the cache if they
+        have not been viewed for ``KOZMIC_LOG_HTML_CACHE_TTL`` seconds.
+        """
+        if not self.is_finished():
+            return u''.join(self._iter_log_html())
+
+        redis_client = get_redis_client()
+        key = self._get_log_html_key()
+        ttl = flask.current_app.config['KOZMIC_LOG_HTML_CACHE_TTL']
+        pipeline = redis_client.pipeline()
+        pipeline.get(key)
+        pipeline.expire(key, ttl)
+        compressed_html, _ = pipeline.execute()
+
+        if compressed_html is not None:
+            redis_client.hincrby(LOG_HTML_CACHE_STATS_KEY, 'hits', 1)
+        else:
+            redis_client.hincrby(LOG_HTML_CACHE_STATS_KEY, 'misses', 1)
+            compressed_html = self.cache_log_html()
+        return zlib.decompress(compressed_html).decode('utf-8')
+
+    def get_log_size(self):
+        """Returns the job log size in bytes."""
+        size = self.log_chunks.with_entities(
+            db.func.sum(JobLogChunk.size)).scalar()
+        if size is None:
+            return len(self.stdout or '')
+        return int(size)
+
     def get_cache_id(self):
         """Returns a string that can be used for tagging a Docker image
         built from the install script.
         A cache id changes whenever the base Docker image, the install
-        script or any of the :term:`tracked files` is changed.
+        script, the environment variables of the build matrix entry
+        or any of the :term:`tracked files` is changed.
+
+        The :term:`tracked files` are looked up in a single recursive
+        listing of the commit tree. Their hashes are memoized in Redis by
+        the tracked paths and the tree SHA, so that other hooks, other
+        entries of the build matrix and restarts of the build (or builds
+        of another commit with the same tree) don't call GitHub API at all.
 
         .. note::
 
             Requires that Docker is running and Docker base image
-            (:attr:`self.hook_call.hook.docker_image`) is pulled.
+            of the build matrix entry is pulled.
         """
         hook = self.hook_call.hook
-        gh = self.build.project.gh
+        entry = self.get_matrix_entry()
         commit_sha = self.build.gh_commit_sha
 
         docker_image_id = docker_utils.get_docker_image_id(
-            *hook.docker_image.rsplit(':'))
+            *entry['docker_image'].rsplit(':'))
         assert docker_image_id
         hash_parts = [docker_image_id, hook.install_script]
+        # Variables are only hashed if there are any,
+        # so that cache ids of hooks without a matrix stay the same
+        hash_parts.extend(u'{}={}'.format(name, value)
+                          for name, value in sorted(entry['env'].items()))
 
+        paths = []
         for tracked_file in hook.tracked_files.order_by(TrackedFile.path):
-            path = tracked_file.path
             # GitHub API wants to see paths relative to the repo directory
             # ("./basic.txt" does not work, whereas "basic.txt" does)
-            path = os.path.relpath(path, start='.')
+            path = os.path.relpath(tracked_file.path, start='.')
             if path == '.':
                 # Special case: os.path.relpath('.', start='.') returns ".",
                 # but GitHub API wants to see "/" or "".
                 path = ''
+            paths.append(path)
+        if not paths:
+            return hashlib.sha256(''.join(hash_parts)).hexdigest()
+
+        redis_client = get_redis_client()
+        memo_key = lambda tree_sha: 'kozmic:tracked-hash:' + hashlib.sha256(
+            '\0'.join(paths + [tree_sha])).hexdigest()
+        commit_tree_key = 'kozmic:commit-tree:' + commit_sha
+
+        tree_sha = redis_client.get(commit_tree_key)
+        if tree_sha:
+            tracked_hash_parts = redis_client.get(memo_key(tree_sha))
+            if tracked_hash_parts:
+                hash_parts.extend(json.loads(tracked_hash_parts))
+                return hashlib.sha256(''.join(hash_parts)).hexdigest()
 
-            contents = gh.contents(path, ref=commit_sha)
-            if isinstance(contents, dict):
-                # `contents` represents a directory. Add all its entries
-                # to the hash
-                for file_path, file_contents in contents.iteritems():
-                    hash_parts.append(file_path + file_contents.sha)
-            elif contents:
-                # `contents` represents a regular file
-                hash_parts.append(path + contents.sha)
-            else:
-                # `path` does not exist. But it's still necessary to include
-                # it in the hash to be able to detect file removals
-                hash_parts.append(path)
-
+        gh = self.build.project.gh
+        # The trees API accepts a commit SHA and resolves it to the
+        # commit's tree
+        tree = gh.recursive_tree(commit_sha)
+        if tree and not tree.to_json().get('truncated'):
+            tracked_hash_parts = _get_tracked_hash_parts_from_tree(tree, paths)
+        else:
+            # The tree is too large to be listed in one response
+            tracked_hash_parts = _get_tracked_hash_parts_from_contents(
+                gh, paths, commit_sha)
+
+        if tree:
+            pipeline = redis_client.pipeline()
+            pipeline.setex(commit_tree_key, CACHE_ID_MEMO_TTL, tree.sha)
+            pipeline.setex(memo_key(tree.sha), CACHE_ID_MEMO_TTL,
+                           json.dumps(tracked_hash_parts))
+            pipeline.execute()
+        hash_parts.extend(tracked_hash_parts)
         return hashlib.sha256(''.join(hash_parts)).hexdigest()
 
     def started(self):
@@ -805,25 +1189,39 @@ class Job(db.Model):
         self.return_code = return_code
         self.finished_at = datetime.datetime.utcnow()
 
+        if self.is_cancelled or self.build.status == 'cancelled':
+            # The build status has been set by :meth:`Build.cancel`
+            return
+
         if return_code != 0:
             description = (
                 'Kozmic build #{0} has failed '
                 'because of the "{1}" job'.format(
-                    self.build.number,
-                    self.hook_call.hook.title))
+                    self.build.number, self.title))
             self.build.set_status('failure', description=description)
             return
 
-        jobs = self.build.jobs
+        jobs = self.build.jobs.all()
         all_other_jobs_finished = all(job.finished_at for job in jobs
                                       if job.id != self.id)
         all_other_jobs_succeeded = all(job.return_code == 0 for job in jobs
                                        if job.id != self.id)
-        if all_other_jobs_finished and all_other_jobs_succeeded:
-            description = 'Kozmic build #{0} has passed'.format(self.build.number)
-            self.build.set_status('success', description=description)
+        if not (all_other_jobs_finished and all_other_jobs_succeeded):
             return
 
+        # Every hook call runs a job for each entry of its build matrix,
+        # some of them may have not been started yet
+        started = set((job.hook_call_id, job.matrix_index) for job in jobs)
+        for hook_call in self.build.hook_calls:
+            if hook_call.hook is None:
+                continue
+            for index in range(len(hook_call.hook.get_matrix())):
+                if (hook_call.id, index) not in started:
+                    return
+
+        description = 'Kozmic build #{0} has passed'.format(self.build.number)
+        self.build.set_status('success', description=description)
+
     @property
     def tailer_url(self):
         """URL of a websocket that streams a job log in realtime."""
@@ -836,21 +1234,57 @@ class Job(db.Model):
         return flask.url_for('.job', project_id=self.build.project.id,
                              build_id=self.build.id, id=self.id)
 
+    def get_cancellation_key(self):
+        """Redis key that is set when the job has to be cancelled."""
+        return 'kozmic:job-cancelled:{}'.format(self.id)
+
+    def request_cancellation(self):
+        """Asks the worker running the job to kill its container."""
+        get_redis_client().setex(self.get_cancellation_key(), 24 * 60 * 60, 1)
+
     def is_finished(self):
         """Is the job finished?"""
-        return self.status in ('success', 'failure', 'error')
+        return self.status in ('success', 'failure', 'error', 'cancelled')
+
+    def can_be_restarted(self):
+        """Can the job be restarted? Jobs of cancelled builds
+        are skipped and therefore can not be restarted.
+        """
+        return self.is_finished() and self.build.status != 'cancelled'
 
     @property
     def status(self):
         """One of the following values: 'enqueued', 'success', 'pending',
-        'failure', 'error'.
+        'failure', 'error', 'cancelled'.
         """
         if not self.started_at:
             return 'enqueued'
         elif self.started_at and not self.finished_at:
             return 'pending'
         elif self.finished_at:
-            if self.return_code == 0:
+            if self.is_cancelled:
+                return 'cancelled'
+            elif self.return_code == 0:
                 return 'success'
             else:
                 return 'failure'
+
+
+class JobLogChunk(db.Model):
+    """A zlib-compressed piece of a job log. Chunks are appended
+    while the job is running by :class:`kozmic.builds.tasks.JobLogWriter`.
+    """
+    job_id = db.Column(db.Integer, db.ForeignKey('job.id', ondelete='CASCADE'),
+                       primary_key=True)
+    #: Chunk number (within a job), starting from 0
+    number = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    #: Position of the first byte of the chunk within the log
+    offset = db.Column(db.BigInteger, nullable=False)
+    #: Size of the uncompressed data
+    size = db.Column(db.Integer, nullable=False)
+    #: Compressed data
+    data = db.Column(sqlalchemy.dialects.mysql.MEDIUMBLOB, nullable=False)
+
+    def get_data(self):
+        """Returns the uncompressed data."""
+        return zlib.decompress(self.data)
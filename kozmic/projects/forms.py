@@ -1,10 +1,12 @@
 # coding: utf-8
+import re
+import shlex
 import os.path
 
 import wtforms
 from flask.ext import wtf
 
-from kozmic.models import TrackedFile
+from kozmic.models import TrackedFile, format_matrix_entry
 
 
 required = wtforms.validators.Required()
@@ -33,6 +35,44 @@ class TrackedFilesField(wtforms.TextAreaField):
         setattr(obj, name, self.data)
 
 
+class MatrixField(wtforms.TextAreaField):
+    """A build matrix, one entry per line: a Docker image (the hook's
+    one if omitted) followed by shell-quoted ``NAME=value`` pairs.
+    """
+    env_name_re = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+    def _value(self):
+        if self.raw_data:
+            return self.raw_data[0]
+        return u'\n'.join(format_matrix_entry(entry)
+                          for entry in self.data or [])
+
+    def process_formdata(self, valuelist):
+        assert len(valuelist) == 1
+        matrix = []
+        for line in valuelist[0].splitlines():
+            try:
+                # shlex does not support unicode in Python 2
+                parts = [part.decode('utf-8') for part in
+                         shlex.split(line.encode('utf-8'))]
+            except ValueError as e:
+                raise ValueError(u'"{}": {}.'.format(line, e))
+            if not parts:
+                continue
+            entry = {'docker_image': None, 'env': {}}
+            if '=' not in parts[0]:
+                entry['docker_image'] = parts.pop(0)
+            for part in parts:
+                name, _, value = part.partition('=')
+                if not self.env_name_re.match(name):
+                    raise ValueError(
+                        u'"{}" is not a valid environment variable '
+                        u'assignment.'.format(part))
+                entry['env'][name] = value
+            matrix.append(entry)
+        self.data = matrix or None
+
+
 class UnixEndingsTextAreaField(wtforms.TextAreaField):
     def process_formdata(self, valuelist):
         valuelist = ['\n'.join(value.splitlines()) for value in valuelist]
@@ -45,6 +85,12 @@ class HookForm(wtf.Form):
         'Install script', [optional])
     tracked_files = TrackedFilesField(
         'Tracked files', [optional])
+    use_warm_install = wtforms.BooleanField(
+        'Run the install script on top of the previous cache image')
+    matrix = MatrixField(
+        'Build matrix', [optional])
+    shard_count = wtforms.IntegerField(
+        'Shards', [wtforms.validators.NumberRange(1, 32)], default=1)
     build_script = UnixEndingsTextAreaField(
         'Build script *', [required],
         default='#!/bin/bash\n\necho "It works!"')
@@ -54,6 +100,12 @@ class HookForm(wtf.Form):
     submit = wtforms.SubmitField('Save')
 
 
+class ProjectSettingsForm(wtf.Form):
+    auto_cancel_builds = wtforms.BooleanField(
+        'Cancel unfinished builds of a branch when a new commit is pushed to it')
+    submit = wtforms.SubmitField('Save')
+
+
 class MemberForm(wtf.Form):
     gh_login = wtforms.TextField('User\'s GitHub login', [required])
     is_manager = wtforms.BooleanField(
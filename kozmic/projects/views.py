@@ -1,14 +1,16 @@
 import logging
 
 from flask import (Response, current_app, render_template, redirect,
-                   flash, request, url_for)
+                   flash, request, url_for, stream_with_context)
 from flask.ext.login import current_user
+from werkzeug.http import is_resource_modified, quote_etag, http_date
 
 from . import bp
-from .forms import HookForm, MemberForm
+from .forms import HookForm, MemberForm, ProjectSettingsForm
 from kozmic import db, perms
 from kozmic.models import (MISSING_ID, Project, User, Membership, Hook,
                            Build, Job)
+from kozmic.builds import scheduler
 from kozmic.builds.tasks import restart_job
 
 
@@ -94,13 +96,15 @@ def build(project_id, id):
         build = project.builds.filter_by(id=build_id).first_or_404()
 
     job = build.jobs.first()  # TODO Show first not finished job
+    queue_position = scheduler.get_queue_position(build) if not job else None
 
     return render_template(
         'projects/job.html',
         is_build_latest=(id == 'latest'),
         project=project,
         build=build,
-        job=job)
+        job=job,
+        queue_position=queue_position)
 
 
 @bp.route('/<int:project_id>/builds/<int:build_id>/jobs/<int:id>/')
@@ -118,10 +122,45 @@ def job(project_id, build_id, id):
 
 @bp.route('/<int:project_id>/jobs/<int:id>/log/')
 def job_log(project_id, id):
+    """Streams the job log as plain text.
+
+    Supports a single byte range ``Range`` header (other ranges are
+    ignored) and ``?tail=N`` parameter that returns the last N lines.
+    Logs of finished jobs never change and are served with ``ETag`` and
+    ``Last-Modified`` headers.
+    """
     project = get_project(project_id, for_management=False)
     job = project.builds.join(Job).filter(
         Job.id == id).with_entities(Job).first_or_404()
-    return Response(job.stdout, mimetype='text/plain')
+
+    size = job.get_log_size()
+    headers = {'Accept-Ranges': 'bytes'}
+    if job.is_finished():
+        etag = '{}-{}'.format(job.id, size)
+        headers['ETag'] = quote_etag(etag)
+        headers['Last-Modified'] = http_date(job.finished_at)
+        if not is_resource_modified(request.environ, etag=etag,
+                                    last_modified=job.finished_at):
+            return Response(status=304, headers=headers)
+
+    status = 200
+    start, end = 0, size
+    tail = request.args.get('tail', type=int)
+    if tail is not None:
+        start = job.get_log_tail_offset(tail)
+    elif (request.range and request.range.units == 'bytes' and
+            len(request.range.ranges) == 1):
+        content_range = request.range.make_content_range(size)
+        if content_range is None:
+            headers['Content-Range'] = 'bytes */{}'.format(size)
+            return Response(status=416, headers=headers)
+        start, end = content_range.start, content_range.stop
+        status = 206
+        headers['Content-Range'] = content_range.to_header()
+
+    headers['Content-Length'] = str(end - start)
+    return Response(stream_with_context(job.iter_log(start=start, end=end)),
+                    status=status, headers=headers, mimetype='text/plain')
 
 
 @bp.route('/<int:project_id>/job/<int:id>/restart/')
@@ -129,6 +168,10 @@ def job_restart(project_id, id):
     project = get_project(project_id, for_management=True)
     job = project.builds.join(Job).filter(
         Job.id == id).with_entities(Job).first_or_404()
+    if not job.can_be_restarted():
+        flash('Jobs of cancelled builds can not be restarted.', 'warning')
+        return redirect(url_for('.build', project_id=project.id,
+                                id=job.build.id))
     restart_job.delay(job.id)
     job.build.set_status('enqueued')
     db.session.commit()
@@ -158,7 +201,19 @@ def settings(id):
         is_current_user_a_manager=perms.manage_project(id).can(),
         can_current_user_delete_a_project=perms.delete_project(id).can(),
         example_badge_href=example_badge_href,
-        example_badge_src=example_badge_src)
+        example_badge_src=example_badge_src,
+        settings_form=ProjectSettingsForm(obj=project))
+
+
+@bp.route('/<int:id>/settings/builds/', methods=('POST',))
+def update_settings(id):
+    project = get_project(id, for_management=True)
+
+    form = ProjectSettingsForm(request.form)
+    if form.validate_on_submit():
+        form.populate_obj(project)
+        db.session.commit()
+    return redirect(url_for('.settings', id=id))
 
 
 @bp.route('/<int:project_id>/hooks/ensure/', methods=('POST',))
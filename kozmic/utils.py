@@ -3,7 +3,10 @@ kozmic.utils
 ~~~~~~~~~~~~
 """
 import json
+import threading
 
+import redis
+from flask import current_app
 from sqlalchemy import types
 
 
@@ -20,3 +23,26 @@ class JSONEncodedDict(types.TypeDecorator):
         if value is not None:
             value = json.loads(value)
         return value
+
+
+_redis_clients = {}
+_redis_clients_lock = threading.Lock()
+
+
+def get_redis_client():
+    """Returns a :class:`redis.StrictRedis` client configured by the current
+    application. Clients (and their connection pools) are shared between
+    the threads of a process.
+    """
+    config = current_app.config
+    key = (config['KOZMIC_REDIS_HOST'], config['KOZMIC_REDIS_PORT'],
+           config['KOZMIC_REDIS_DATABASE'])
+    client = _redis_clients.get(key)
+    if client is None:
+        with _redis_clients_lock:
+            client = _redis_clients.get(key)
+            if client is None:
+                host, port, db = key
+                client = redis.StrictRedis(host=host, port=port, db=db)
+                _redis_clients[key] = client
+    return client
@@ -0,0 +1,26 @@
+"""add project.auto_cancel_builds and job.is_cancelled
+
+Revision ID: 1c9a6b2e8f47
+Revises: 4a7c3e9d5b21
+Create Date: 2014-06-09 11:20:05.613309
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '1c9a6b2e8f47'
+down_revision = '4a7c3e9d5b21'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('project', sa.Column('auto_cancel_builds', sa.Boolean(),
+                                       nullable=False, server_default='0'))
+    op.add_column('job', sa.Column('is_cancelled', sa.Boolean(),
+                                   nullable=False, server_default='0'))
+
+
+def downgrade():
+    op.drop_column('job', 'is_cancelled')
+    op.drop_column('project', 'auto_cancel_builds')
@@ -0,0 +1,23 @@
+"""add hook.use_warm_install
+
+Revision ID: 2f0d6e4a1c3b
+Revises: 375111a5fd54
+Create Date: 2014-06-02 12:41:17.503412
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '2f0d6e4a1c3b'
+down_revision = '375111a5fd54'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('hook', sa.Column('use_warm_install', sa.Boolean(),
+                                    nullable=False, server_default='0'))
+
+
+def downgrade():
+    op.drop_column('hook', 'use_warm_install')
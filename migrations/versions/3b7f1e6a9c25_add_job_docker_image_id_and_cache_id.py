@@ -0,0 +1,26 @@
+"""add job.docker_image_id and job.cache_id
+
+Revision ID: 3b7f1e6a9c25
+Revises: 5e8d2c7b4a19
+Create Date: 2014-06-18 12:05:47.613920
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3b7f1e6a9c25'
+down_revision = '5e8d2c7b4a19'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('job', sa.Column('docker_image_id', sa.String(length=64),
+                                   nullable=True))
+    op.add_column('job', sa.Column('cache_id', sa.String(length=64),
+                                   nullable=True))
+
+
+def downgrade():
+    op.drop_column('job', 'cache_id')
+    op.drop_column('job', 'docker_image_id')
@@ -0,0 +1,31 @@
+"""add job_log_chunk
+
+Revision ID: 4a7c3e9d5b21
+Revises: 2f0d6e4a1c3b
+Create Date: 2014-06-05 16:03:48.127715
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4a7c3e9d5b21'
+down_revision = '2f0d6e4a1c3b'
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import mysql
+
+
+def upgrade():
+    op.create_table('job_log_chunk',
+    sa.Column('job_id', sa.Integer(), nullable=False),
+    sa.Column('number', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('offset', sa.BigInteger(), nullable=False),
+    sa.Column('size', sa.Integer(), nullable=False),
+    sa.Column('data', mysql.MEDIUMBLOB(), nullable=False),
+    sa.ForeignKeyConstraint(['job_id'], ['job.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('job_id', 'number')
+    )
+
+
+def downgrade():
+    op.drop_table('job_log_chunk')
@@ -0,0 +1,22 @@
+"""add job.timings
+
+Revision ID: 5e8d2c7b4a19
+Revises: 1c9a6b2e8f47
+Create Date: 2014-06-12 16:42:31.204518
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5e8d2c7b4a19'
+down_revision = '1c9a6b2e8f47'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('job', sa.Column('timings', sa.LargeBinary(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('job', 'timings')
@@ -0,0 +1,25 @@
+"""add hook.matrix and job.matrix_index
+
+Revision ID: 6d2a9f4c8e13
+Revises: 3b7f1e6a9c25
+Create Date: 2014-06-23 15:20:08.731642
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '6d2a9f4c8e13'
+down_revision = '3b7f1e6a9c25'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('hook', sa.Column('matrix', sa.LargeBinary(), nullable=True))
+    op.add_column('job', sa.Column('matrix_index', sa.Integer(),
+                                   nullable=False, server_default='0'))
+
+
+def downgrade():
+    op.drop_column('job', 'matrix_index')
+    op.drop_column('hook', 'matrix')
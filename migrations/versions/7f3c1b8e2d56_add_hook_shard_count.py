@@ -0,0 +1,23 @@
+"""add hook.shard_count
+
+Revision ID: 7f3c1b8e2d56
+Revises: 6d2a9f4c8e13
+Create Date: 2014-06-27 11:47:52.380915
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7f3c1b8e2d56'
+down_revision = '6d2a9f4c8e13'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('hook', sa.Column('shard_count', sa.Integer(),
+                                    nullable=False, server_default='1'))
+
+
+def downgrade():
+    op.drop_column('hook', 'shard_count')
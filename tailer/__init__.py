@@ -4,9 +4,9 @@ Tailer
 An WSGI-application that watches a Redis pub/sub channel and streams it's
 content to a websocket.
 
-The application exposes only one endpoint: `/<channel-name>/`.
-
-It does the following:
+The application exposes two endpoints. `/metrics` serves metrics of
+the process in the Prometheus text format. `/<channel-name>/` does
+the following:
 
 1. Retrieves a list of strings stored at the `channel-name` *key* and sends
    it to the websocket;
@@ -46,14 +46,38 @@ else:
 redis = redis.StrictRedis(host=redis_host, port=redis_port, db=redis_db)
 
 
+#: Metrics of the process: name -> [type, help, value]
+metrics = {
+    'clients': ['gauge', 'Connected websocket clients.', 0],
+    'connections_total': ['counter', 'Accepted websocket connections.', 0],
+    'messages_sent_total': ['counter', 'Messages sent to websockets.', 0],
+}
+
+
 def send_message(type, content):
     uwsgi.websocket_send(json.dumps({
         'type': type,
         'content': content,
     }))
+    metrics['messages_sent_total'][2] += 1
+
+
+def render_metrics():
+    lines = []
+    for name, (type_, help_, value) in sorted(metrics.items()):
+        name = 'kozmic_tailer_' + name
+        lines.append('# HELP {} {}'.format(name, help_))
+        lines.append('# TYPE {} {}'.format(name, type_))
+        lines.append('{} {}'.format(name, value))
+    return '\n'.join(lines) + '\n'
 
 
 def app(environ, start_response):
+    if environ['PATH_INFO'] == '/metrics':
+        start_response('200 OK',
+                       [('Content-Type', 'text/plain; version=0.0.4')])
+        return [render_metrics()]
+
     match = re.match('/(?P<job_id>.+)/', environ['PATH_INFO'])
     if not match:
         start_response('404', [('Content-Type', 'text/plain')])
@@ -61,7 +85,16 @@ def app(environ, start_response):
 
     uwsgi.websocket_handshake(environ['HTTP_SEC_WEBSOCKET_KEY'],
                               environ.get('HTTP_ORIGIN', ''))
-    
+    metrics['connections_total'][2] += 1
+    metrics['clients'][2] += 1
+    try:
+        stream(job_id)
+    finally:
+        metrics['clients'][2] -= 1
+    return ''
+
+
+def stream(job_id):
     # Emit the backlog of messages
     lines = redis.lrange(job_id, 0, -1)
     send_message('message', ''.join(lines))
@@ -97,4 +130,3 @@ def app(environ, start_response):
             if not redis.exists(job_id):
                 send_message('status', 'finished')
                 break
-    return ''
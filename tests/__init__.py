@@ -7,6 +7,7 @@ from alembic.command import upgrade as alembic_upgrade
 from flask.ext.webtest import TestApp, get_scopefunc
 
 from kozmic import create_app, db
+from kozmic.utils import get_redis_client
 from . import factories
 
 
@@ -83,6 +84,7 @@ class TestCase(WebTestMixin, SQLAlchemyMixin, SQLAlchemyFixtureMixin):
         self.setup_app_and_ctx()
         self.drop_database()
         self.create_database()
+        get_redis_client().flushdb()
         factories.setup(self.db.session)
         self.load_fixtures()
 
@@ -38,7 +38,7 @@ class TestDoJob(TestCase):
                            'echo "installed!"',
             build_script='cat /hello/readme.txt && echo "YEAH"')
 
-    def _do_job(self, hook_call):
+    def _do_job(self, hook_call, cache_id='qwerty'):
         @contextlib.contextmanager
         def create_temp_dir():
             working_dir = tempfile.mktemp()
@@ -49,7 +49,7 @@ class TestDoJob(TestCase):
         with SessionScope(self.db):
             with mock.patch.object(Build, 'set_status'), \
                  mock.patch.object(DeployKey, 'ensure') as ensure_deploy_key_mock, \
-                 mock.patch.object(Job, 'get_cache_id', return_value='qwerty'), \
+                 mock.patch.object(Job, 'get_cache_id', return_value=cache_id), \
                  mock.patch('kozmic.builds.tasks.create_temp_dir', create_temp_dir):
                 kozmic.builds.tasks.do_job(hook_call_id=hook_call.id)
         self.db.session.rollback()
@@ -59,10 +59,8 @@ class TestDoJob(TestCase):
 
         return Job.query.filter_by(hook_call=hook_call).first()
 
-    def test_private_project(self):
-        cache_id = 'qwerty'
+    def _remove_cached_image(self, cache_id):
         cached_image = 'kozmic-cache/{}'.format(cache_id)
-
         try:
             for image_data in docker.images(cached_image):
                 for repo_tag in image_data['RepoTags']:
@@ -72,6 +70,10 @@ class TestDoJob(TestCase):
         except:
             pass
         assert not docker.images(cached_image)
+        return cached_image
+
+    def test_private_project(self):
+        cached_image = self._remove_cached_image('qwerty')
 
         build = factories.BuildFactory.create(
             project=self.project,
@@ -82,9 +84,10 @@ class TestDoJob(TestCase):
 
         job = self._do_job(hook_call)
         assert job.return_code == 0
-        assert job.stdout == (
+        assert job.get_log() == (
             'Pulling "{}" Docker image...\n'
-             'installed!\nit works\nYEAH\n'.format(self.hook.docker_image))
+            'Running install script (cold install)...\n'
+            'installed!\nit works\nYEAH\n'.format(self.hook.docker_image))
         assert docker.images(cached_image)
 
         build = factories.BuildFactory.create(
@@ -96,12 +99,55 @@ class TestDoJob(TestCase):
 
         job = self._do_job(hook_call)
         assert job.return_code == 0
-        assert job.stdout == (
+        assert job.get_log() == (
             'Pulling "{}" Docker image...\n'
-            'Skipping install script as tracked files did not change...\n'
+            'Skipping install script as tracked files did not change '
+            '(cache hit)...\n'
             'it works\n'
             'YEAH\n'.format(self.hook.docker_image))
 
+    def test_warm_install(self):
+        self.hook.use_warm_install = True
+        self.hook.install_script = (
+            '#!/bin/bash\n'
+            'if [ -f /hello/readme.txt ]; then echo "upgraded!"; exit 0; fi\n'
+            'sudo su -c "mkdir /hello/ && echo \\"it works\\" > /hello/readme.txt"\n'
+            'echo "installed!"')
+        self.db.session.commit()
+        # warm-2 is built on top of warm-1 and must be removed first
+        self._remove_cached_image('warm-2')
+        self._remove_cached_image('warm-1')
+
+        build = factories.BuildFactory.create(
+            project=self.project,
+            gh_commit_sha=self.prev_head_sha)
+        hook_call = factories.HookCallFactory.create(
+            hook=self.hook,
+            build=build)
+        job = self._do_job(hook_call, cache_id='warm-1')
+        assert job.return_code == 0
+        assert job.get_log() == (
+            'Pulling "{}" Docker image...\n'
+            'Running install script (cold install)...\n'
+            'installed!\nit works\nYEAH\n'.format(self.hook.docker_image))
+
+        # Tracked files have changed: the install script
+        # runs on top of the previous cached image
+        build = factories.BuildFactory.create(
+            project=self.project,
+            gh_commit_sha=self.head_sha)
+        hook_call = factories.HookCallFactory.create(
+            hook=self.hook,
+            build=build)
+        job = self._do_job(hook_call, cache_id='warm-2')
+        assert job.return_code == 0
+        assert job.get_log() == (
+            'Pulling "{}" Docker image...\n'
+            'Running install script on top of kozmic-cache/warm-1:{} '
+            '(warm install)...\n'
+            'upgraded!\nit works\nYEAH\n'.format(self.hook.docker_image,
+                                                 self.project.id))
+
     def test_public_project(self):
         self.hook.install_script = ''
         self.hook.build_script = 'echo Hello!'
@@ -118,7 +164,7 @@ class TestDoJob(TestCase):
 
         job = self._do_job(hook_call)
         assert job.return_code == 0
-        assert job.stdout == (
+        assert job.get_log() == (
             'Pulling "{}" Docker image...\n'
             'Hello!\n'.format(self.hook.docker_image))
 
@@ -10,6 +10,9 @@ import github3.git
 from flask import url_for
 
 from kozmic.models import User, DeployKey, Project, Hook
+from kozmic.builds import scheduler
+from kozmic.builds.tasks import JobLogWriter
+from kozmic.utils import get_redis_client
 from . import TestCase, func_fixtures as fixtures
 from . import factories, unit_tests
 
@@ -428,6 +431,44 @@ class TestHooksManagement(TestCase):
             'Pumpurum.txt',
         }
 
+    def test_manager_can_change_build_matrix_in_hook_settings(self):
+        """Manager can change the build matrix."""
+        hook = factories.HookFactory.create(project=self.project)
+        self.login(user_id=self.user.id)
+        settings_page = self.get_project_settings_page(self.project)
+        link_id = 'edit-hook-{}'.format(hook.id)
+
+        hook_form = settings_page.click(linkid=link_id).forms['hook-form']
+        assert hook_form['matrix'].value == ''
+        hook_form['matrix'] = ('python:2.7\r\n'
+                               '\r\n'
+                               'python:3.3 DB=mysql OPTS="-v -x"\r\n'
+                               'DB=postgresql')
+        hook_form.submit()
+
+        assert hook.matrix == [
+            {'docker_image': 'python:2.7', 'env': {}},
+            {'docker_image': 'python:3.3',
+             'env': {'DB': 'mysql', 'OPTS': '-v -x'}},
+            {'docker_image': None, 'env': {'DB': 'postgresql'}},
+        ]
+        assert [entry['docker_image'] for entry in hook.get_matrix()] == [
+            'python:2.7', 'python:3.3', hook.docker_image]
+
+        hook_form = settings_page.click(linkid=link_id).forms['hook-form']
+        assert hook_form['matrix'].value.splitlines() == [
+            'python:2.7',
+            "python:3.3 DB=mysql OPTS='-v -x'",
+            'DB=postgresql',
+        ]
+        hook_form['matrix'] = 'python:2.7 2DB=mysql'
+        assert 'is not a valid environment variable' in hook_form.submit()
+
+        hook_form['matrix'] = ''
+        hook_form.submit()
+        assert hook.matrix is None
+        assert len(hook.get_matrix()) == 1
+
 
 class TestMembersManagement(TestCase):
     def setup_method(self, method):
@@ -583,6 +624,52 @@ class TestGitHubHooks(TestCase):
         assert mock.call(hook_call_id=hook_call_2.id) in do_job_mock.delay.call_args_list
 
 
+    def test_auto_cancel_superseded_builds(self):
+        commit_data = fixtures.COMMIT_47fe2_DATA
+        gh_repo_mock = self._create_gh_repo_mock(commit_data)
+        self.project.auto_cancel_builds = True
+        self.db.session.commit()
+        ref = fixtures.PULL_REQUEST_HOOK_CALL_DATA['pull_request']['head']['ref']
+
+        enqueued_build = factories.BuildFactory.create(
+            project=self.project, gh_commit_ref=ref, status='enqueued')
+        enqueued_hook_call = factories.HookCallFactory.create(
+            hook=self.hook_1, build=enqueued_build)
+        pending_build = factories.BuildFactory.create(
+            project=self.project, gh_commit_ref=ref, status='pending')
+        pending_job = factories.JobFactory.create(
+            build=pending_build,
+            hook_call=factories.HookCallFactory.create(
+                hook=self.hook_1, build=pending_build),
+            started_at=dt.datetime.utcnow())
+        other_build = factories.BuildFactory.create(
+            project=self.project, gh_commit_ref='other', status='enqueued')
+
+        with mock.patch.object(Project, 'gh', gh_repo_mock), \
+             mock.patch('kozmic.builds.tasks.do_job') as do_job_mock:
+            self.app.config['KOZMIC_PROJECT_CONCURRENCY'] = 0
+            scheduler.enqueue(enqueued_hook_call)
+            self.app.config['KOZMIC_PROJECT_CONCURRENCY'] = 1
+            self.w.post_json(
+                url_for('builds.hook', id=self.hook_1.id, _external=True),
+                fixtures.PULL_REQUEST_HOOK_CALL_DATA)
+
+        build = self.project.builds.filter_by(
+            gh_commit_sha=commit_data['sha']).first()
+        hook_call = self.hook_1.calls.filter_by(build=build).first()
+        do_job_mock.delay.assert_called_once_with(hook_call_id=hook_call.id)
+
+        assert enqueued_build.status == 'cancelled'
+        assert pending_build.status == 'cancelled'
+        assert other_build.status == 'enqueued'
+        assert get_redis_client().exists(pending_job.get_cancellation_key())
+        gh_repo_mock.create_status.assert_any_call(
+            pending_build.gh_commit_sha, 'error',
+            target_url=mock.ANY,
+            description='Kozmic build #{0} has been superseded by '
+                        '#{1}'.format(pending_build.number, build.number),
+            context='Kozmic-CI')
+
     def test_skip_build_if_commit_contains_ci_skip(self):
         for skip_pattern in self.skip_patters:
             commit_data = fixtures.COMMIT_47fe2_DATA.copy()
@@ -652,6 +739,15 @@ class TestBadges(TestCase):
         assert r.location == 'https://kozmic.test/static/img/badges/failure.png'
 
 
+class TestMetrics(TestCase):
+    def test_metrics(self):
+        r = self.w.get('/metrics')
+        assert r.content_type == 'text/plain'
+        assert 'kozmic_jobs_running 0' in r.body.splitlines()
+        # A web process has no Docker connections of its own to report
+        assert 'kozmic_docker_requests_total' not in r.body
+
+
 class TestBuilds(TestCase):
     def setup_method(self, method):
         TestCase.setup_method(self, method)
@@ -669,12 +765,15 @@ class TestBuilds(TestCase):
             hook_call=self.hook_call,
             started_at=dt.datetime.utcnow() - dt.timedelta(minutes=2),
             finished_at=dt.datetime.utcnow(),
-            stdout='[4mHello![24m')
+            stdout='[4mHello![24m',
+            timings=[['docker pull', 1.5], ['build script', 10.25]])
 
         self.login(user_id=self.user.id)
         r = self.w.get(url_for('projects.build', project_id=self.project.id,
                                id=self.build.id))
         assert '<span class="ansi4">Hello!</span>' in r
+        assert 'Build script' in r
+        assert '10.25 s' in r
 
     def test_restart(self):
         job = factories.JobFactory.create(
@@ -694,3 +793,63 @@ class TestBuilds(TestCase):
             r.click('Restart').follow()
         restart_job_mock.delay.assert_called_once_with(job.id)
         assert job.build.status == 'enqueued'
+
+        # Jobs of cancelled builds are skipped and can not be restarted
+        job.build.status = 'cancelled'
+        self.db.session.commit()
+        url = url_for('projects.job_restart', project_id=self.project.id,
+                      id=job.id)
+        r = self.w.get(url_for('projects.build', project_id=self.project.id,
+                               id=self.build.id))
+        assert url not in r
+        with mock.patch('kozmic.projects.views.restart_job') as restart_job_mock:
+            self.w.get(url).follow()
+        assert not restart_job_mock.delay.called
+        assert job.build.status == 'cancelled'
+
+    def test_job_log(self):
+        job = factories.JobFactory.create(
+            build=self.build,
+            hook_call=self.hook_call,
+            started_at=dt.datetime.utcnow() - dt.timedelta(minutes=2))
+        log_writer = JobLogWriter(self.db.engine, job.id, chunk_size=4)
+        log_writer.write('one\ntwo\nthree\nfour\n')
+        log_writer.flush()
+
+        self.login(user_id=self.user.id)
+        url = url_for('projects.job_log', project_id=self.project.id,
+                      id=job.id)
+
+        r = self.w.get(url)
+        assert r.body == 'one\ntwo\nthree\nfour\n'
+        assert r.headers['Accept-Ranges'] == 'bytes'
+        # The job is still running
+        assert 'ETag' not in r.headers
+
+        r = self.w.get(url, {'tail': 2})
+        assert r.body == 'three\nfour\n'
+        r = self.w.get(url, {'tail': 10})
+        assert r.body == 'one\ntwo\nthree\nfour\n'
+        r = self.w.get(url, {'tail': 0})
+        assert r.body == ''
+
+        r = self.w.get(url, headers={'Range': 'bytes=4-9'}, status=206)
+        assert r.body == 'two\nth'
+        assert r.headers['Content-Range'] == 'bytes 4-9/19'
+        r = self.w.get(url, headers={'Range': 'bytes=-5'}, status=206)
+        assert r.body == 'four\n'
+        r = self.w.get(url, headers={'Range': 'bytes=100-'}, status=416)
+        assert r.headers['Content-Range'] == 'bytes */19'
+        # Multiple ranges are not supported and the header is ignored
+        r = self.w.get(url, headers={'Range': 'bytes=0-2,4-6'}, status=200)
+        assert r.body == 'one\ntwo\nthree\nfour\n'
+        assert 'Content-Range' not in r.headers
+
+        job.finished(0)
+        self.db.session.commit()
+        r = self.w.get(url)
+        etag = r.headers['ETag']
+        last_modified = r.headers['Last-Modified']
+        self.w.get(url, headers={'If-None-Match': etag}, status=304)
+        self.w.get(url, headers={'If-Modified-Since': last_modified},
+                   status=304)
@@ -1,12 +1,18 @@
 # coding: utf-8
 import os
+import stat
 import time
+import shutil
 import unittest
 import tempfile
 import Queue
 import datetime as dt
 import hashlib
 import json
+import socket
+import struct
+import threading
+import subprocess
 
 import docker as _docker
 import httpretty
@@ -18,9 +24,18 @@ from flask import current_app, url_for
 from flask.ext.principal import Need
 from flask.ext.webtest import SessionScope
 
+import kozmic
+import kozmic.builds.affinity
+import kozmic.builds.ansi
+import kozmic.builds.mirrors
+import kozmic.builds.pool
+import kozmic.builds.scheduler
 import kozmic.builds.tasks
 import kozmic.builds.views
+import kozmic.builds.watchdog
+import kozmic.metrics
 from kozmic import mail, docker, docker_utils
+from kozmic.utils import get_redis_client
 from kozmic.models import (db, DeployKey, Project, Membership, User, Hook,
                            HookCall, Job, Build, TrackedFile)
 from . import TestCase, factories, func_fixtures, utils, unit_fixtures as fixtures
@@ -529,6 +544,27 @@ class TestHookDB(TestCase):
 
         assert not hook.ensure()
 
+    def test_get_matrix(self):
+        user = factories.UserFactory.create()
+        project = factories.ProjectFactory.create(owner=user)
+        hook = factories.HookFactory.create(project=project,
+                                            docker_image='ubuntu')
+        assert hook.get_matrix() == [
+            {'docker_image': 'ubuntu', 'env': {},
+             'shard_index': 0, 'shard_total': 1},
+        ]
+
+        hook.matrix = [{'env': {'DB': 'mysql'}},
+                       {'docker_image': 'debian', 'env': {}}]
+        hook.shard_count = 2
+        assert [(entry['docker_image'], entry['env'], entry['shard_index'])
+                for entry in hook.get_matrix()] == [
+            ('ubuntu', {'DB': 'mysql'}, 0),
+            ('ubuntu', {'DB': 'mysql'}, 1),
+            ('debian', {}, 0),
+            ('debian', {}, 1),
+        ]
+
     def test_delete_cascade(self):
         """Tests that hook calls are preserved on hook delete."""
         user = factories.UserFactory.create()
@@ -562,13 +598,7 @@ Through another lonely day, whoaa.
 
 
 class TestTailer(TestCase):
-    # We can't mock _kill_container method in ahother thread,
-    # so just make it no-op to ease testing.
-    class _Tailer(kozmic.builds.tasks.Tailer):
-        def _kill_container(self):
-            pass
-
-    def test_tailer(self):
+    def _test_tailer(self):
         config = current_app.config
         redis_client = redis.StrictRedis(host=config['KOZMIC_REDIS_HOST'],
                                          port=config['KOZMIC_REDIS_PORT'],
@@ -579,10 +609,9 @@ class TestTailer(TestCase):
         listener = channel.listen()
 
         with tempfile.NamedTemporaryFile(mode='a+b') as f:
-            tailer = self._Tailer(
+            tailer = kozmic.builds.tasks.Tailer(
                 log_path=f.name,
-                publisher=kozmic.builds.tasks.Publisher(redis_client, 'test'),
-                container=mock.MagicMock())
+                publisher=kozmic.builds.tasks.Publisher(redis_client, 'test'))
             tailer.start()
             time.sleep(.5)
 
@@ -598,25 +627,124 @@ class TestTailer(TestCase):
         time.sleep(.5)
         assert KOZMIC_BLUES + '\n' == ''.join(redis_client.lrange('test', 0, -1))
 
-    def test_kill_timeout_is_working(self):
+    def test_tailer(self):
+        self._test_tailer()
+
+    def test_tailer_without_inotify(self):
+        with mock.patch('kozmic.builds.inotify.Watch',
+                        side_effect=OSError(38, 'Function not implemented')):
+            self._test_tailer()
+
+    def test_watch_is_touched(self):
+        watch = mock.MagicMock()
         with tempfile.NamedTemporaryFile(mode='a+b') as f:
-            tailer = self._Tailer(
+            tailer = kozmic.builds.tasks.Tailer(
                 log_path=f.name,
                 publisher=mock.MagicMock(),
-                container={'Id': '564fe66af3aa755d79797e1'},
-                kill_timeout=2)
+                watch=watch)
+            tailer.start()
+            time.sleep(.5)
+            assert not watch.touch.called
 
-            with mock.patch.object(tailer, '_kill_container') as kill_container_mock:
-                tailer.start()
-                time.sleep(1)
-                assert not kill_container_mock.called
-                time.sleep(2)
-            kill_container_mock.assert_called_once_with()
+            f.write('line\n')
+            f.flush()
+            time.sleep(.5)
+            tailer.stop()
+            tailer.join()
+        watch.touch.assert_called_once_with()
+
+
+class TestStreamTailer(unittest.TestCase):
+    def _frame(self, data, stream=1):
+        return struct.pack('>BxxxL', stream, len(data)) + data
+
+    def test_stream_tailer(self):
+        container_end, tailer_end = socket.socketpair()
+        docker_mock = mock.MagicMock()
+        docker_mock.attach_socket.return_value = tailer_end
+        publisher = mock.MagicMock()
+        watch = mock.MagicMock()
+
+        tailer = kozmic.builds.tasks.StreamTailer(
+            docker=docker_mock,
+            container={'Id': '564fe66af3aa755d79797e1'},
+            publisher=publisher,
+            watch=watch,
+            poll_interval=0.1)
+        tailer.start()
+
+        lines = KOZMIC_BLUES.split('\n')
+        container_end.sendall(self._frame('\n'.join(lines[:3]) + '\n'))
+        container_end.sendall(self._frame('\n'.join(lines[3:])))
+        time.sleep(.5)
+        assert tailer.is_alive()
+
+        tailer.stop()
+        tailer.join(1)
+        assert not tailer.is_alive()
+        container_end.close()
+
+        docker_mock.attach_socket.assert_called_once_with(
+            {'Id': '564fe66af3aa755d79797e1'},
+            params={'stdout': 1, 'stderr': 0, 'stream': 1, 'logs': 1})
+        assert publisher.publish.call_args_list == [
+            mock.call(lines[:3]), mock.call(lines[3:-1]),
+            mock.call([lines[-1]])]
+        assert watch.touch.call_count == 2
+
+
+class TestWatchdog(unittest.TestCase):
+    def setUp(self):
+        self.watchdog = kozmic.builds.watchdog.Watchdog(
+            cancel_check_interval=0.1)
+        self.watchdog.start()
+        self.kill = mock.MagicMock()
+
+    def test_kill_timeout_is_working(self):
+        stalled_container = {'Id': '564fe66af3aa755d79797e1'}
+        active_container = {'Id': '72b4b8e9f2f38b1ed2d0c6e'}
+        stopped_container = {'Id': 'fe1a0f5c2f7a0c5f9a3a1b2'}
+
+        stalled_watch = self.watchdog.watch(
+            stalled_container, timeout=1, kill=self.kill)
+        active_watch = self.watchdog.watch(
+            active_container, timeout=1, kill=self.kill)
+        stopped_watch = self.watchdog.watch(
+            stopped_container, timeout=1, kill=self.kill)
+        stopped_watch.stop()
+
+        for _ in range(6):
+            time.sleep(.25)
+            active_watch.touch()
+        self.kill.assert_called_once_with(stalled_container)
+        assert stalled_watch.has_stalled
+        assert not active_watch.has_stalled
+        assert not stopped_watch.has_stalled
+
+        time.sleep(1.25)
+        assert self.kill.call_args_list == [
+            mock.call(stalled_container), mock.call(active_container)]
+        assert active_watch.has_stalled
+
+    def test_cancellation(self):
+        is_cancelled = threading.Event()
+        container = {'Id': '564fe66af3aa755d79797e1'}
+        watch = self.watchdog.watch(container, timeout=60, kill=self.kill,
+                                    is_cancelled=is_cancelled.isSet)
+        time.sleep(.5)
+        assert not self.kill.called
+
+        is_cancelled.set()
+        time.sleep(.5)
+        self.kill.assert_called_once_with(container)
+        assert watch.has_been_cancelled
+        assert not watch.has_stalled
 
 
 class TestPublisher(TestCase):
     def test_ansi_sequences_formatting(self):
         redis_mock = mock.MagicMock()
+        pipeline_mock = redis_mock.pipeline.return_value
 
         publisher = kozmic.builds.tasks.Publisher(redis_mock, 'test')
         publisher.publish([
@@ -630,8 +758,77 @@ class TestPublisher(TestCase):
             mock.call('test', '<span class="ansi36">-&gt;</span> running '
                               '<span class="ansi36">1 suite</span>\n')
         ]
-        assert redis_mock.rpush.call_args_list == expected_calls
-        assert redis_mock.publish.call_args_list == expected_calls
+        assert pipeline_mock.rpush.call_args_list == expected_calls
+        assert pipeline_mock.publish.call_args_list == expected_calls
+        # The lines and the counters are sent in one round trip
+        assert pipeline_mock.execute.call_count == 1
+        pipeline_mock.hincrby.assert_any_call(
+            kozmic.metrics.COUNTERS_KEY, 'log_published_messages', 2)
+        assert not redis_mock.hincrby.called
+
+    def test_buffering(self):
+        redis_mock = mock.MagicMock()
+        pipeline_mock = redis_mock.pipeline.return_value
+
+        publisher = kozmic.builds.tasks.Publisher(
+            redis_mock, 'test', flush_interval=60, batch_size=10)
+        publisher.publish(['one', 'two'])
+        assert not pipeline_mock.execute.called
+
+        # The batch size is exceeded -- everything is sent in one round trip
+        publisher.publish('three')
+        assert pipeline_mock.rpush.call_args_list == [
+            mock.call('test', 'one\n', 'two\n', 'three\n')]
+        assert pipeline_mock.publish.call_args_list == [
+            mock.call('test', 'one\ntwo\nthree\n')]
+        assert pipeline_mock.execute.call_count == 1
+        pipeline_mock.hincrby.assert_any_call(
+            kozmic.metrics.COUNTERS_KEY, 'log_published_lines', 3)
+
+        # `finish` sends what is left before removing the channel key
+        publisher.publish('four')
+        publisher.finish()
+        assert pipeline_mock.rpush.call_args_list[-1] == mock.call('test', 'four\n')
+        assert pipeline_mock.execute.call_count == 2
+        redis_mock.delete.assert_called_once_with('test')
+        assert not redis_mock.publish.called
+        assert not redis_mock.rpush.called
+
+    def test_buffer_is_flushed_after_interval(self):
+        redis_mock = mock.MagicMock()
+        pipeline_mock = redis_mock.pipeline.return_value
+
+        publisher = kozmic.builds.tasks.Publisher(
+            redis_mock, 'test', flush_interval=0.2)
+        publisher.publish(['one', 'two'])
+        assert not pipeline_mock.execute.called
+        time.sleep(0.5)
+        pipeline_mock.publish.assert_called_once_with('test', 'one\ntwo\n')
+        assert pipeline_mock.execute.call_count == 1
+
+
+class TestAnsiToHtmlConverter(unittest.TestCase):
+    def test_state_is_carried_between_lines(self):
+        converter = kozmic.builds.ansi.AnsiToHtmlConverter()
+        assert converter.convert_lines([
+            '\x1b[1;31mFAILED',
+            'tests/unit_tests.py:42: AssertionError',
+            'E  assert 1 == 2\x1b[0m done',
+        ]) == [
+            '<span class="ansi1 ansi31">FAILED</span>',
+            '<span class="ansi1 ansi31">tests/unit_tests.py:42: '
+            'AssertionError</span>',
+            '<span class="ansi1 ansi31">E  assert 1 == 2</span> done',
+        ]
+
+        converter.reset()
+        assert converter.convert('plain') == 'plain'
+
+    def test_escaping_and_non_sgr_sequences(self):
+        converter = kozmic.builds.ansi.AnsiToHtmlConverter()
+        assert converter.convert(
+            '\x1b[2K<b>&</b> \x1b[38;5;208mwarning') == (
+            '&lt;b&gt;&amp;&lt;/b&gt; <span class="ansi38-208">warning</span>')
 
 
 @pytest.mark.docker
@@ -689,17 +886,286 @@ class TestBuilder(TestCase):
         assert builder.return_code == 1
 
 
+    def test_builder_with_git_mirror(self):
+        with kozmic.builds.tasks.create_temp_dir() as build_dir:
+            head_sha = utils.create_git_repo(os.path.join(build_dir, 'test-repo'))
+            mirror_path = kozmic.builds.mirrors.update_git_mirror(
+                os.path.join(build_dir, 'mirrors'), 1,
+                os.path.join(build_dir, 'test-repo'), head_sha)
+
+            builder = kozmic.builds.tasks.Builder(
+                docker=docker._get_current_object(),
+                docker_image='kozmic/ubuntu-base:12.04',
+                script='#!/bin/bash\nbash ./kozmic.sh',
+                working_dir=build_dir,
+                # The repository is not reachable from the container,
+                # so it can only be cloned from the mirror
+                clone_url='/nonexistent-repo',
+                commit_sha=head_sha,
+                mirror_path=mirror_path,
+                message_queue=mock.MagicMock())
+            builder.run()
+
+            with open(os.path.join(build_dir, 'script.log'), 'r') as log:
+                stdout = log.read().strip()
+
+        assert builder.return_code == 0
+        assert stdout == 'Hello!'
+
+    def test_builder_with_streamed_output(self):
+        with kozmic.builds.tasks.create_temp_dir() as build_dir:
+            head_sha = utils.create_git_repo(os.path.join(build_dir, 'test-repo'))
+
+            builder = kozmic.builds.tasks.Builder(
+                docker=docker._get_current_object(),
+                docker_image='kozmic/ubuntu-base:12.04',
+                script='#!/bin/bash\nbash ./kozmic.sh',
+                working_dir=build_dir,
+                clone_url='/kozmic/test-repo',
+                commit_sha=head_sha,
+                message_queue=mock.MagicMock(),
+                stream_output=True)
+            builder.run()
+
+            assert not os.path.exists(os.path.join(build_dir, 'script.log'))
+
+        assert builder.return_code == 0
+        assert docker.logs(builder.container, stderr=False).strip() == 'Hello!'
+
+    def test_script_timings(self):
+        with kozmic.builds.tasks.create_temp_dir() as build_dir:
+            builder = kozmic.builds.tasks.Builder(
+                docker=mock.MagicMock(),
+                docker_image='kozmic/ubuntu-base:12.04',
+                script='#!/bin/bash\nbash ./kozmic.sh',
+                working_dir=build_dir,
+                clone_url='/kozmic/test-repo',
+                commit_sha='HEAD',
+                message_queue=mock.MagicMock())
+            # The clone has not finished
+            assert builder._get_script_timings(1000.0) == []
+
+            with open(os.path.join(build_dir, 'clone-started-at'), 'w') as f:
+                f.write('990.5\n')
+            with open(os.path.join(build_dir, 'clone-finished-at'), 'w') as f:
+                f.write('992.0\n')
+            assert builder._get_script_timings(1000.0) == [
+                ('git clone', 1.5), ('script', 8.0)]
+
+    def test_test_timings(self):
+        with kozmic.builds.tasks.create_temp_dir() as build_dir:
+            builder = kozmic.builds.tasks.Builder(
+                docker=mock.MagicMock(),
+                docker_image='kozmic/ubuntu-base:12.04',
+                script='#!/bin/bash\nbash ./kozmic.sh',
+                working_dir=build_dir,
+                clone_url='/kozmic/test-repo',
+                commit_sha='HEAD',
+                message_queue=mock.MagicMock())
+            assert builder._get_test_timings() == {}
+
+            with open(os.path.join(build_dir, 'test-timings.tsv'), 'w') as f:
+                f.write('tests.py::test_a\t1.5\n'
+                        'tests.py::test b\t0.25\n'
+                        'garbage\n'
+                        'tests.py::test_c\tslow\n')
+            assert builder._get_test_timings() == {
+                'tests.py::test_a': 1.5,
+                'tests.py::test b': 0.25,
+            }
+
+
+class TestShardTests(unittest.TestCase):
+    def shard_tests(self, tests, timings, shard_total):
+        """Runs `/kozmic/shard-tests` helper for every shard and returns
+        lists of the tests of the shards.
+        """
+        temp_dir = tempfile.mkdtemp()
+        try:
+            script_path = os.path.join(temp_dir, 'shard-tests')
+            with open(script_path, 'w') as f:
+                f.write(kozmic.builds.tasks.SHARD_TESTS_SH)
+            timings_path = os.path.join(temp_dir, 'shard-timings.tsv')
+            with open(timings_path, 'w') as f:
+                for test, seconds in timings.items():
+                    f.write('{}\t{}\n'.format(test, seconds))
+
+            shards = []
+            for shard_index in range(shard_total):
+                env = dict(os.environ,
+                           KOZMIC_SHARD_TIMINGS=timings_path,
+                           KOZMIC_SHARD_INDEX=str(shard_index),
+                           KOZMIC_SHARD_TOTAL=str(shard_total))
+                process = subprocess.Popen(
+                    ['bash', script_path], env=env,
+                    stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+                stdout, _ = process.communicate('\n'.join(tests) + '\n')
+                assert process.returncode == 0
+                shards.append(stdout.splitlines())
+            return shards
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_shards_are_balanced(self):
+        timings = {'a': 10, 'b': 5, 'c': 4, 'd': 1, 'removed': 100}
+        # "e" and "f" are new and are assumed to take the average time, 5 s
+        shards = self.shard_tests(['f', 'e', 'd', 'c', 'b', 'a', 'a'],
+                                  timings, shard_total=3)
+        assert shards == [['a'], ['b', 'f'], ['e', 'c', 'd']]
+
+    def test_single_shard(self):
+        assert self.shard_tests(['b', 'a'], {}, shard_total=1) == [['a', 'b']]
+
+
+class TestContainerPool(unittest.TestCase):
+    def setUp(self):
+        self.docker = mock.MagicMock()
+        self.docker.create_container.side_effect = (
+            lambda image, **kwargs: {'Id': image + '-container'})
+        self.docker.inspect_container.return_value = {
+            'State': {'Running': True}}
+        self.image_ids = {'ubuntu': 'ubuntu-1', 'debian': 'debian-1'}
+        self.docker.inspect_image.side_effect = (
+            lambda image: {'Id': self.image_ids[image]})
+
+    def _wait_for_idle(self, pool, idle):
+        for _ in range(50):
+            if pool.get_stats()['idle'] == idle:
+                return
+            time.sleep(.1)
+        assert pool.get_stats()['idle'] == idle
+
+    def test_claim(self):
+        pool = kozmic.builds.pool.ContainerPool(
+            docker=self.docker, size=2, idle_timeout=60)
+        assert pool.claim('ubuntu', '/mirrors/1') is None
+        self._wait_for_idle(pool, 1)
+        assert pool.claim('ubuntu') is None
+        self._wait_for_idle(pool, 2)
+
+        warm_container = pool.claim('ubuntu', '/mirrors/1')
+        with warm_container as working_dir:
+            assert warm_container.container == {'Id': 'ubuntu-1-container'}
+            assert os.path.exists(os.path.join(working_dir, 'pool-starter.sh'))
+            assert stat.S_ISFIFO(os.stat(os.path.join(working_dir, 'go')).st_mode)
+            _, kwargs = self.docker.start.call_args_list[0]
+            assert kwargs['binds'] == {working_dir: '/kozmic',
+                                       '/mirrors/1': '/kozmic-mirror:ro'}
+        assert not os.path.exists(working_dir)
+        self._wait_for_idle(pool, 2)
+        assert pool.get_stats() == {'idle': 2, 'hits': 1, 'misses': 2}
+
+        # A container that has given up waiting is not claimed
+        # and is removed even though it can not be killed
+        self.docker.inspect_container.return_value = {
+            'State': {'Running': False}}
+        self.docker.kill.side_effect = Exception('Container is not running')
+        assert pool.claim('ubuntu') is None
+        self.docker.remove_container.assert_called_once_with(
+            {'Id': 'ubuntu-1-container'})
+
+    def test_size_budget(self):
+        pool = kozmic.builds.pool.ContainerPool(
+            docker=self.docker, size=1, idle_timeout=60)
+        pool.claim('debian')
+        self._wait_for_idle(pool, 1)
+
+        # More used image takes the place of a less used one...
+        pool.claim('ubuntu')
+        pool.claim('ubuntu')
+        time.sleep(.5)
+        assert pool.get_stats()['idle'] == 1
+        self.docker.remove_container.assert_called_once_with(
+            {'Id': 'debian-1-container'})
+        assert pool.claim('ubuntu') is not None
+
+        # ...but not the other way round
+        self.docker.remove_container.reset_mock()
+        time.sleep(.5)
+        pool.claim('debian')
+        time.sleep(.5)
+        assert not self.docker.remove_container.called
+        assert pool.get_stats()['idle'] == 1
+
+    def test_idle_timeout(self):
+        pool = kozmic.builds.pool.ContainerPool(
+            docker=self.docker, size=2, idle_timeout=0.5)
+        pool.claim('ubuntu')
+        self._wait_for_idle(pool, 1)
+        time.sleep(1)
+        assert pool.get_stats()['idle'] == 0
+        self.docker.kill.assert_called_once_with({'Id': 'ubuntu-1-container'})
+        self.docker.remove_container.assert_called_once_with(
+            {'Id': 'ubuntu-1-container'})
+
+    def test_moved_tag(self):
+        pool = kozmic.builds.pool.ContainerPool(
+            docker=self.docker, size=2, idle_timeout=60)
+        pool.claim('ubuntu')
+        self._wait_for_idle(pool, 1)
+
+        # `docker pull` has moved the tag: the container of the old
+        # image is removed and not claimed
+        self.image_ids['ubuntu'] = 'ubuntu-2'
+        assert pool.claim('ubuntu') is None
+        self.docker.remove_container.assert_called_once_with(
+            {'Id': 'ubuntu-1-container'})
+        self._wait_for_idle(pool, 1)
+        warm_container = pool.claim('ubuntu')
+        assert warm_container.container == {'Id': 'ubuntu-2-container'}
+
+
+class TestGitMirrors(unittest.TestCase):
+    def setUp(self):
+        self.working_dir = tempfile.mkdtemp()
+        self.repo_path = os.path.join(self.working_dir, 'test-repo')
+        self.mirrors_dir = os.path.join(self.working_dir, 'mirrors')
+
+    def tearDown(self):
+        shutil.rmtree(self.working_dir)
+
+    def test_update_git_mirror(self):
+        head_sha = utils.create_git_repo(self.repo_path)
+        mirror_path = kozmic.builds.mirrors.update_git_mirror(
+            self.mirrors_dir, 1, self.repo_path, head_sha)
+        assert mirror_path == os.path.join(self.mirrors_dir, '1.git')
+
+        utils.add_commit_to_git_repo(self.repo_path)
+        new_head_sha = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=self.repo_path).strip()
+        assert new_head_sha != head_sha
+
+        # The new commit is fetched into the existing mirror
+        assert kozmic.builds.mirrors.update_git_mirror(
+            self.mirrors_dir, 1, self.repo_path, new_head_sha) == mirror_path
+        subprocess.check_call(['git', '--git-dir', mirror_path,
+                               'cat-file', '-e', new_head_sha])
+
+    def test_update_git_mirror_failure(self):
+        head_sha = utils.create_git_repo(self.repo_path)
+        assert kozmic.builds.mirrors.update_git_mirror(
+            self.mirrors_dir, 1, self.repo_path, '0' * 40) is None
+        assert kozmic.builds.mirrors.update_git_mirror(
+            self.mirrors_dir, 2, '/nonexistent-repo', head_sha) is None
+        # A failed clone leaves nothing behind
+        assert sorted(os.listdir(self.mirrors_dir)) == [
+            '1.git', '1.git.lock', '2.git.lock']
+
+
 class BuilderStub(kozmic.builds.tasks.Builder):
     def run(self):
         time.sleep(1)
 
+        log_path = os.path.join(self._working_dir, 'script.log')
+        open(log_path, 'w').close()
+
         self._message_queue.put({'Id': 'qwerty'}, block=True, timeout=60)
         self._message_queue.join()
 
-        log_path = os.path.join(self._working_dir, 'script.log')
         with open(log_path, 'a') as log:
             log.write('Everything went great!\nGood bye.')
 
+        self.test_timings = {u'tests.py::test_a': 1.5}
         self.return_code = 0
 
 
@@ -720,17 +1186,20 @@ class TestBuildTaskDB(TestCase):
             with mock.patch.object(Build, 'set_status') as set_status_mock, \
                  mock.patch.object(DeployKey, 'ensure') as ensure_deploy_key_mock, \
                  mock.patch('kozmic.builds.tasks.Builder', new=BuilderStub), \
-                 mock.patch('kozmic.builds.tasks.Tailer') as tailer_mock, \
                  mock.patch.multiple('docker.Client', pull=mock.DEFAULT,
-                                     inspect_image=mock.DEFAULT):
-                tailer_mock.return_value.has_killed_container = False
+                                     inspect_image=mock.Mock(
+                                         return_value={'Id': 'image-id'})):
                 kozmic.builds.tasks.do_job(hook_call_id=hook_call_id)
         self.db.session.rollback()
 
         assert self.build.jobs.count() == 1
         job = self.build.jobs.first()
         assert job.return_code == 0
-        assert 'Everything went great!\nGood bye.' in job.stdout
+        assert job.docker_image_id == 'image-id'
+        assert kozmic.builds.tasks._get_test_timings(self.hook) == {
+            'tests.py::test_a': 1.5}
+        assert job.get_log().endswith('Everything went great!\nGood bye.\n')
+        assert [phase for phase, _ in job.get_timings()] == ['docker pull']
         build_number = self.build.number
         ensure_deploy_key_mock.assert_called_once_with()
         set_status_mock.assert_has_calls([
@@ -742,6 +1211,21 @@ class TestBuildTaskDB(TestCase):
                 description='Kozmic build #{} has passed'.format(build_number)),
         ])
 
+    def test_do_job_frees_slot_if_job_is_not_created(self):
+        scheduler = kozmic.builds.scheduler
+        with mock.patch('kozmic.builds.tasks.do_job'):
+            scheduler.enqueue(self.hook_call)
+        assert scheduler.get_stats() == {'enqueued': 0, 'running': 1}
+
+        hook_call_id = self.hook_call.id
+        with SessionScope(self.db):
+            with mock.patch.object(Job, 'started', side_effect=RuntimeError):
+                with pytest.raises(RuntimeError):
+                    kozmic.builds.tasks.do_job(hook_call_id=hook_call_id)
+        self.db.session.rollback()
+        assert self.build.jobs.count() == 0
+        assert scheduler.get_stats() == {'enqueued': 0, 'running': 0}
+
     @pytest.mark.docker
     def test_restart_build(self):
         job = factories.JobFactory.create(
@@ -759,7 +1243,7 @@ class TestBuildTaskDB(TestCase):
                  mock.patch('kozmic.builds.tasks._run') as _run_mock, \
                  mock.patch.object(DeployKey, 'ensure') as ensure_deploy_key_mock:
                 _run_mock.return_value.__enter__ = mock.MagicMock(
-                    side_effect=lambda *args, **kwargs: (0, 'output', {'Id': 'container-id'}))
+                    side_effect=lambda *args, **kwargs: (0, {'Id': 'container-id'}))
                 kozmic.builds.tasks.restart_job(job.id)
         self.db.session.rollback()
 
@@ -770,7 +1254,366 @@ class TestBuildTaskDB(TestCase):
         job = self.build.jobs.first()
         assert job_id_before_restart != job.id
         assert job.return_code == 0
-        assert 'output' in job.stdout
+        assert job.get_log().startswith('Pulling "')
+
+    def test_restart_job_reuses_pulled_image(self):
+        job = factories.JobFactory.create(
+            build=self.build,
+            hook_call=self.hook_call,
+            started_at=dt.datetime.utcnow() - dt.timedelta(minutes=2),
+            finished_at=dt.datetime.utcnow(),
+            docker_image_id='image-id',
+            stdout='output')
+
+        with SessionScope(self.db):
+            with mock.patch.object(Build, 'set_status'), \
+                 mock.patch.object(DeployKey, 'ensure'), \
+                 mock.patch('kozmic.builds.tasks.Builder', new=BuilderStub), \
+                 mock.patch.multiple('docker.Client', pull=mock.DEFAULT,
+                                     inspect_image=mock.Mock(
+                                         return_value={'Id': 'image-id'})) \
+                    as docker_mocks:
+                kozmic.builds.tasks.restart_job(job.id)
+        self.db.session.rollback()
+
+        assert not docker_mocks['pull'].called
+        job = self.build.jobs.first()
+        assert job.return_code == 0
+        assert job.docker_image_id == 'image-id'
+        assert job.get_log().startswith('Reusing "')
+        assert [phase for phase, _ in job.get_timings()] == []
+
+    def test_restart_hint(self):
+        tasks = kozmic.builds.tasks
+        job = factories.JobFactory.create(
+            build=self.build,
+            hook_call=self.hook_call,
+            docker_image_id='image-id',
+            cache_id='cache-id')
+
+        tasks._save_restart_hint(job)
+        hint = tasks._pop_restart_hint(self.hook_call)
+        assert hint['docker_image_id'] == 'image-id'
+        assert hint['cache_id'] == 'cache-id'
+        # A hint is used once
+        assert tasks._pop_restart_hint(self.hook_call) == {}
+
+        # The hook has been changed
+        tasks._save_restart_hint(job)
+        factories.TrackedFileFactory.create(hook=self.hook, path='a.txt')
+        assert tasks._pop_restart_hint(self.hook_call) == {}
+
+    def test_test_timings(self):
+        tasks = kozmic.builds.tasks
+        assert tasks._get_test_timings(self.hook) == {}
+
+        # Shards report timings of different tests
+        tasks._save_test_timings(self.hook, {u'test_a': 1.5, u'test_b': 2.0})
+        tasks._save_test_timings(self.hook, {u'test_b': 3.0, u'test_c': 0.1})
+        tasks._save_test_timings(self.hook, {})
+        assert tasks._get_test_timings(self.hook) == {
+            'test_a': 1.5, 'test_b': 3.0, 'test_c': 0.1}
+
+    def test_shard_timings(self):
+        tasks = kozmic.builds.tasks
+        self.hook.shard_count = 2
+        self.db.session.commit()
+        tasks._save_test_timings(self.hook, {u'test_a': 1.5})
+
+        # All the shards of the hook call are split by the same timings
+        assert tasks._get_shard_timings(self.hook_call) == {'test_a': 1.5}
+        tasks._save_test_timings(self.hook, {u'test_a': 3.0})
+        assert tasks._get_shard_timings(self.hook_call) == {'test_a': 1.5}
+
+        # Reported timings are merged once all the shards have finished
+        factories.JobFactory.create(
+            build=self.build, hook_call=self.hook_call, matrix_index=0,
+            finished_at=dt.datetime.utcnow())
+        tasks._report_test_timings(self.hook_call, {u'test_a': 2.0})
+        tasks._merge_test_timings(self.hook_call)
+        assert tasks._get_test_timings(self.hook) == {'test_a': 3.0}
+
+        factories.JobFactory.create(
+            build=self.build, hook_call=self.hook_call, matrix_index=1,
+            finished_at=dt.datetime.utcnow())
+        tasks._report_test_timings(self.hook_call, {u'test_b': 0.5})
+        tasks._merge_test_timings(self.hook_call)
+        assert tasks._get_test_timings(self.hook) == {
+            'test_a': 2.0, 'test_b': 0.5}
+
+    def test_failed_warm_install_falls_back_to_cold_install(self):
+        self.hook.install_script = '#!/bin/bash\npip install -r reqs.txt'
+        self.hook.use_warm_install = True
+        self.db.session.commit()
+        hook_call_id = self.hook_call.id
+        with SessionScope(self.db):
+            with mock.patch.object(Build, 'set_status'), \
+                 mock.patch.object(DeployKey, 'ensure'), \
+                 mock.patch.object(Job, 'get_cache_id', return_value='cache-id'), \
+                 mock.patch('kozmic.builds.tasks.Builder', new=BuilderStub), \
+                 mock.patch('kozmic.builds.tasks.does_docker_image_exist',
+                            return_value=False), \
+                 mock.patch('kozmic.builds.tasks._get_warm_install_image',
+                            return_value=('kozmic-cache/warm:1', 0)) \
+                    as get_warm_install_image_mock, \
+                 mock.patch('kozmic.builds.tasks._install',
+                            side_effect=[RuntimeError, 0]) as install_mock, \
+                 mock.patch.multiple('docker.Client', pull=mock.DEFAULT,
+                                     images=mock.Mock(return_value=[{}]),
+                                     inspect_image=mock.Mock(
+                                         return_value={'Id': 'image-id'})):
+                kozmic.builds.tasks.do_job(hook_call_id=hook_call_id)
+        self.db.session.rollback()
+
+        # The base image is not looked up again
+        args, _ = get_warm_install_image_mock.call_args
+        assert args[1:] == ('image-id', 0)
+        assert ([call[1]['docker_image'] for call in install_mock.call_args_list] ==
+                ['kozmic-cache/warm:1', self.hook.docker_image])
+        job = self.build.jobs.first()
+        assert job.return_code == 0
+        assert 'Warm install has failed.' in job.get_log()
+
+    @mock.patch('kozmic.builds.tasks.does_docker_image_exist', return_value=True)
+    def test_warm_install_image(self, does_docker_image_exist_mock):
+        get_warm_install_image = kozmic.builds.tasks._get_warm_install_image
+        set_warm_install_image = kozmic.builds.tasks._set_warm_install_image
+        assert get_warm_install_image(self.hook, 'base-1') == (None, -1)
+
+        set_warm_install_image(self.hook, 'base-1', 'kozmic-cache/1:1', 0)
+        assert get_warm_install_image(self.hook, 'base-1') == (
+            'kozmic-cache/1:1', 0)
+        does_docker_image_exist_mock.assert_called_once_with(
+            'kozmic-cache/1', '1')
+
+        # The base image has changed
+        assert get_warm_install_image(self.hook, 'base-2') == (None, -1)
+
+        # Too many warm installs in a row
+        set_warm_install_image(
+            self.hook, 'base-1', 'kozmic-cache/2:1',
+            kozmic.builds.tasks.WARM_INSTALL_MAX_DEPTH)
+        assert get_warm_install_image(self.hook, 'base-1') == (None, -1)
+
+        # The image has been removed
+        set_warm_install_image(self.hook, 'base-1', 'kozmic-cache/3:1', 1)
+        does_docker_image_exist_mock.return_value = False
+        assert get_warm_install_image(self.hook, 'base-1') == (None, -1)
+
+
+class TestScheduler(TestCase):
+    def setup_method(self, method):
+        TestCase.setup_method(self, method)
+
+        self.user = factories.UserFactory.create()
+        self.project_1 = factories.ProjectFactory.create(owner=self.user)
+        self.project_2 = factories.ProjectFactory.create(owner=self.user)
+        self.hook_1 = factories.HookFactory.create(project=self.project_1)
+        self.hook_2 = factories.HookFactory.create(project=self.project_2)
+
+    def create_hook_call(self, hook):
+        build = factories.BuildFactory.create(project=hook.project)
+        return factories.HookCallFactory.create(hook=hook, build=build)
+
+    def test_fair_share(self):
+        scheduler = kozmic.builds.scheduler
+        self.app.config['KOZMIC_PROJECT_CONCURRENCY'] = 2
+        self.app.config['KOZMIC_SCHEDULER_CAPACITY'] = 3
+
+        with mock.patch('kozmic.builds.tasks.do_job') as do_job_mock:
+            # The first project pushes many commits
+            calls_1 = [self.create_hook_call(self.hook_1) for _ in range(4)]
+            for hook_call in calls_1:
+                scheduler.enqueue(hook_call)
+            calls_2 = [self.create_hook_call(self.hook_2) for _ in range(2)]
+            for hook_call in calls_2:
+                scheduler.enqueue(hook_call)
+            dispatched = [call[1]['hook_call_id']
+                          for call in do_job_mock.delay.call_args_list]
+            # The first project has run out of its concurrency
+            assert dispatched == [calls_1[0].id, calls_1[1].id, calls_2[0].id]
+
+            assert scheduler.get_queue_position(calls_1[0].build) is None
+            assert scheduler.get_queue_position(calls_1[3].build) == 2
+            assert scheduler.get_queue_position(calls_2[1].build) == 1
+
+            # The default branch build goes ahead of the others
+            priority_call = self.create_hook_call(self.hook_1)
+            scheduler.enqueue(priority_call, priority=scheduler.HIGH_PRIORITY)
+            assert scheduler.get_queue_position(priority_call.build) == 1
+            assert do_job_mock.delay.call_count == 3
+
+            # Both projects have queued jobs, but the first one
+            # has been served least recently
+            do_job_mock.reset_mock()
+            scheduler.job_finished(calls_1[0])
+            do_job_mock.delay.assert_called_once_with(
+                hook_call_id=priority_call.id)
+
+            # Now it is the second project's turn
+            do_job_mock.reset_mock()
+            scheduler.job_finished(calls_2[0])
+            do_job_mock.delay.assert_called_once_with(
+                hook_call_id=calls_2[1].id)
+
+            do_job_mock.reset_mock()
+            scheduler.job_finished(calls_2[1])
+            assert not do_job_mock.delay.called
+
+    def test_expired_jobs(self):
+        scheduler = kozmic.builds.scheduler
+        self.app.config['KOZMIC_PROJECT_CONCURRENCY'] = 1
+
+        with mock.patch('kozmic.builds.tasks.do_job') as do_job_mock:
+            hook_call_1 = self.create_hook_call(self.hook_1)
+            hook_call_2 = self.create_hook_call(self.hook_1)
+            scheduler.enqueue(hook_call_1)
+            scheduler.enqueue(hook_call_2)
+            assert scheduler.dispatch() == []
+
+            # The worker running the first job has died
+            self.app.config['KOZMIC_SCHEDULER_JOB_TIMEOUT'] = -1
+            assert scheduler.dispatch() == [hook_call_2.id]
+        assert do_job_mock.delay.call_count == 2
+
+    def test_get_stats(self):
+        scheduler = kozmic.builds.scheduler
+        self.app.config['KOZMIC_PROJECT_CONCURRENCY'] = 1
+
+        assert scheduler.get_stats() == {'enqueued': 0, 'running': 0}
+        with mock.patch('kozmic.builds.tasks.do_job'):
+            for hook in (self.hook_1, self.hook_1, self.hook_2):
+                scheduler.enqueue(self.create_hook_call(hook))
+        assert scheduler.get_stats() == {'enqueued': 1, 'running': 2}
+
+    def test_matrix(self):
+        scheduler = kozmic.builds.scheduler
+        self.app.config['KOZMIC_PROJECT_CONCURRENCY'] = 2
+        self.hook_1.matrix = [{'docker_image': 'ubuntu:12.04'},
+                              {'docker_image': 'ubuntu:14.04'},
+                              {'env': {'DB': 'mysql'}}]
+
+        with mock.patch('kozmic.builds.tasks.do_job') as do_job_mock:
+            hook_call = self.create_hook_call(self.hook_1)
+            other_hook_call = self.create_hook_call(self.hook_1)
+            scheduler.enqueue(hook_call)
+            scheduler.enqueue(other_hook_call)
+            assert do_job_mock.delay.call_args_list == [
+                mock.call(hook_call_id=hook_call.id),
+                mock.call(hook_call_id=hook_call.id, matrix_index=1),
+            ]
+            assert scheduler.get_queue_position(hook_call.build) == 1
+            assert scheduler.get_queue_position(other_hook_call.build) == 2
+
+            do_job_mock.reset_mock()
+            scheduler.job_finished(hook_call, matrix_index=1)
+            do_job_mock.delay.assert_called_once_with(
+                hook_call_id=hook_call.id, matrix_index=2)
+            assert scheduler.get_queue_position(hook_call.build) is None
+
+            # All the jobs of the hook call are removed from the queue
+            assert scheduler.cancel(other_hook_call)
+            assert scheduler.get_stats() == {'enqueued': 0, 'running': 2}
+
+    def test_affinity(self):
+        scheduler = kozmic.builds.scheduler
+        affinity = kozmic.builds.affinity
+        self.app.config['KOZMIC_PROJECT_CONCURRENCY'] = 4
+
+        # The first worker has pulled the base image
+        with mock.patch('docker.Client.images',
+                        return_value=[{'RepoTags': ['ubuntu:latest']}]):
+            affinity.sync_images('worker-1', concurrency=1)
+        with mock.patch('docker.Client.images', return_value=[]):
+            affinity.sync_images('worker-2', concurrency=2)
+        # The second one has built the cached image
+        self.app.config['KOZMIC_WORKER_QUEUE'] = 'worker-2'
+        affinity.add_image('kozmic-cache/qwerty:1')
+        affinity.set_hook_image(self.hook_1, 'kozmic-cache/qwerty:1')
+
+        with mock.patch('kozmic.builds.tasks.do_job') as do_job_mock:
+            calls = [self.create_hook_call(self.hook_1) for _ in range(4)]
+            for hook_call in calls:
+                scheduler.enqueue(hook_call)
+            assert [(call[1]['kwargs']['hook_call_id'], call[1]['queue'])
+                    for call in do_job_mock.apply_async.call_args_list] == [
+                (calls[0].id, 'worker-2'),
+                (calls[1].id, 'worker-2'),
+                (calls[2].id, 'worker-1'),
+            ]
+            # Both workers are busy
+            do_job_mock.delay.assert_called_once_with(hook_call_id=calls[3].id)
+
+            do_job_mock.reset_mock()
+            scheduler.job_finished(calls[0])
+            hook_call = self.create_hook_call(self.hook_1)
+            scheduler.enqueue(hook_call)
+            do_job_mock.apply_async.assert_called_once_with(
+                kwargs={'hook_call_id': hook_call.id}, queue='worker-2',
+                expires=affinity.ROUTE_TIMEOUT)
+
+        # The second worker has died
+        with mock.patch.object(kozmic.builds.affinity, 'HEARTBEAT_TIMEOUT', -1):
+            assert affinity.route(hook_call.id, self.hook_1.id, 'ubuntu',
+                                  job_timeout=60) is None
+
+    def test_affinity_expired_jobs(self):
+        scheduler = kozmic.builds.scheduler
+        affinity = kozmic.builds.affinity
+        with mock.patch('docker.Client.images',
+                        return_value=[{'RepoTags': ['ubuntu:latest']}]):
+            affinity.sync_images('worker-1', concurrency=2)
+
+        with mock.patch('kozmic.builds.tasks.do_job') as do_job_mock:
+            hook_call_1 = self.create_hook_call(self.hook_1)
+            hook_call_2 = self.create_hook_call(self.hook_1)
+            scheduler.enqueue(hook_call_1)
+            scheduler.enqueue(hook_call_2)
+            assert do_job_mock.apply_async.call_count == 2
+            # The first job has been started by the worker
+            affinity.start(hook_call_1.id)
+
+            # The worker has died before starting the second one
+            do_job_mock.reset_mock()
+            with mock.patch.object(affinity, 'ROUTE_TIMEOUT', -1):
+                assert scheduler.dispatch() == [hook_call_2.id]
+            do_job_mock.delay.assert_called_once_with(
+                hook_call_id=hook_call_2.id)
+            assert not do_job_mock.apply_async.called
+            # It still takes its running slot, but not the worker's one
+            assert scheduler.get_stats() == {'enqueued': 0, 'running': 2}
+            assert get_redis_client().zcard(
+                affinity._get_routed_key('worker-1')) == 1
+
+            # The job is sent again only once
+            with mock.patch.object(affinity, 'ROUTE_TIMEOUT', -1):
+                assert scheduler.dispatch() == []
+
+
+class TestMetrics(TestCase):
+    def test_render(self):
+        kozmic.metrics.incr('cache_hits')
+        kozmic.metrics.incr('cache_hits', 2)
+        kozmic.metrics.observe('job_duration_seconds', 42)
+        kozmic.metrics.observe('job_phase_duration_seconds', 0.5, 'docker pull')
+        kozmic.metrics.observe('job_phase_duration_seconds', 3, 'docker pull')
+
+        lines = kozmic.metrics.render().splitlines()
+        assert '# TYPE kozmic_cache_hits_total counter' in lines
+        assert 'kozmic_cache_hits_total 3' in lines
+        assert 'kozmic_cache_misses_total 0' in lines
+        assert 'kozmic_jobs_enqueued 0' in lines
+        assert '# TYPE kozmic_job_duration_seconds histogram' in lines
+        assert 'kozmic_job_duration_seconds_bucket{le="30"} 0' in lines
+        assert 'kozmic_job_duration_seconds_bucket{le="60"} 1' in lines
+        assert 'kozmic_job_duration_seconds_count 1' in lines
+        assert 'kozmic_job_duration_seconds_sum 42.0' in lines
+        assert ('kozmic_job_phase_duration_seconds_bucket'
+                '{phase="docker pull",le="1"} 1') in lines
+        assert ('kozmic_job_phase_duration_seconds_bucket'
+                '{phase="docker pull",le="5"} 2') in lines
+        assert ('kozmic_job_phase_duration_seconds_count'
+                '{phase="docker pull"} 2') in lines
 
 
 class TestJobDB(TestCase):
@@ -788,10 +1631,7 @@ class TestJobDB(TestCase):
         self.job = factories.JobFactory.create(
             build=self.build, hook_call=self.hook_call)
 
-    @mock.patch('kozmic.docker_utils.get_docker_image_id', return_value=u'id-1')
-    @mock.patch.object(Project, 'gh')
-    def test_get_cache_id_changes_when_tracked_file_changes(
-            self, gh_mock, get_image_id_mock):
+    def track_files(self):
         self.hook.tracked_files.delete()
         self.hook.tracked_files.extend([
             TrackedFile(path='./a/../b/../install.sh'),
@@ -800,22 +1640,33 @@ class TestJobDB(TestCase):
         ])
         db.session.flush()
 
-        dir_entries = ['requirements/basic.txt', 'requirements/dev.txt']
-        deleted_paths = []
+    @staticmethod
+    def make_tree(blob_paths):
+        """Returns :class:`github3.git.Tree` listing `blob_paths`
+        the way a recursive GitHub tree does.
+        """
+        sha = lambda s: hashlib.sha1(s).hexdigest()
+        entries = [{'path': path, 'type': 'blob', 'sha': sha(path)}
+                   for path in blob_paths]
+        dir_paths = set(os.path.dirname(path) for path in blob_paths) - {''}
+        entries.extend({'path': path, 'type': 'tree',
+                        'sha': sha(json.dumps(sorted(blob_paths)) + path)}
+                       for path in dir_paths)
+        return github3.git.Tree({
+            'sha': sha(json.dumps(sorted(blob_paths))),
+            'tree': entries,
+            'truncated': False,
+        })
 
-        def contents(path, ref=None):
-            # Mock github3.repo.Repository.contents method
-            if path == 'requirements':
-                # Pretend that "requirements" is a directory
-                return dict(zip(dir_entries, map(contents, dir_entries)))
-            else:
-                # Other paths are regular files, maybe deleted
-                if path in deleted_paths:
-                    return None
-                rv = mock.MagicMock()  # Mock github3.repos.contents.Contents
-                rv.sha = hashlib.sha256(path).hexdigest()
-                return rv
-        gh_mock.contents.side_effect = contents
+    @mock.patch('kozmic.docker_utils.get_docker_image_id', return_value=u'id-1')
+    @mock.patch.object(Project, 'gh')
+    def test_get_cache_id_changes_when_tracked_file_changes(
+            self, gh_mock, get_image_id_mock):
+        self.track_files()
+        blob_paths = ['install.sh', 'Gemfile', 'README.md',
+                      'requirements/basic.txt', 'requirements/dev.txt']
+        gh_mock.recursive_tree.side_effect = \
+            lambda sha: self.make_tree(blob_paths)
 
         seen_cache_ids = set()
 
@@ -824,32 +1675,94 @@ class TestJobDB(TestCase):
         assert cache_id not in seen_cache_ids
         seen_cache_ids.add(cache_id)
 
-        # Make sure that `get_cache_id` asked GitHub API for contents
-        # of all the tracked files using their normalized paths.
-        # Also make sure that calls are made in lexicographical order
-        assert gh_mock.contents.call_args_list == [
-            mock.call('Gemfile', ref=self.build.gh_commit_sha),
-            mock.call('install.sh', ref=self.build.gh_commit_sha),
-            mock.call('requirements', ref=self.build.gh_commit_sha),
-        ]
+        # Make sure that `get_cache_id` asked GitHub API for the commit tree
+        # only once, and did not ask for contents of the tracked files
+        assert gh_mock.recursive_tree.call_args_list == [
+            mock.call(self.build.gh_commit_sha)]
+        assert not gh_mock.contents.called
+
+        # Change an untracked file and make sure the cache id is not changed
+        blob_paths.remove('README.md')
+        self.build.gh_commit_sha = 'b' * 40
+        cache_id = self.job.get_cache_id()
+        assert cache_id in seen_cache_ids
 
         # Add a new file to the tracked directory and
         # make sure the cache id is changed
-        dir_entries.append('requirements/new-file.txt')
+        blob_paths.append('requirements/new-file.txt')
+        self.build.gh_commit_sha = 'c' * 40
         cache_id = self.job.get_cache_id()
         assert cache_id not in seen_cache_ids
         seen_cache_ids.add(cache_id)
 
         # Delete one of the tracked files and make sure the cache id is changed
-        deleted_paths.append('install.sh')
+        blob_paths.remove('install.sh')
+        self.build.gh_commit_sha = 'd' * 40
         cache_id = self.job.get_cache_id()
         assert cache_id not in seen_cache_ids
         seen_cache_ids.add(cache_id)
 
         # Change nothing and make sure the cache id is not changed
+        self.build.gh_commit_sha = 'e' * 40
         cache_id = self.job.get_cache_id()
         assert cache_id in seen_cache_ids
 
+    @mock.patch('kozmic.docker_utils.get_docker_image_id', return_value=u'id-1')
+    @mock.patch.object(Project, 'gh')
+    def test_get_cache_id_is_memoized(self, gh_mock, get_image_id_mock):
+        self.track_files()
+        gh_mock.recursive_tree.return_value = self.make_tree(
+            ['install.sh', 'requirements/basic.txt'])
+        cache_id = self.job.get_cache_id()
+
+        # Another job of the same build does not call GitHub API
+        job = factories.JobFactory.create(
+            build=self.build, hook_call=self.hook_call)
+        assert job.get_cache_id() == cache_id
+        assert gh_mock.recursive_tree.call_count == 1
+
+        # Other install script -- other cache id, but the tracked files
+        # are not looked up again
+        self.hook.install_script = '#!/bin/bash\nbundle install'
+        other_cache_id = job.get_cache_id()
+        assert other_cache_id != cache_id
+        assert gh_mock.recursive_tree.call_count == 1
+
+        # So are other entries of the build matrix
+        self.hook.matrix = [{}, {'env': {'DB': 'mysql'}}]
+        job.matrix_index = 1
+        assert job.get_cache_id() not in (cache_id, other_cache_id)
+        assert gh_mock.recursive_tree.call_count == 1
+
+    @mock.patch('kozmic.docker_utils.get_docker_image_id', return_value=u'id-1')
+    @mock.patch.object(Project, 'gh')
+    def test_get_cache_id_with_truncated_tree(self, gh_mock, get_image_id_mock):
+        self.track_files()
+        tree = self.make_tree(['install.sh', 'Gemfile',
+                               'requirements/basic.txt'])
+        gh_mock.recursive_tree.return_value = tree
+        cache_id = self.job.get_cache_id()
+
+        get_redis_client().flushdb()
+        tree.to_json()['truncated'] = True
+
+        def contents(path, ref=None):
+            # Mock github3.repo.Repository.contents method
+            assert ref == self.build.gh_commit_sha
+            entries = dict((entry.path, entry) for entry in tree.tree)
+            if path == 'requirements':
+                return {'basic.txt': entries['requirements/basic.txt']}
+            return entries.get(path)
+        gh_mock.contents.side_effect = contents
+
+        # Falling back to GitHub contents API gives the same cache id
+        assert self.job.get_cache_id() == cache_id
+        assert gh_mock.contents.call_args_list == [
+            mock.call('Gemfile', ref=self.build.gh_commit_sha),
+            mock.call('install.sh', ref=self.build.gh_commit_sha),
+            mock.call('requirements', ref=self.build.gh_commit_sha),
+        ]
+
     @mock.patch('kozmic.docker_utils.get_docker_image_id', return_value='id-1')
     @mock.patch.object(Project, 'gh')
     def test_get_cache_id_changes_when__script_changes(
@@ -889,6 +1802,122 @@ class TestJobDB(TestCase):
         cache_id = self.job.get_cache_id()
         assert cache_id not in seen_cache_ids
 
+    @mock.patch.object(Build, 'set_status')
+    def test_finished_with_matrix(self, set_status_mock):
+        self.hook.matrix = [{}, {'docker_image': 'ubuntu:14.04',
+                                 'env': {'DB': 'mysql'}}]
+        other_hook = factories.HookFactory.create(project=self.project)
+        other_hook_call = factories.HookCallFactory.create(
+            hook=other_hook, build=self.build)
+        assert self.job.title == u'{} (ubuntu)'.format(self.hook.title)
+        statuses = lambda: [call[0][0] for call in
+                            set_status_mock.call_args_list]
+
+        self.job.started()
+        self.job.finished(0)
+        # The jobs of the second entry and of the other hook
+        # have not been started yet
+        assert statuses() == ['pending']
+
+        job = factories.JobFactory.create(
+            build=self.build, hook_call=self.hook_call, matrix_index=1)
+        assert job.title == u'{} (ubuntu:14.04 DB=mysql)'.format(
+            self.hook.title)
+        job.started()
+        job.finished(0)
+        assert statuses() == ['pending', 'pending']
+
+        job = factories.JobFactory.create(
+            build=self.build, hook_call=other_hook_call)
+        assert job.title == other_hook.title
+        job.started()
+        job.finished(0)
+        set_status_mock.assert_called_with(
+            'success', description='Kozmic build #{} has passed'.format(
+                self.build.number))
+
+    def test_log(self):
+        writer = kozmic.builds.tasks.JobLogWriter(
+            self.db.engine, self.job.id, chunk_size=4)
+        writer.write('Hello')
+        writer.write(', world!\n')
+        assert self.job.log_chunks.count() == 3
+        writer.flush()
+        assert [chunk.size for chunk in self.job.log_chunks] == [4, 4, 4, 2]
+        assert [chunk.offset for chunk in self.job.log_chunks] == [0, 4, 8, 12]
+
+        assert self.job.get_log_size() == 14
+        assert self.job.get_log() == 'Hello, world!\n'
+        assert self.job.get_log(start=3, end=9) == 'lo, wo'
+        assert self.job.get_log(start=4, end=8) == 'o, w'
+        assert self.job.get_log(start=12) == '!\n'
+        assert self.job.get_log(start=20) == ''
+        assert self.job.get_log(start=5, end=5) == ''
+        # Only the chunks overlapping the range are fetched
+        assert list(self.job.iter_log(start=5, end=10)) == [', w', 'or']
+
+    def test_get_log_tail_offset(self):
+        writer = kozmic.builds.tasks.JobLogWriter(
+            self.db.engine, self.job.id, chunk_size=3)
+        writer.write('one\ntwo\n\nfour')
+        writer.flush()
+
+        get_tail = lambda lines: self.job.get_log(
+            start=self.job.get_log_tail_offset(lines))
+        assert get_tail(0) == ''
+        assert get_tail(1) == 'four'
+        assert get_tail(2) == '\nfour'
+        assert get_tail(3) == 'two\n\nfour'
+        assert get_tail(4) == 'one\ntwo\n\nfour'
+        assert get_tail(5) == 'one\ntwo\n\nfour'
+
+        writer.write('\n')
+        writer.flush()
+        assert get_tail(1) == 'four\n'
+        assert get_tail(2) == '\nfour\n'
+
+    def test_get_log_html(self):
+        self.job.stdout = '\x1b[4mHello!\x1b[24m'
+        self.job.started_at = dt.datetime.utcnow()
+        self.db.session.commit()
+        # The job is running -- its log is not cached
+        assert self.job.get_log_html() == '<span class="ansi4">Hello!</span>'
+        assert kozmic.models.get_log_html_cache_stats() == {
+            'hits': 0, 'misses': 0}
+
+        self.job.finished_at = dt.datetime.utcnow()
+        self.job.return_code = 0
+        self.db.session.commit()
+        assert self.job.get_log_html() == '<span class="ansi4">Hello!</span>'
+        with mock.patch.object(Job, '_iter_log_html') as render_mock:
+            assert (self.job.get_log_html() ==
+                    '<span class="ansi4">Hello!</span>')
+            assert not render_mock.called
+        assert kozmic.models.get_log_html_cache_stats() == {
+            'hits': 1, 'misses': 1}
+
+    def test_get_log_html_from_chunks(self):
+        writer = kozmic.builds.tasks.JobLogWriter(
+            self.db.engine, self.job.id, chunk_size=3)
+        # Chunks split the ANSI sequences and the UTF-8 character, the color
+        # is carried over the lines
+        writer.write(u'\x1b[31mПр\nok\x1b[0m\n'.encode('utf-8'))
+        writer.flush()
+        self.job.started_at = dt.datetime.utcnow()
+        self.job.finished_at = dt.datetime.utcnow()
+        self.job.return_code = 0
+        self.db.session.commit()
+        assert self.job.log_chunks.count() > 1
+        assert self.job.get_log_html() == (
+            u'<span class="ansi31">Пр\n</span>'
+            u'<span class="ansi31">ok</span>\n')
+
+    def test_legacy_log(self):
+        self.job.stdout = 'Hello, world!\n'
+        assert self.job.get_log_size() == 14
+        assert self.job.get_log() == 'Hello, world!\n'
+        assert self.job.get_log(start=7, end=12) == 'world'
+
 
 class TestCommands(TestCase):
     @mock.patch('kozmic.builds.commands.docker')
@@ -909,6 +1938,37 @@ class TestCommands(TestCase):
         ]
 
 
+    @mock.patch('kozmic.builds.commands.docker')
+    def test_clean_dependencies_cache_evicts_least_recently_used(
+            self, docker_mock):
+        i = 'kozmic-cache/{}:{}'.format
+        docker_mock.images.return_value = [
+            {'RepoTags': [i('a1', '1')], 'Created': 100, 'Id': 'id-a1', 'Size': 10},
+            {'RepoTags': [i('b1', '1')], 'Created': 200, 'Id': 'id-b1', 'Size': 20},
+            {'RepoTags': [i('c1', '1')], 'Created': 300, 'Id': 'id-c1', 'Size': 30},
+            {'RepoTags': [i('d1', '1')], 'Created': 400, 'Id': 'id-d1', 'Size': 40},
+            {'RepoTags': [i('a2', '2')], 'Created': 150, 'Id': 'id-a2', 'Size': 50},
+            {'RepoTags': ['ubuntu:latest'], 'Created': 50, 'Id': 'id-u', 'Size': 99},
+        ]
+        # a1 is the oldest image, but it has been used recently
+        with mock.patch('time.time', return_value=1000):
+            docker_utils.touch_cached_image('kozmic-cache/a1', '1')
+
+        self.app.config['KOZMIC_CACHED_IMAGES_DISK_BUDGET'] = 100
+        kozmic.builds.commands.clean_dependencies_cache(dry_run=True)
+        assert not docker_mock.remove_image.called
+
+        kozmic.builds.commands.clean_dependencies_cache()
+        # b1 exceeds the per-project limit. After it is removed, 130 bytes
+        # are left, so the least recently used a2 is removed to fit the budget
+        assert docker_mock.remove_image.call_args_list == [
+            mock.call('id-a2'),
+            mock.call('id-b1'),
+        ]
+        assert docker_utils.get_cached_images_last_used() == {
+            'kozmic-cache/a1:1': 1000}
+
+
 class TestUtils(TestCase):
     @mock.patch.object(_docker.Client, 'images')
     def test_does_docker_image_exist(self, images_mock):
@@ -941,3 +2001,62 @@ class TestUtils(TestCase):
         assert docker_utils.does_docker_image_exist('ubuntu')
         assert not docker_utils.does_docker_image_exist('ubuntu', tag='qwerty')
         assert not docker_utils.does_docker_image_exist('debian')
+
+
+class TestDockerClient(unittest.TestCase):
+    def setUp(self):
+        self.working_dir = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.working_dir, 'docker.sock')
+        self.server = utils.UnixHTTPServer(
+            self.socket_path, '/v1.10/images/json', json.dumps([]))
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.start()
+        self.config = {
+            'DOCKER_URL': 'unix://' + self.socket_path,
+            'DOCKER_API_VERSION': '1.10',
+            'DOCKER_TIMEOUT': 10,
+            'DOCKER_POOL_SIZE': 2,
+        }
+
+    def tearDown(self):
+        client = docker_utils.get_docker_client(self.config)
+        client.get_adapter(client.base_url).close()
+        self.server.shutdown()
+        self.server_thread.join()
+        self.server.server_close()
+        shutil.rmtree(self.working_dir)
+
+    def test_client_is_shared_and_reuses_connections(self):
+        client = docker_utils.get_docker_client(self.config)
+        assert docker_utils.get_docker_client(dict(self.config)) is client
+
+        stats_before = docker_utils.get_docker_pool_stats()
+
+        def request_images():
+            for _ in range(5):
+                assert client.images() == []
+
+        threads = [threading.Thread(target=request_images) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        stats = docker_utils.get_docker_pool_stats()
+        assert stats['requests'] - stats_before['requests'] == 10
+        assert 1 <= stats['connections'] - stats_before['connections'] <= 2
+
+
+class TestWorkerApp(unittest.TestCase):
+    def test_app_is_created_once_per_process(self):
+        with mock.patch('kozmic._worker_app', None):
+            with mock.patch('kozmic.create_app',
+                            wraps=kozmic.create_app) as create_app_mock:
+                kozmic.init_worker_process()
+                app = kozmic.get_worker_app()
+                assert kozmic.get_worker_app() is app
+                assert create_app_mock.call_count == 1
+
+                with mock.patch('os.getpid', return_value=-1):
+                    assert kozmic.get_worker_app() is not app
+                assert create_app_mock.call_count == 2
@@ -1,4 +1,6 @@
 import subprocess
+import SocketServer
+import BaseHTTPServer
 
 from Crypto.PublicKey import RSA
 
@@ -47,3 +49,35 @@ def add_commit_to_git_repo(target_dir):
 def generate_private_key(passphrase):
     rsa_key = RSA.generate(1024)
     return rsa_key.exportKey(format='PEM', passphrase=passphrase)
+
+
+class UnixHTTPServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """A keep-alive HTTP server listening on a Unix socket that
+    responds to GET requests for `path` with `body` and to any other
+    request with 404.
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path, path, body):
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                if self.path.split('?', 1)[0] != path:
+                    self.send_response(404)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def address_string(self):
+                return socket_path
+
+            def log_message(self, *args):
+                pass
+
+        SocketServer.UnixStreamServer.__init__(self, socket_path, Handler)